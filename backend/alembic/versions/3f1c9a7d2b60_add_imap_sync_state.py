@@ -0,0 +1,38 @@
+"""add imap_sync_state
+
+Revision ID: 3f1c9a7d2b60
+Revises: 099be33742b7
+Create Date: 2026-03-02 10:12:41.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9a7d2b60'
+down_revision: Union[str, Sequence[str], None] = '099be33742b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "imap_sync_state",
+        sa.Column("account_id", sa.Integer(), sa.ForeignKey("email_accounts.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("org_id", sa.Integer(), nullable=False),
+        sa.Column("uidvalidity", sa.BigInteger(), nullable=False),
+        sa.Column("last_uid", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("highestmodseq", sa.BigInteger(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+    op.create_index("ix_imap_sync_state_org_id", "imap_sync_state", ["org_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_imap_sync_state_org_id", table_name="imap_sync_state")
+    op.drop_table("imap_sync_state")
@@ -0,0 +1,76 @@
+"""add worker hot query indexes
+
+Revision ID: 4e8a1c6f0b27
+Revises: f19c3a7d5e84
+Create Date: 2026-03-20 10:12:44.381950
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e8a1c6f0b27'
+down_revision: Union[str, Sequence[str], None] = 'f19c3a7d5e84'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# name -> (table, columns / expressions, create_index kwargs)
+# Built CONCURRENTLY so the worker keeps writing conversation_audit / org_usage meanwhile.
+INDEXES = {
+    # replied_to_sender_recently() / snapshot sender_recent
+    "ix_conversation_audit_out_sender": (
+        "conversation_audit",
+        ["org_id", sa.text("lower(customer_email)"), "created_at"],
+        {"postgresql_where": sa.text("direction = 'OUT'")},
+    ),
+    # already_replied() / snapshot already_replied
+    "ix_conversation_audit_out_message": (
+        "conversation_audit",
+        ["org_id", "email_message_id"],
+        {"postgresql_where": sa.text("direction = 'OUT'")},
+    ),
+    # replies_sent_last_hour() / Redis window warm-up (index-only with qty)
+    "ix_org_usage_org_event_created": (
+        "org_usage",
+        ["org_id", "event", "created_at"],
+        {"postgresql_include": ["qty"]},
+    ),
+}
+
+
+def _drop_if_invalid(name: str) -> None:
+    # A CONCURRENTLY build that failed or was interrupted leaves an INVALID index behind
+    invalid = op.get_bind().execute(
+        sa.text(
+            """
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name AND NOT i.indisvalid
+            """
+        ),
+        {"name": name},
+    ).scalar()
+    if invalid:
+        op.drop_index(name, postgresql_concurrently=True, if_exists=True)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, (table, columns, kwargs) in INDEXES.items():
+            _drop_if_invalid(name)
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **kwargs)
+        op.execute("ANALYZE conversation_audit")
+        op.execute("ANALYZE org_usage")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, (table, _, _) in INDEXES.items():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,30 @@
+"""add llm metrics to conversation_audit
+
+Revision ID: 5b8d1e3f7a20
+Revises: a7e2c4d91b38
+Create Date: 2026-03-12 09:41:18.274530
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8d1e3f7a20'
+down_revision: Union[str, Sequence[str], None] = 'a7e2c4d91b38'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("conversation_audit", sa.Column("ai_latency_ms", sa.Integer(), nullable=True))
+    op.add_column("conversation_audit", sa.Column("ai_retries", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("conversation_audit", "ai_retries")
+    op.drop_column("conversation_audit", "ai_latency_ms")
@@ -0,0 +1,29 @@
+"""add organizations.prompt_token_budget
+
+Revision ID: 8c4f2a6e1d93
+Revises: 5b8d1e3f7a20
+Create Date: 2026-03-13 11:05:52.618340
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c4f2a6e1d93'
+down_revision: Union[str, Sequence[str], None] = '5b8d1e3f7a20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # NULL = PROMPT_TOKEN_BUDGET from the worker env
+    op.add_column("organizations", sa.Column("prompt_token_budget", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("organizations", "prompt_token_budget")
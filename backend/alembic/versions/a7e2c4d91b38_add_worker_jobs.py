@@ -0,0 +1,58 @@
+"""add worker_jobs
+
+Revision ID: a7e2c4d91b38
+Revises: 3f1c9a7d2b60
+Create Date: 2026-03-09 14:27:05.604311
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7e2c4d91b38'
+down_revision: Union[str, Sequence[str], None] = '3f1c9a7d2b60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "worker_jobs",
+        sa.Column("id", sa.BigInteger(), primary_key=True),
+        sa.Column("org_id", sa.Integer(), nullable=False),
+        sa.Column("account_id", sa.Integer(), sa.ForeignKey("email_accounts.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("dedupe_key", sa.String(length=512), nullable=False),
+        sa.Column("thread_key", sa.String(length=512), nullable=True),
+        sa.Column("stage", sa.String(length=16), nullable=False),
+        sa.Column("status", sa.String(length=16), nullable=False, server_default="queued"),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("max_attempts", sa.Integer(), nullable=False, server_default="5"),
+        sa.Column("run_after", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.Column("locked_by", sa.String(length=100), nullable=True),
+        sa.Column("locked_until", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("payload", postgresql.JSONB(), nullable=False),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.UniqueConstraint("org_id", "dedupe_key", name="uq_worker_jobs_org_dedupe"),
+    )
+    op.create_index("ix_worker_jobs_org_id", "worker_jobs", ["org_id"])
+    # Claim scan: only open jobs, in run order per stage
+    op.create_index(
+        "ix_worker_jobs_claim",
+        "worker_jobs",
+        ["stage", "run_after", "id"],
+        postgresql_where=sa.text("status IN ('queued', 'running')"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_worker_jobs_claim", table_name="worker_jobs")
+    op.drop_index("ix_worker_jobs_org_id", table_name="worker_jobs")
+    op.drop_table("worker_jobs")
@@ -0,0 +1,49 @@
+"""add message_thread_index
+
+Revision ID: b6d2e8a41c07
+Revises: e3b7c91f4a52
+Create Date: 2026-03-18 11:07:52.613904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6d2e8a41c07'
+down_revision: Union[str, Sequence[str], None] = 'e3b7c91f4a52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "message_thread_index",
+        sa.Column("org_id", sa.BigInteger(), nullable=False),
+        sa.Column("message_id", sa.Text(), nullable=False),
+        sa.Column("thread_key", sa.String(length=512), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("org_id", "message_id", name="pk_message_thread_index"),
+    )
+    op.create_index("ix_message_thread_index_thread", "message_thread_index", ["org_id", "thread_key"])
+
+    # Seed with the inbound Message-IDs already audited (their current thread keys stay canonical)
+    op.execute(
+        """
+        INSERT INTO message_thread_index (org_id, message_id, thread_key, created_at)
+        SELECT DISTINCT ON (org_id, email_message_id) org_id, email_message_id, thread_key, created_at
+        FROM conversation_audit
+        WHERE direction = 'IN' AND email_message_id IS NOT NULL AND email_message_id <> ''
+        ORDER BY org_id, email_message_id, created_at
+        ON CONFLICT DO NOTHING
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_message_thread_index_thread", table_name="message_thread_index")
+    op.drop_table("message_thread_index")
@@ -0,0 +1,45 @@
+"""add org_filter_rules
+
+Revision ID: e3b7c91f4a52
+Revises: 8c4f2a6e1d93
+Create Date: 2026-03-16 15:22:09.481736
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3b7c91f4a52'
+down_revision: Union[str, Sequence[str], None] = '8c4f2a6e1d93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "org_filter_rules",
+        sa.Column("id", sa.BigInteger(), primary_key=True),
+        sa.Column("org_id", sa.Integer(), sa.ForeignKey("organizations.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("action", sa.String(length=8), nullable=False),
+        sa.Column("field", sa.String(length=16), nullable=False),
+        sa.Column("match_type", sa.String(length=16), nullable=False, server_default="contains"),
+        sa.Column("pattern", sa.String(length=500), nullable=False),
+        sa.Column("enabled", sa.Boolean(), nullable=False, server_default=sa.text("true")),
+        sa.Column("note", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.CheckConstraint("action IN ('allow', 'deny')", name="ck_org_filter_rules_action"),
+        sa.CheckConstraint("field IN ('sender', 'subject', 'headers', 'body')", name="ck_org_filter_rules_field"),
+        sa.CheckConstraint("match_type IN ('contains', 'domain', 'regex')", name="ck_org_filter_rules_match_type"),
+    )
+    op.create_index("ix_org_filter_rules_org_id", "org_filter_rules", ["org_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_org_filter_rules_org_id", table_name="org_filter_rules")
+    op.drop_table("org_filter_rules")
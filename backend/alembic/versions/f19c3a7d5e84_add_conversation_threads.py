@@ -0,0 +1,86 @@
+"""add conversation_threads
+
+Revision ID: f19c3a7d5e84
+Revises: b6d2e8a41c07
+Create Date: 2026-03-19 16:48:31.207115
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f19c3a7d5e84'
+down_revision: Union[str, Sequence[str], None] = 'b6d2e8a41c07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "conversation_threads",
+        sa.Column("org_id", sa.BigInteger(), nullable=False),
+        sa.Column("thread_key", sa.String(length=512), nullable=False),
+        sa.Column("first_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.Column("last_in_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("last_out_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("last_message_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.Column("message_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("last_customer_email", sa.String(length=320), nullable=True),
+        sa.Column("last_subject", sa.String(length=998), nullable=True),
+        sa.Column("recent_messages", postgresql.JSONB(), server_default=sa.text("'[]'::jsonb"), nullable=False),
+        sa.PrimaryKeyConstraint("org_id", "thread_key", name="pk_conversation_threads"),
+    )
+    op.create_index(
+        "ix_conversation_threads_org_last_message",
+        "conversation_threads",
+        ["org_id", sa.text("last_message_at DESC")],
+    )
+
+    # Build the state of every existing thread from conversation_audit (12 = THREAD_RECENT_MESSAGES)
+    op.execute(
+        """
+        INSERT INTO conversation_threads (
+            org_id, thread_key, first_at, last_in_at, last_out_at, last_message_at,
+            message_count, last_customer_email, last_subject, recent_messages
+        )
+        SELECT a.org_id,
+               a.thread_key,
+               MIN(a.created_at),
+               MAX(a.created_at) FILTER (WHERE a.direction = 'IN'),
+               MAX(a.created_at) FILTER (WHERE a.direction = 'OUT'),
+               MAX(a.created_at),
+               COUNT(*),
+               (array_agg(a.customer_email ORDER BY a.created_at DESC) FILTER (WHERE a.customer_email IS NOT NULL))[1],
+               (array_agg(a.subject ORDER BY a.created_at DESC) FILTER (WHERE a.subject IS NOT NULL))[1],
+               COALESCE((
+                   SELECT jsonb_agg(
+                              jsonb_build_object(
+                                  'direction', r.direction,
+                                  'at', r.created_at,
+                                  'text', left(btrim(coalesce(r.body_text, ''), E' \\t\\r\\n'), 4000)
+                              ) ORDER BY r.created_at, r.id
+                          )
+                   FROM (
+                       SELECT id, direction, created_at, body_text
+                       FROM conversation_audit r
+                       WHERE r.org_id = a.org_id AND r.thread_key = a.thread_key
+                       ORDER BY created_at DESC, id DESC
+                       LIMIT 12
+                   ) r
+               ), '[]'::jsonb)
+        FROM conversation_audit a
+        GROUP BY a.org_id, a.thread_key
+        ON CONFLICT DO NOTHING
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_conversation_threads_org_last_message", table_name="conversation_threads")
+    op.drop_table("conversation_threads")
@@ -6,7 +6,9 @@ from sqlalchemy.orm import Session
 
 from app.db import engine
 from app.models import Organization
-from app.models import Organization, ConversationAudit, WorkerStatus
+from app.models import Organization, ConversationAudit, WorkerStatus, OrgFilterRule
+from app.services.org_settings_cache import invalidate_org_settings
+from app.services.filter_rules import invalidate_filter_rules, load_rules, validate_rule
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -65,6 +67,7 @@ def get_org(org_id: int, x_admin_token: Optional[str] = Header(None)):
             "system_prompt": o.system_prompt,
             "auto_reply": o.auto_reply,
             "max_replies_per_hour": o.max_replies_per_hour,
+            "prompt_token_budget": o.prompt_token_budget,
         }
 
 
@@ -88,6 +91,7 @@ def update_org(
         "system_prompt",
         "auto_reply",
         "max_replies_per_hour",
+        "prompt_token_budget",
     }
 
     with Session(engine) as db:
@@ -101,5 +105,125 @@ def update_org(
                 setattr(o, key, value)
 
         db.commit()
+        invalidate_org_settings(org_id)
 
         return {"ok": True, "updated_org_id": org_id}
+
+
+# --------------------------------------------------
+# ORG FILTER RULES (allow / deny on top of the built-in filters)
+# --------------------------------------------------
+RULE_EDITABLE_FIELDS = {"action", "field", "match_type", "pattern", "enabled", "note"}
+
+
+def _rule_out(r: OrgFilterRule) -> dict:
+    return {
+        "id": r.id,
+        "org_id": r.org_id,
+        "action": r.action,
+        "field": r.field,
+        "match_type": r.match_type,
+        "pattern": r.pattern,
+        "enabled": r.enabled,
+        "note": r.note,
+        "updated_at": r.updated_at,
+    }
+
+
+def _require_org(db: Session, org_id: int):
+    if not db.query(Organization.id).filter(Organization.id == org_id).first():
+        raise HTTPException(status_code=404, detail="Organization not found")
+
+
+@router.get("/orgs/{org_id}/filter-rules")
+def list_filter_rules(org_id: int, x_admin_token: Optional[str] = Header(None)):
+    require_admin_token(x_admin_token)
+
+    with Session(engine) as db:
+        _require_org(db, org_id)
+        rows = db.query(OrgFilterRule).filter(OrgFilterRule.org_id == org_id).order_by(OrgFilterRule.id).all()
+        return [_rule_out(r) for r in rows]
+
+
+@router.post("/orgs/{org_id}/filter-rules")
+def create_filter_rule(org_id: int, payload: dict, x_admin_token: Optional[str] = Header(None)):
+    require_admin_token(x_admin_token)
+
+    rule = {k: v for k, v in payload.items() if k in RULE_EDITABLE_FIELDS}
+    rule["match_type"] = rule.get("match_type") or "contains"
+    rule["pattern"] = (rule.get("pattern") or "").strip()
+    error = validate_rule(rule)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+
+    with Session(engine) as db:
+        _require_org(db, org_id)
+        r = OrgFilterRule(org_id=org_id, **rule)
+        db.add(r)
+        db.commit()
+        db.refresh(r)
+        invalidate_filter_rules(org_id)
+        return _rule_out(r)
+
+
+@router.put("/orgs/{org_id}/filter-rules/{rule_id}")
+def update_filter_rule(org_id: int, rule_id: int, payload: dict, x_admin_token: Optional[str] = Header(None)):
+    require_admin_token(x_admin_token)
+
+    with Session(engine) as db:
+        r = db.query(OrgFilterRule).filter(OrgFilterRule.org_id == org_id, OrgFilterRule.id == rule_id).first()
+        if not r:
+            raise HTTPException(status_code=404, detail="Filter rule not found")
+
+        merged = _rule_out(r)
+        merged.update({k: v for k, v in payload.items() if k in RULE_EDITABLE_FIELDS})
+        merged["pattern"] = (merged.get("pattern") or "").strip()
+        error = validate_rule(merged)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+
+        for key in RULE_EDITABLE_FIELDS:
+            setattr(r, key, merged[key])
+        db.commit()
+        db.refresh(r)
+        invalidate_filter_rules(org_id)
+        return _rule_out(r)
+
+
+@router.delete("/orgs/{org_id}/filter-rules/{rule_id}")
+def delete_filter_rule(org_id: int, rule_id: int, x_admin_token: Optional[str] = Header(None)):
+    require_admin_token(x_admin_token)
+
+    with Session(engine) as db:
+        r = db.query(OrgFilterRule).filter(OrgFilterRule.org_id == org_id, OrgFilterRule.id == rule_id).first()
+        if not r:
+            raise HTTPException(status_code=404, detail="Filter rule not found")
+        db.delete(r)
+        db.commit()
+        invalidate_filter_rules(org_id)
+        return {"ok": True, "deleted_rule_id": rule_id}
+
+
+@router.post("/orgs/{org_id}/filter-rules/test")
+def test_filter_rules(org_id: int, payload: dict, x_admin_token: Optional[str] = Header(None)):
+    """
+    Evaluate a sample email {sender, subject, headers, body} against the org's enabled rules
+    (read fresh, not from the worker cache). pre_fetch is what the worker decides from headers alone.
+    """
+    require_admin_token(x_admin_token)
+
+    with Session(engine) as db:
+        _require_org(db, org_id)
+
+    fields = {f: str(payload.get(f) or "") for f in ("sender", "subject", "headers", "body")}
+    compiled = load_rules(engine, org_id)
+    pre_action, pre_rule = compiled.evaluate_headers(fields["sender"], fields["subject"], fields["headers"])
+    action, rule = compiled.evaluate(fields)
+    return {
+        "org_id": org_id,
+        "rules_enabled": len(compiled.rules),
+        "decision": action,
+        "rule": rule,
+        "pre_fetch": {"decision": pre_action, "rule": pre_rule},
+        "matches": compiled.matches(fields),
+    }
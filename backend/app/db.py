@@ -16,11 +16,19 @@ DATABASE_URL = os.getenv("DATABASE_URL") or f"sqlite:///{DB_PATH}"
 # SQLite needs this for multi-thread/multi-worker
 connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
 
+# Optional pool sizing (the worker may run many accounts concurrently, see WORKER_CONCURRENCY)
+pool_args = {}
+if os.getenv("DB_POOL_SIZE"):
+    pool_args["pool_size"] = int(os.getenv("DB_POOL_SIZE"))
+if os.getenv("DB_MAX_OVERFLOW"):
+    pool_args["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW"))
+
 engine = create_engine(
     DATABASE_URL,
     future=True,
     pool_pre_ping=True,
     pool_reset_on_return="rollback",
+    **pool_args,
 )
 
 @event.listens_for(Engine, "connect")
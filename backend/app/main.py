@@ -171,6 +171,7 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None,
 
 app.include_router(me.router)
 app.include_router(whoami_router)
+app.include_router(admin_router)            # orgs, filter rules (X-Admin-Token)
 app.include_router(admin_c3_router)
 app.include_router(billing_router)          # Stripe
 app.include_router(manual_billing_router)   # Manual
@@ -9,10 +9,12 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
     func,
+    text,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -44,6 +46,7 @@ class Organization(Base):
     # Controls
     auto_reply = Column(Integer, default=1)
     max_replies_per_hour = Column(Integer, default=10)
+    prompt_token_budget = Column(Integer, nullable=True)  # NULL = worker default (PROMPT_TOKEN_BUDGET)
 
     # Enterprise toggle + cooldown
     cooldown_hours = Column(Integer, default=24, nullable=False)
@@ -106,9 +109,28 @@ class ConversationAudit(Base):
     ai_model: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
     ai_tokens_in: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     ai_tokens_out: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    ai_latency_ms: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # LLM wall-clock incl. retries
+    ai_retries: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
+    # Worker pre-send checks (sender cooldown, already replied) only ever look at OUT rows
+    __table_args__ = (
+        Index(
+            "ix_conversation_audit_out_sender",
+            "org_id",
+            text("lower(customer_email)"),
+            "created_at",
+            postgresql_where=text("direction = 'OUT'"),
+        ),
+        Index(
+            "ix_conversation_audit_out_message",
+            "org_id",
+            "email_message_id",
+            postgresql_where=text("direction = 'OUT'"),
+        ),
+    )
+
 
 class WorkerStatus(Base):
     __tablename__ = "worker_status"
@@ -165,7 +187,12 @@ class OrgUsage(Base):
 
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
 
-from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey, String, UniqueConstraint
+    # Hourly reply rate: SUM(qty) per org / event over a time window, index-only
+    __table_args__ = (
+        Index("ix_org_usage_org_event_created", "org_id", "event", "created_at", postgresql_include=["qty"]),
+    )
+
+from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey, Index, String, UniqueConstraint
 from sqlalchemy.sql import func
 
 class ReplyThreadLock(Base):
@@ -201,3 +228,106 @@ class ReplyThreadLock(Base):
         UniqueConstraint("org_id", "thread_key", name="uq_reply_thread_locks_org_thread"),
     )
 
+
+
+class ImapSyncState(Base):
+    __tablename__ = "imap_sync_state"
+
+    # One incremental-sync cursor per mailbox (INBOX)
+    account_id = Column(
+        Integer,
+        ForeignKey("email_accounts.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    org_id = Column(Integer, nullable=False, index=True)
+
+    uidvalidity = Column(BigInteger, nullable=False)
+    last_uid = Column(BigInteger, nullable=False, default=0)
+    # Only set when the server supports CONDSTORE
+    highestmodseq = Column(BigInteger, nullable=True)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class WorkerJob(Base):
+    __tablename__ = "worker_jobs"
+    __table_args__ = (
+        UniqueConstraint("org_id", "dedupe_key", name="uq_worker_jobs_org_dedupe"),
+    )
+
+    # Durable reply pipeline: ingest -> generate -> deliver (claimed with FOR UPDATE SKIP LOCKED)
+    id = Column(BigInteger, primary_key=True)
+    org_id = Column(Integer, nullable=False, index=True)
+    account_id = Column(Integer, ForeignKey("email_accounts.id", ondelete="CASCADE"), nullable=False)
+
+    # Normalized Message-ID, or "uid:<account>:<uidvalidity>:<uid>" when there is none
+    dedupe_key = Column(String(512), nullable=False)
+    thread_key = Column(String(512), nullable=True)
+
+    stage = Column(String(16), nullable=False)  # generate | deliver
+    status = Column(String(16), nullable=False, default="queued")  # queued | running | done | skipped | dead
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+
+    run_after = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    locked_by = Column(String(100), nullable=True)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+
+    payload = Column(JSONB, nullable=False)
+    last_error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class OrgFilterRule(Base):
+    __tablename__ = "org_filter_rules"
+
+    # Per-org allow/deny rules on top of the built-in mail filters (app.services.filter_rules)
+    id = Column(BigInteger, primary_key=True)
+    org_id = Column(Integer, ForeignKey("organizations.id", ondelete="CASCADE"), nullable=False, index=True)
+
+    action = Column(String(8), nullable=False)  # allow | deny
+    field = Column(String(16), nullable=False)  # sender | subject | headers | body
+    match_type = Column(String(16), nullable=False, default="contains")  # contains | domain | regex
+    pattern = Column(String(500), nullable=False)
+    enabled = Column(Boolean, nullable=False, default=True)
+    note = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class MessageThreadIndex(Base):
+    __tablename__ = "message_thread_index"
+
+    # message_id (normalized: lowercase, no <>) -> canonical thread_key, for IN and OUT mail
+    # (app.services.thread_index). First mapping wins.
+    org_id = Column(BigInteger, primary_key=True)
+    message_id = Column(Text, primary_key=True)
+    thread_key = Column(String(512), nullable=False)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (Index("ix_message_thread_index_thread", "org_id", "thread_key"),)
+
+
+class ConversationThread(Base):
+    __tablename__ = "conversation_threads"
+
+    # One row per thread, kept current by log_conversation() in the same transaction as the
+    # conversation_audit row: cooldown / needs-reply checks and thread history are PK reads.
+    org_id = Column(BigInteger, primary_key=True)
+    thread_key = Column(String(512), primary_key=True)
+
+    first_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    last_in_at = Column(DateTime(timezone=True), nullable=True)
+    last_out_at = Column(DateTime(timezone=True), nullable=True)
+    last_message_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    message_count = Column(Integer, nullable=False, default=0)
+    last_customer_email = Column(String(320), nullable=True)
+    last_subject = Column(String(998), nullable=True)
+    # Rolling window of the newest messages, oldest first: [{"direction", "at", "text"}, ...]
+    recent_messages = Column(JSONB, nullable=False, default=list)
+
+    __table_args__ = (Index("ix_conversation_threads_org_last_message", "org_id", last_message_at.desc()),)
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from typing import Optional, List
 
 from fastapi import APIRouter, Depends, HTTPException
@@ -11,7 +11,9 @@ from sqlalchemy.orm import Session
 from sqlalchemy import desc
 
 # Import your models (adjust paths)
-from app.models import Organization, ConversationAudit, WorkerStatus  # <-- adjust if different
+from app.models import Organization, ConversationAudit, ConversationThread, WorkerStatus  # <-- adjust if different
+from app.services.observability import llm_usage_by_day
+from app.services.org_settings_cache import invalidate_org_settings
 
 
 router = APIRouter(prefix="/admin", tags=["admin-c3"])
@@ -39,6 +41,19 @@ class ConversationOut(BaseModel):
     created_at: datetime
 
 
+class ThreadOut(BaseModel):
+    org_id: int
+    thread_key: str
+    first_at: datetime
+    last_in_at: Optional[datetime] = None
+    last_out_at: Optional[datetime] = None
+    last_message_at: datetime
+    message_count: int
+    last_customer_email: Optional[str] = None
+    last_subject: Optional[str] = None
+    needs_reply: bool
+
+
 class WorkerStatusOut(BaseModel):
     worker_id: str
     last_run_at: Optional[datetime] = None
@@ -51,6 +66,18 @@ class WorkerStatusOut(BaseModel):
     updated_at: Optional[datetime] = None
 
 
+class LlmUsageDayOut(BaseModel):
+    org_id: int
+    day: date
+    replies: int
+    tokens_in: int
+    tokens_out: int
+    retries: int
+    llm_calls: int
+    p50_latency_ms: Optional[int] = None
+    p95_latency_ms: Optional[int] = None
+
+
 # --------- Endpoints ---------
 
 @router.patch("/orgs/{org_id}/auto-reply", response_model=AutoReplyToggleOut)
@@ -63,6 +90,7 @@ def set_org_auto_reply(org_id: int, payload: AutoReplyToggleIn, db: Session = De
     db.add(org)
     db.commit()
     db.refresh(org)
+    invalidate_org_settings(org.id)
     return AutoReplyToggleOut(org_id=org.id, auto_reply_enabled=org.auto_reply_enabled)
 
 
@@ -98,6 +126,54 @@ def get_org_conversations(org_id: int, limit: int = 20, db: Session = Depends(ge
     ]
 
 
+@router.get("/orgs/{org_id}/threads", response_model=List[ThreadOut])
+def get_org_threads(
+    org_id: int,
+    limit: int = 20,
+    before: Optional[datetime] = None,
+    needs_reply: Optional[bool] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Threads by latest activity, from conversation_threads (index on org_id, last_message_at).
+    Page with before=<last_message_at of the last row>; needs_reply=true lists threads whose
+    newest message is an unanswered IN.
+    """
+    org = db.get(Organization, org_id)
+    if not org:
+        raise HTTPException(status_code=404, detail="Org not found")
+
+    limit = max(1, min(limit, 100))
+
+    q = db.query(ConversationThread).filter(ConversationThread.org_id == org_id)
+    if before is not None:
+        q = q.filter(ConversationThread.last_message_at < before)
+    unanswered = ConversationThread.last_in_at.isnot(None) & (
+        ConversationThread.last_out_at.is_(None) | (ConversationThread.last_in_at > ConversationThread.last_out_at)
+    )
+    if needs_reply is True:
+        q = q.filter(unanswered)
+    elif needs_reply is False:
+        q = q.filter(~unanswered)
+
+    rows = q.order_by(desc(ConversationThread.last_message_at)).limit(limit).all()
+    return [
+        ThreadOut(
+            org_id=r.org_id,
+            thread_key=r.thread_key,
+            first_at=r.first_at,
+            last_in_at=r.last_in_at,
+            last_out_at=r.last_out_at,
+            last_message_at=r.last_message_at,
+            message_count=r.message_count,
+            last_customer_email=r.last_customer_email,
+            last_subject=r.last_subject,
+            needs_reply=bool(r.last_in_at and (r.last_out_at is None or r.last_in_at > r.last_out_at)),
+        )
+        for r in rows
+    ]
+
+
 @router.get("/worker-status", response_model=List[WorkerStatusOut])
 def list_worker_status(db: Session = Depends(get_db)):
     rows = db.query(WorkerStatus).order_by(desc(WorkerStatus.updated_at)).limit(50).all()
@@ -115,3 +191,10 @@ def list_worker_status(db: Session = Depends(get_db)):
         )
         for r in rows
     ]
+
+
+@router.get("/llm-usage", response_model=List[LlmUsageDayOut])
+def get_llm_usage(days: int = 7, org_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """Per-org daily token spend and p50/p95 generation latency (from OUT conversation_audit rows)."""
+    days = max(1, min(days, 90))
+    return [LlmUsageDayOut(**r) for r in llm_usage_by_day(db, days=days, org_id=org_id)]
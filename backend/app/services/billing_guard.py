@@ -1,5 +1,9 @@
-﻿import json
-from typing import Any, Dict, Optional
+﻿import atexit
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
 
 from sqlalchemy import text
 from sqlalchemy.engine import Engine
@@ -137,3 +141,199 @@ def log_usage(
     except SQLAlchemyError:
         # Swallow logging errors; but engine.begin() already rolled back safely.
         return
+
+
+# ---------------------- credit leases ----------------------
+# A worker reserves a block of credits in one UPDATE and spends them in memory.
+# Leased credits are counted in credits_used until spent or released, so other workers
+# never see them as available. org_usage keeps the exact per-reply accounting.
+CREDIT_LEASE_SIZE = int(os.getenv("CREDIT_LEASE_SIZE", "10"))
+CREDIT_LEASE_SECONDS = int(os.getenv("CREDIT_LEASE_SECONDS", "300"))
+
+
+def lease_credits(engine: Engine, org_id: int, qty: int) -> Tuple[int, Any, float]:
+    """
+    Atomically reserve up to `qty` credits (moves them into credits_used).
+    Returns (granted, lease_date, seconds_to_midnight). granted=0 when nothing is left or on error.
+    lease_date is the credits_reset_at day the block belongs to (see release_credits).
+    """
+    qty = int(qty or 0)
+    if qty <= 0:
+        return 0, None, 0.0
+
+    try:
+        with engine.begin() as conn:
+            _ensure_org_credits_row(conn, org_id)
+            _reset_if_needed(conn, org_id)
+
+            row = conn.execute(
+                text(
+                    """
+                    WITH cur AS (
+                        SELECT org_id, LEAST(:qty, GREATEST(credits_total - credits_used, 0)) AS n
+                        FROM org_credits
+                        WHERE org_id = :oid
+                        FOR UPDATE
+                    )
+                    UPDATE org_credits c
+                    SET credits_used = c.credits_used + cur.n,
+                        updated_at = NOW()
+                    FROM cur
+                    WHERE c.org_id = cur.org_id
+                    RETURNING cur.n,
+                              c.credits_reset_at,
+                              EXTRACT(EPOCH FROM ((CURRENT_DATE + 1)::timestamptz - NOW()))
+                    """
+                ),
+                {"oid": org_id, "qty": qty},
+            ).fetchone()
+
+            if not row:
+                return 0, None, 0.0
+            return int(row[0] or 0), row[1], float(row[2] or 0)
+    except SQLAlchemyError:
+        return 0, None, 0.0
+
+
+def release_credits(engine: Engine, org_id: int, qty: int, lease_date) -> bool:
+    """
+    Return unused leased credits. Only applies while the org is still on the same credits day:
+    after a daily reset the leased block was already wiped, so returning it would over-credit.
+    """
+    qty = int(qty or 0)
+    if qty <= 0 or lease_date is None:
+        return True
+
+    try:
+        with engine.begin() as conn:
+            res = conn.execute(
+                text(
+                    """
+                    UPDATE org_credits
+                    SET credits_used = GREATEST(credits_used - :qty, 0),
+                        updated_at = NOW()
+                    WHERE org_id = :oid
+                      AND credits_reset_at = :lease_date
+                      AND credits_reset_at = CURRENT_DATE
+                    """
+                ),
+                {"oid": org_id, "qty": qty, "lease_date": lease_date},
+            )
+            return (res.rowcount or 0) == 1
+    except SQLAlchemyError:
+        return False
+
+
+class _Lease:
+    def __init__(self, remaining: int, lease_date, expires_at: float):
+        self.remaining = remaining
+        self.lease_date = lease_date
+        self.expires_at = expires_at
+
+
+class CreditLeaseManager:
+    """
+    In-process credit leases, one per org.
+
+    - available(org_id): credits this process can spend (leases a block when empty).
+    - spend(org_id): in-memory decrement; leases a new block only when the current one is used up.
+    - Leases expire after CREDIT_LEASE_SECONDS or at the DB's midnight, whichever is first;
+      the unused remainder is released by the org's next call or by release_expired(), which
+      the worker loops call every cycle (so quiet orgs get theirs back too).
+    - release_all() runs at exit and from the worker's SIGTERM handler.
+    A killed (SIGKILL) worker loses at most one unreleased block per org until the next daily reset.
+    """
+
+    def __init__(self, engine: Engine, block_size: int = CREDIT_LEASE_SIZE, ttl: int = CREDIT_LEASE_SECONDS):
+        self.engine = engine
+        self.block_size = max(1, int(block_size))
+        self.ttl = ttl
+        self._leases: Dict[int, _Lease] = {}
+        self._lock = threading.Lock()
+        self.leases_taken = 0
+
+    def _expire_locked(self, org_id: int) -> Optional[_Lease]:
+        lease = self._leases.get(org_id)
+        if lease and time.monotonic() >= lease.expires_at:
+            release_credits(self.engine, org_id, lease.remaining, lease.lease_date)
+            del self._leases[org_id]
+            lease = None
+        return lease
+
+    def _lease_locked(self, org_id: int) -> Optional[_Lease]:
+        lease = self._expire_locked(org_id)
+        if lease and lease.remaining > 0:
+            return lease
+
+        granted, lease_date, to_midnight = lease_credits(self.engine, org_id, self.block_size)
+        if granted <= 0:
+            return None
+        self.leases_taken += 1
+        lease = _Lease(granted, lease_date, time.monotonic() + min(self.ttl, max(to_midnight, 0.0)))
+        self._leases[org_id] = lease
+        return lease
+
+    def available(self, org_id: int) -> int:
+        org_id = int(org_id)
+        with self._lock:
+            lease = self._lease_locked(org_id)
+            return lease.remaining if lease else 0
+
+    def spend(self, org_id: int, qty: int = 1) -> bool:
+        """Spend `qty` credits (qty <= block size). Returns False if the org has no credits left."""
+        org_id = int(org_id)
+        qty = int(qty or 0)
+        if qty <= 0:
+            return True
+
+        with self._lock:
+            lease = self._lease_locked(org_id)
+            if lease and lease.remaining < qty:
+                # Not enough in this block: give it back and lease a fresh one.
+                release_credits(self.engine, org_id, lease.remaining, lease.lease_date)
+                del self._leases[org_id]
+                lease = self._lease_locked(org_id)
+            if not lease or lease.remaining < qty:
+                return False
+            lease.remaining -= qty
+            return True
+
+    def release(self, org_id: int) -> None:
+        org_id = int(org_id)
+        with self._lock:
+            lease = self._leases.pop(org_id, None)
+            if lease:
+                release_credits(self.engine, org_id, lease.remaining, lease.lease_date)
+
+    def release_expired(self) -> int:
+        """Release every expired lease (periodic sweep). Returns how many were released."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [(org_id, lease) for org_id, lease in self._leases.items() if now >= lease.expires_at]
+            for org_id, _ in expired:
+                del self._leases[org_id]
+        for org_id, lease in expired:
+            release_credits(self.engine, org_id, lease.remaining, lease.lease_date)
+        return len(expired)
+
+    def release_all(self) -> None:
+        with self._lock:
+            leases = list(self._leases.items())
+            self._leases.clear()
+        for org_id, lease in leases:
+            release_credits(self.engine, org_id, lease.remaining, lease.lease_date)
+
+
+_lease_manager: Optional[CreditLeaseManager] = None
+_lease_manager_lock = threading.Lock()
+
+
+def get_credit_lease_manager(engine: Engine) -> CreditLeaseManager:
+    """Process-wide lease manager (unused credits are released at interpreter exit)."""
+    global _lease_manager
+    if _lease_manager is None:
+        with _lease_manager_lock:
+            if _lease_manager is None:
+                _lease_manager = CreditLeaseManager(engine)
+                atexit.register(_lease_manager.release_all)
+    return _lease_manager
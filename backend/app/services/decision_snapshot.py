@@ -0,0 +1,84 @@
+from typing import Any, Dict
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+# Same values the individual worker helpers return when their query fails
+SNAPSHOT_ON_ERROR = {
+    "already_replied": False,
+    "thread_recent": False,
+    "sender_recent": False,
+}
+
+_SNAPSHOT_SQL = """
+SELECT
+    (:mid <> '' AND EXISTS (
+        SELECT 1
+        FROM conversation_audit
+        WHERE org_id = :oid
+          AND email_message_id = :mid
+          AND direction = 'OUT'
+    )) AS already_replied,
+
+    COALESCE(t.last_out_at >= (NOW() AT TIME ZONE 'utc') - (:hrs * INTERVAL '1 hour'), false) AS thread_recent,
+
+    (:email <> '' AND EXISTS (
+        SELECT 1
+        FROM conversation_audit
+        WHERE org_id = :oid
+          AND lower(customer_email) = :email
+          AND direction = 'OUT'
+          AND created_at >= (NOW() AT TIME ZONE 'utc') - (:hrs * INTERVAL '1 hour')
+    )) AS sender_recent
+FROM (SELECT 1) AS one
+-- thread state: one primary-key read (conversation_threads is kept current by log_conversation)
+LEFT JOIN conversation_threads t
+       ON t.org_id = :oid
+      AND t.thread_key = :tkey
+      AND :tkey <> ''
+"""
+
+
+def get_decision_snapshot(
+    engine: Engine,
+    org_id: int,
+    message_id: str,
+    thread_key: str,
+    sender_email: str,
+    cooldown_hours: int,
+) -> Dict[str, Any]:
+    """
+    The pre-send gating facts gate_message needs for one email, in ONE round trip.
+
+    Same semantics as the worker helpers it replaces:
+      already_replied = already_replied(org_id, message_id)
+      thread_recent   = replied_to_thread_recently(org_id, thread_key, cooldown_hours)
+      sender_recent   = replied_to_sender_recently(org_id, sender_email, cooldown_hours)
+
+    Rate, credits and "new IN > OUT" are not in here: the worker reads them from their own
+    sources (Redis window, credit leases, thread_needs_reply under the thread lock).
+
+    message_id is the normalized id (lowercase, no <>), as stored by the worker.
+    On DB errors every field falls back to the helper's own error value.
+    """
+    params = {
+        "oid": int(org_id),
+        "mid": (message_id or "").strip(),
+        "tkey": thread_key or "",
+        "email": (sender_email or "").strip().lower(),
+        "hrs": int(cooldown_hours),
+    }
+
+    try:
+        with engine.connect() as conn:
+            row = conn.execute(text(_SNAPSHOT_SQL), params).mappings().first()
+    except SQLAlchemyError as e:
+        print(f"[DEBUG] decision snapshot failed: {e!r}")
+        return dict(SNAPSHOT_ON_ERROR)
+
+    return {
+        "already_replied": bool(row["already_replied"]),
+        "thread_recent": bool(row["thread_recent"]),
+        "sender_recent": bool(row["sender_recent"]),
+    }
@@ -0,0 +1,216 @@
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import text
+
+from app.services.signal_matcher import SignalMatcher
+
+# Compiled rules are reused for this long before a cheap version re-check
+FILTER_RULES_TTL_SECONDS = int(os.getenv("FILTER_RULES_TTL_SECONDS", "60"))
+
+RULE_ACTIONS = ("allow", "deny")
+# sender / subject / headers are known before the body is fetched; body rules need the full message
+RULE_FIELDS = ("sender", "subject", "headers", "body")
+MATCH_TYPES = ("contains", "domain", "regex")
+PATTERN_MAX_LEN = 500
+
+# md5 over the enabled rules: changes on any insert / update / delete / toggle
+# (a JSON array per rule, so NULLs and separators inside patterns cannot collide)
+_VERSION_SQL = """
+    SELECT md5(coalesce(string_agg(
+               json_build_array(id, action, field, match_type, pattern)::text, ',' ORDER BY id), ''))
+    FROM org_filter_rules
+    WHERE org_id = :org_id AND enabled
+"""
+
+
+def validate_rule(rule: dict) -> Optional[str]:
+    """Error message for an invalid rule, None when it is fine."""
+    if rule.get("action") not in RULE_ACTIONS:
+        return f"action must be one of {', '.join(RULE_ACTIONS)}"
+    if rule.get("field") not in RULE_FIELDS:
+        return f"field must be one of {', '.join(RULE_FIELDS)}"
+    match_type = rule.get("match_type") or "contains"
+    if match_type not in MATCH_TYPES:
+        return f"match_type must be one of {', '.join(MATCH_TYPES)}"
+    pattern = (rule.get("pattern") or "").strip()
+    if not pattern:
+        return "pattern is required"
+    if len(pattern) > PATTERN_MAX_LEN:
+        return f"pattern longer than {PATTERN_MAX_LEN} characters"
+    if match_type == "domain" and rule["field"] != "sender":
+        return "domain rules apply to the sender field"
+    if match_type == "regex":
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            return f"invalid regex: {e}"
+    return None
+
+
+def _sender_domain(sender: str) -> str:
+    m = re.search(r"@([A-Za-z0-9.\-]+)", sender or "")
+    return m.group(1).lower().rstrip(".") if m else ""
+
+
+class CompiledRules:
+    """
+    One org's enabled rules, compiled once: per field, all "contains" patterns in one
+    SignalMatcher, domains in a set, regexes pre-compiled.
+    Allow wins over deny (an allow rule is an exception to a broader deny rule).
+    """
+
+    def __init__(self, rules: list, version: Optional[str] = None):
+        self.version = version
+        self.rules = list(rules)
+        self._contains = {}  # field -> (SignalMatcher, {needle: [rule, ...]})
+        self._domains = {}  # domain -> [rule, ...]
+        self._regexes = []  # (field, compiled, rule)
+        by_field = {}
+        for r in self.rules:
+            if r["match_type"] == "contains":
+                by_field.setdefault(r["field"], {}).setdefault(r["pattern"].strip().lower(), []).append(r)
+            elif r["match_type"] == "domain":
+                self._domains.setdefault(r["pattern"].strip().lower().lstrip("@").rstrip("."), []).append(r)
+            elif r["match_type"] == "regex":
+                self._regexes.append((r["field"], re.compile(r["pattern"], re.IGNORECASE), r))
+        for field, needles in by_field.items():
+            self._contains[field] = (SignalMatcher(needles), needles)
+        self.has_allow = any(r["action"] == "allow" for r in self.rules)
+        self.has_body_allow = any(r["field"] == "body" and r["action"] == "allow" for r in self.rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def matches(self, fields: dict) -> list:
+        """All rules matching the given fields ({field: text}; missing fields are not checked)."""
+        out = []
+        for field, (matcher, needles) in self._contains.items():
+            value = fields.get(field)
+            if value:
+                for needle in matcher.hits(value.lower()):
+                    out.extend(needles[needle])
+        if self._domains and fields.get("sender"):
+            domain = _sender_domain(fields["sender"])
+            while domain:
+                out.extend(self._domains.get(domain, ()))
+                domain = domain.split(".", 1)[1] if "." in domain else ""
+        for field, rx, r in self._regexes:
+            value = fields.get(field)
+            if value and rx.search(value):
+                out.append(r)
+        return out
+
+    def evaluate(self, fields: dict) -> tuple:
+        """("allow" | "deny" | None, the deciding rule or None)."""
+        if not self.rules:
+            return None, None
+        hits = self.matches(fields)
+        for action in ("allow", "deny"):
+            rule = min((r for r in hits if r["action"] == action), key=lambda r: r["id"], default=None)
+            if rule is not None:
+                return action, rule
+        return None, None
+
+    def evaluate_headers(self, sender: str, subject: str, headers: str) -> tuple:
+        """
+        Before the body fetch. A deny is only final when no body rule could still allow
+        the message; otherwise (None, None) and gate_message decides on the full message.
+        """
+        action, rule = self.evaluate({"sender": sender, "subject": subject, "headers": headers})
+        if action == "deny" and self.has_body_allow:
+            return None, None
+        return action, rule
+
+
+def load_rules(engine, org_id: int) -> CompiledRules:
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT id, action, field, match_type, pattern
+                FROM org_filter_rules
+                WHERE org_id = :org_id AND enabled
+                ORDER BY id
+            """),
+            {"org_id": int(org_id)},
+        ).mappings().all()
+        version = conn.execute(text(_VERSION_SQL), {"org_id": int(org_id)}).scalar()
+    rules = []
+    for r in rows:
+        r = dict(r)
+        error = validate_rule(r)
+        if error:
+            print(f"[DEBUG] org={org_id} ignoring invalid filter rule id={r['id']}: {error}")
+            continue
+        rules.append(r)
+    return CompiledRules(rules, version)
+
+
+def filter_rules_version(engine, org_id: int) -> str:
+    with engine.connect() as conn:
+        return conn.execute(text(_VERSION_SQL), {"org_id": int(org_id)}).scalar()
+
+
+class FilterRulesCache:
+    """
+    Compiled rules per org, same policy as OrgSettingsCache: served from memory for ttl
+    seconds, then a version query decides whether to recompile.
+    """
+
+    def __init__(self, engine, ttl: int = FILTER_RULES_TTL_SECONDS):
+        self.engine = engine
+        self.ttl = ttl
+        self._entries = {}  # org_id -> (CompiledRules, checked_at)
+        self._lock = threading.Lock()
+        self.compiles = 0
+
+    def get(self, org_id: int) -> CompiledRules:
+        org_id = int(org_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(org_id)
+
+        if entry:
+            compiled, checked_at = entry
+            if now - checked_at < self.ttl:
+                return compiled
+            if filter_rules_version(self.engine, org_id) == compiled.version:
+                with self._lock:
+                    self._entries[org_id] = (compiled, now)
+                return compiled
+
+        compiled = load_rules(self.engine, org_id)
+        self.compiles += 1
+        with self._lock:
+            self._entries[org_id] = (compiled, now)
+        return compiled
+
+    def invalidate(self, org_id: int = None):
+        with self._lock:
+            if org_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(org_id), None)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_filter_rules_cache() -> FilterRulesCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from app.db import engine
+                _cache = FilterRulesCache(engine)
+    return _cache
+
+
+def invalidate_filter_rules(org_id: int = None):
+    """Hook for code that edits org_filter_rules (no-op if nothing was cached in this process)."""
+    if _cache is not None:
+        _cache.invalidate(org_id)
@@ -0,0 +1,326 @@
+import base64
+import binascii
+import codecs
+import logging
+import os
+import quopri
+import re
+from email import message_from_bytes
+from email.policy import default
+from html.parser import HTMLParser
+from typing import Optional
+
+logger = logging.getLogger("ai_mail_worker")
+
+# Bytes of the selected text part fetched per email (the prompt only keeps a few KB of it anyway).
+# Attachments are never downloaded: only the text/plain (else text/html) section is fetched.
+IMAP_BODY_MAX_BYTES = int(os.getenv("IMAP_BODY_MAX_BYTES", "262144"))
+# When BODYSTRUCTURE cannot be used, the whole message is fetched only up to this RFC822.SIZE
+IMAP_FULL_FETCH_MAX_BYTES = int(os.getenv("IMAP_FULL_FETCH_MAX_BYTES", "1048576"))
+
+_SIZE_RE = re.compile(rb"RFC822\.SIZE\s+(\d+)", re.IGNORECASE)
+_ATOM_END = (b" ", b"(", b")", b'"', b"{", b"\r", b"\n")
+
+
+# ---------- BODYSTRUCTURE ----------
+def _response_bytes(data: list) -> bytes:
+    """Re-join an imaplib FETCH response: tuples are (line ending in {n}, literal)."""
+    out = b""
+    for item in data or []:
+        if isinstance(item, tuple):
+            out += (item[0] or b"") + b"\r\n" + (item[1] or b"")
+        elif isinstance(item, bytes):
+            out += item
+    return out
+
+
+def _parse_sexp(raw: bytes):
+    """IMAP parenthesized list -> nested lists of str (NIL -> None). Raises ValueError."""
+    stack, cur, i, n = [], [], 0, len(raw)
+    while i < n:
+        c = raw[i:i + 1]
+        if c in (b" ", b"\r", b"\n"):
+            i += 1
+        elif c == b"(":
+            stack.append(cur)
+            cur = []
+            i += 1
+        elif c == b")":
+            if not stack:
+                raise ValueError("unbalanced )")
+            done, cur = cur, stack.pop()
+            cur.append(done)
+            i += 1
+        elif c == b'"':
+            j, buf = i + 1, bytearray()
+            while j < n and raw[j:j + 1] != b'"':
+                if raw[j:j + 1] == b"\\":
+                    j += 1
+                buf += raw[j:j + 1]
+                j += 1
+            if j >= n:
+                raise ValueError("unterminated string")
+            cur.append(buf.decode("utf-8", "replace"))
+            i = j + 1
+        elif c == b"{":
+            end = raw.index(b"}", i)
+            size = int(raw[i + 1:end])
+            start = end + 1
+            while raw[start:start + 1] in (b"\r", b"\n"):
+                start += 1
+            cur.append(raw[start:start + size].decode("utf-8", "replace"))
+            i = start + size
+        else:
+            j = i
+            while j < n and raw[j:j + 1] not in _ATOM_END:
+                j += 1
+            atom = raw[i:j].decode("ascii", "replace")
+            cur.append(None if atom.upper() == "NIL" else atom)
+            i = j
+    if stack:
+        raise ValueError("unbalanced (")
+    return cur
+
+
+def parse_fetch_structure(data: list) -> tuple[Optional[int], Optional[list]]:
+    """(RFC822.SIZE, BODYSTRUCTURE list) from a UID FETCH (RFC822.SIZE BODYSTRUCTURE) response."""
+    raw = _response_bytes(data)
+    m = _SIZE_RE.search(raw)
+    size = int(m.group(1)) if m else None
+    try:
+        tokens = _parse_sexp(raw)
+    except (ValueError, IndexError):
+        return size, None
+    for item in tokens:
+        if isinstance(item, list):
+            for key, value in zip(item[::2], item[1::2]):
+                if isinstance(key, str) and key.upper() == "BODYSTRUCTURE" and isinstance(value, list):
+                    return size, value
+    return size, None
+
+
+def _params(value) -> dict:
+    if not isinstance(value, list):
+        return {}
+    return {
+        str(k).lower(): v for k, v in zip(value[::2], value[1::2]) if isinstance(k, str) and isinstance(v, str)
+    }
+
+
+def _leaf_parts(node: list, prefix: str = ""):
+    """Yield (section, info) for every non-multipart part, in document order (not inside message/rfc822)."""
+    if node and isinstance(node[0], list):
+        # multipart: body parts first, then the subtype and extension data
+        children = []
+        for child in node:
+            if not isinstance(child, list):
+                break
+            children.append(child)
+        subtype = node[len(children)] if len(node) > len(children) else None
+        if str(subtype or "").lower() == "related":
+            children = children[:1]  # only the root of multipart/related is the body
+        for i, child in enumerate(children, 1):
+            yield from _leaf_parts(child, f"{prefix}.{i}" if prefix else str(i))
+        return
+
+    if len(node) < 7:
+        return
+    ctype = f"{node[0] or ''}/{node[1] or ''}".lower()
+    # text parts carry a line count before the extension data (md5, disposition, ...)
+    disp_at = 9 if ctype.startswith("text/") else 8
+    disp = node[disp_at] if len(node) > disp_at else None
+    disposition = (disp[0] or "").lower() if isinstance(disp, list) and disp else ""
+    try:
+        size = int(node[6])
+    except (TypeError, ValueError):
+        size = 0
+    yield (prefix or "1"), {
+        "type": ctype,
+        "charset": _params(node[2]).get("charset") or "",
+        "encoding": (node[5] or "7bit").lower(),
+        "size": size,
+        "attachment": disposition == "attachment",
+    }
+
+
+def select_text_part(structure: list) -> tuple[Optional[str], Optional[dict]]:
+    """First inline text/plain part, else the first inline text/html one: (section, info) or (None, None)."""
+    parts = [p for p in _leaf_parts(structure) if not p[1]["attachment"]]
+    for ctype in ("text/plain", "text/html"):
+        for section, info in parts:
+            if info["type"] == ctype:
+                return section, info
+    return None, None
+
+
+# ---------- decoding ----------
+def decode_part(raw: bytes, encoding: str, charset: str, truncated: bool = False) -> str:
+    """Content-Transfer-Encoding + charset decode of one (possibly byte-capped) section."""
+    encoding = (encoding or "").lower()
+    try:
+        if encoding == "base64":
+            b64 = re.sub(rb"[^A-Za-z0-9+/=]", b"", raw)
+            if truncated:
+                b64 = b64[: len(b64) - len(b64) % 4]  # whole 4-char groups only
+            else:
+                b64 += b"=" * (-len(b64) % 4)
+            data = base64.b64decode(b64)
+        elif encoding == "quoted-printable":
+            if truncated:
+                # do not decode a soft break / escape cut in half
+                raw = re.sub(rb"=[0-9A-Fa-f]?$", b"", raw)
+            data = quopri.decodestring(raw)
+        else:
+            data = raw
+    except (binascii.Error, ValueError):
+        data = raw
+
+    try:
+        codec = codecs.lookup(charset or "utf-8").name
+    except LookupError:
+        codec = "utf-8"
+    text = data.decode(codec, errors="replace")
+    if truncated:
+        text = text.rstrip("\ufffd")
+    return text.replace("\r\n", "\n")
+
+
+class _HtmlText(HTMLParser):
+    _SKIP = {"script", "style", "head", "title"}
+    _BLOCK = {"br", "p", "div", "tr", "li", "ul", "ol", "table", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "hr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skip += 1
+        elif tag in self._BLOCK:
+            self.out.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in self._BLOCK:
+            self.out.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.out.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """Readable text of an HTML body (tags dropped, blocks on their own lines)."""
+    p = _HtmlText()
+    try:
+        p.feed(html or "")
+        p.close()
+    except Exception:
+        pass
+    lines = [" ".join(line.split()) for line in "".join(p.out).splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def message_body_text(msg) -> str:
+    """
+    Body of a fully fetched message: prefer plain text, else HTML converted to text. Avoid attachments.
+    """
+    try:
+        body_part = msg.get_body(preferencelist=("plain", "html"))
+        if body_part:
+            content = body_part.get_content() or ""
+            if body_part.get_content_type() == "text/html":
+                return html_to_text(content)
+            return content
+    except Exception:
+        pass
+
+    try:
+        if msg.is_multipart():
+            for part in msg.walk():
+                ctype = part.get_content_type()
+                disp = str(part.get("Content-Disposition") or "").lower()
+                if "attachment" in disp:
+                    continue
+                if ctype == "text/plain":
+                    return part.get_content() or ""
+        elif msg.get_content_maintype() == "text":
+            return msg.get_content() or ""
+    except Exception:
+        pass
+
+    return ""
+
+
+# ---------- fetch ----------
+def _literal(data: list) -> Optional[bytes]:
+    for item in data or []:
+        if isinstance(item, tuple) and len(item) >= 2:
+            return item[1] or b""
+    return None
+
+
+def _literals(data: list) -> list:
+    """All literals of a FETCH response, in the order the server sent them."""
+    return [item[1] or b"" for item in data or [] if isinstance(item, tuple) and len(item) >= 2]
+
+
+def fetch_body_text(imap, uid, max_bytes: int = IMAP_BODY_MAX_BYTES) -> tuple[Optional[str], dict]:
+    """
+    Body text of one email without downloading its attachments:
+      1. UID FETCH (RFC822.SIZE BODYSTRUCTURE)    - a few hundred bytes
+      2. UID FETCH (BODY.PEEK[<section>]<0.max>)  - only the text/plain (else text/html) part, byte-capped
+    Falls back to the whole message (BODY.PEEK[]) when the structure cannot be used and the
+    message is not larger than IMAP_FULL_FETCH_MAX_BYTES; for larger ones, to the header plus
+    the first max_bytes of the body (BODY.PEEK[TEXT]<0.max>), parsed as a truncated message.
+
+    Returns (text, info); text is None when the message could not be fetched (retry next cycle).
+    info = {"size", "section", "type", "fetched", "truncated", "mode"} for logging.
+    """
+    info = {"size": None, "section": None, "type": None, "fetched": 0, "truncated": False, "mode": "part"}
+
+    st, data = imap.uid("FETCH", uid, "(RFC822.SIZE BODYSTRUCTURE)")
+    if st != "OK" or not data or data[0] is None:
+        return None, info
+    size, structure = parse_fetch_structure(data)
+    info["size"] = size
+
+    section, part = select_text_part(structure) if structure else (None, None)
+    if section:
+        info["section"], info["type"] = section, part["type"]
+        st, data = imap.uid("FETCH", uid, f"(BODY.PEEK[{section}]<0.{int(max_bytes)}>)")
+        raw = _literal(data) if st == "OK" else None
+        if raw is None:
+            return None, info
+        info["fetched"] = len(raw)
+        info["truncated"] = part["size"] > len(raw) and len(raw) >= max_bytes
+        text = decode_part(raw, part["encoding"], part["charset"], truncated=info["truncated"])
+        if part["type"] == "text/html":
+            text = html_to_text(text)
+        return text, info
+
+    if structure is not None:
+        # Parsed, but no inline text part (e.g. only attachments): nothing to read
+        info["mode"] = "none"
+        return "", info
+
+    info["mode"] = "full"
+    if size is not None and size > IMAP_FULL_FETCH_MAX_BYTES:
+        # No structure and too big to download whole: read the start of the body instead
+        info["mode"] = "capped"
+        st, data = imap.uid("FETCH", uid, f"(BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.{int(max_bytes)}>)")
+        literals = _literals(data) if st == "OK" else []
+        if len(literals) < 2:
+            return None, info
+        header, body = literals[0], literals[1]
+        info["fetched"] = len(header) + len(body)
+        info["truncated"] = len(body) >= max_bytes
+        return message_body_text(message_from_bytes(header + body, policy=default)), info
+    st, data = imap.uid("FETCH", uid, "(BODY.PEEK[])")
+    raw = _literal(data) if st == "OK" else None
+    if raw is None:
+        return None, info
+    info["fetched"] = len(raw)
+    return message_body_text(message_from_bytes(raw, policy=default)), info
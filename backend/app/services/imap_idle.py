@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from imapclient import IMAPClient
+
+logger = logging.getLogger("ai_mail_worker")
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes.
+IDLE_RENEW_SECONDS = 24 * 60
+IDLE_CHECK_SECONDS = 30
+
+
+class IdleWatcher(threading.Thread):
+    """
+    Keeps one long-lived IMAP IDLE session for a mailbox and calls on_mail(account_id)
+    whenever the server reports new mail (EXISTS / RECENT).
+
+    If the server does not advertise IDLE, the watcher stops with supported=False and the
+    account stays on normal polling.
+    """
+
+    def __init__(
+        self,
+        account_id: int,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        on_mail: Callable[[int], None],
+        folder: str = "INBOX",
+    ):
+        super().__init__(name=f"idle-{account_id}", daemon=True)
+        self.account_id = account_id
+        self.host = host
+        self.port = int(port or 993)
+        self.username = username
+        self.password = password
+        self.on_mail = on_mail
+        self.folder = folder
+
+        self.supported: Optional[bool] = None  # None = not probed yet
+        self.connected = False
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def healthy(self) -> bool:
+        """True while an IDLE session is up (so the account can skip frequent polling)."""
+        return self.is_alive() and bool(self.supported) and self.connected
+
+    def run(self):
+        backoff = 5
+        while not self._stop_event.is_set():
+            try:
+                self._session()
+                backoff = 5
+            except Exception as e:
+                self.connected = False
+                logger.info(f"event=idle_error account={self.account_id} error={e!r}")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 300)
+            if self.supported is False:
+                return
+
+    def _session(self):
+        client = IMAPClient(self.host, port=self.port, ssl=True, timeout=IDLE_CHECK_SECONDS + 30)
+        try:
+            client.login(self.username, self.password)
+            if not client.has_capability("IDLE"):
+                self.supported = False
+                logger.info(f"event=idle_unsupported account={self.account_id} host={self.host}")
+                return
+            self.supported = True
+
+            client.select_folder(self.folder, readonly=True)
+            self.connected = True
+            logger.info(f"event=idle_connected account={self.account_id} host={self.host}")
+
+            while not self._stop_event.is_set():
+                client.idle()
+                renew_at = time.monotonic() + IDLE_RENEW_SECONDS
+                got_mail = False
+                try:
+                    while not self._stop_event.is_set() and time.monotonic() < renew_at:
+                        responses = client.idle_check(timeout=IDLE_CHECK_SECONDS)
+                        if any(len(r) >= 2 and r[1] in (b"EXISTS", b"RECENT") for r in responses):
+                            got_mail = True
+                            break
+                finally:
+                    client.idle_done()
+
+                if got_mail:
+                    self.on_mail(self.account_id)
+        finally:
+            self.connected = False
+            try:
+                client.logout()
+            except Exception:
+                pass
+
+
+class IdleSupervisor:
+    """
+    Owns the IdleWatcher threads and a wake queue of account ids with new mail.
+    sync() starts/stops watchers so they follow the current account list.
+    """
+
+    def __init__(self):
+        self.watchers: Dict[int, IdleWatcher] = {}
+        self.wake: "queue.Queue[int]" = queue.Queue()
+
+    def _notify(self, account_id: int):
+        self.wake.put(account_id)
+
+    def sync(self, accounts: list):
+        wanted = {int(a.id): a for a in accounts}
+
+        for acc_id in list(self.watchers.keys()):
+            w = self.watchers[acc_id]
+            if acc_id not in wanted or (not w.is_alive() and w.supported is not False):
+                w.stop()
+                del self.watchers[acc_id]
+
+        for acc_id, a in wanted.items():
+            if acc_id in self.watchers:
+                continue
+            w = IdleWatcher(
+                account_id=acc_id,
+                host=a.imap_host,
+                port=a.imap_port,
+                username=a.imap_username,
+                password=a.imap_password,
+                on_mail=self._notify,
+            )
+            self.watchers[acc_id] = w
+            w.start()
+
+    def is_push_healthy(self, account_id: int) -> bool:
+        w = self.watchers.get(int(account_id))
+        return bool(w and w.healthy)
+
+    def wait_for_mail(self, timeout: float, debounce: float = 2.0) -> set:
+        """
+        Block up to `timeout` seconds for new-mail notifications.
+        Returns the set of account ids that were woken (empty on timeout).
+        """
+        woken = set()
+        try:
+            woken.add(self.wake.get(timeout=timeout))
+        except queue.Empty:
+            return woken
+
+        # Collect a short burst so several new emails cause one cycle.
+        deadline = time.monotonic() + debounce
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                woken.add(self.wake.get(timeout=left))
+            except queue.Empty:
+                break
+        return woken
+
+    def stop_all(self):
+        for w in self.watchers.values():
+            w.stop()
+        self.watchers.clear()
@@ -0,0 +1,121 @@
+import imaplib
+import logging
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger("ai_mail_worker")
+
+# NOOP before reuse when the connection sat idle longer than this (e.g. during an LLM call)
+NOOP_AFTER_SECONDS = 30
+
+
+class ImapSession:
+    """
+    One authenticated IMAP connection per account for a whole account turn.
+
+    - .imap returns a live, SELECTed connection (NOOP after idle, reconnect if it died).
+    - Flag updates are queued with queue_seen() and written by flush_flags() as ONE
+      UID STORE over the UID set. UIDs stay valid across reconnects, so a reconnect
+      in the middle of a turn is transparent.
+    - before_select(imap) runs after every login, before SELECT (e.g. ENABLE CONDSTORE).
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        folder: str = "INBOX",
+        before_select: Optional[Callable] = None,
+    ):
+        self.host = host
+        self.port = int(port or 993)
+        self.username = username
+        self.password = password
+        self.folder = folder
+        self.before_select = before_select
+
+        self._imap = None
+        self._last_used = 0.0
+        self._pending_seen = []
+        self.logins = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Flags queued so far belong to emails that were fully handled: write them even on errors.
+        self.close()
+        return False
+
+    # ---------- connection ----------
+    def connect(self):
+        self._drop()
+        imap = imaplib.IMAP4_SSL(self.host, self.port)
+        imap.login(self.username, self.password)
+        if self.before_select:
+            self.before_select(imap)
+        imap.select(self.folder)
+        self._imap = imap
+        self._last_used = time.monotonic()
+        self.logins += 1
+        return imap
+
+    def _drop(self):
+        if self._imap is not None:
+            try:
+                self._imap.logout()
+            except Exception:
+                pass
+        self._imap = None
+
+    @property
+    def imap(self):
+        """Live connection; NOOP-checked after NOOP_AFTER_SECONDS idle, reconnected if dead."""
+        if self._imap is None:
+            return self.connect()
+
+        if time.monotonic() - self._last_used > NOOP_AFTER_SECONDS:
+            try:
+                self._imap.noop()
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.info(f"event=imap_reconnect host={self.host} user={self.username} reason={e!r}")
+                return self.connect()
+
+        self._last_used = time.monotonic()
+        return self._imap
+
+    # ---------- flags ----------
+    def queue_seen(self, uid):
+        if uid is None:
+            return
+        uid = uid.decode() if isinstance(uid, bytes) else str(uid)
+        if uid not in self._pending_seen:
+            self._pending_seen.append(uid)
+
+    def flush_flags(self):
+        """Apply all queued \\Seen flags in one UID STORE (retried once on a fresh connection)."""
+        if not self._pending_seen:
+            return
+        uid_set = ",".join(self._pending_seen)
+        for attempt in range(2):
+            try:
+                self.imap.uid("STORE", uid_set, "+FLAGS", "\\Seen")
+                self._pending_seen = []
+                return
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.info(f"event=imap_flag_store_failed host={self.host} attempt={attempt + 1} error={e!r}")
+                if attempt == 0:
+                    try:
+                        self.connect()
+                    except Exception:
+                        return
+
+    def close(self, flush: bool = True):
+        if flush:
+            try:
+                self.flush_flags()
+            except Exception:
+                pass
+        self._drop()
@@ -0,0 +1,268 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+# Pipeline stages (ingest is the IMAP side that enqueues into "generate")
+STAGE_GENERATE = "generate"
+STAGE_DELIVER = "deliver"
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Retry backoff: JOB_RETRY_BASE_SECONDS * 2^(attempt-1), capped
+JOB_RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+JOB_RETRY_MAX_SECONDS = int(os.getenv("JOB_RETRY_MAX_SECONDS", "3600"))
+
+
+def enqueue_job(
+    engine: Engine,
+    org_id: int,
+    account_id: int,
+    dedupe_key: str,
+    thread_key: Optional[str],
+    payload: Dict[str, Any],
+    stage: str = STAGE_GENERATE,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+) -> bool:
+    """
+    Insert a job (idempotent on (org_id, dedupe_key)).
+    Returns True when the email is durably queued (new or already known), False on DB errors.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO worker_jobs (org_id, account_id, dedupe_key, thread_key, stage, status,
+                                             attempts, max_attempts, run_after, payload, created_at, updated_at)
+                    VALUES (:oid, :aid, :dkey, :tkey, :stage, 'queued',
+                            0, :max_attempts, NOW(), CAST(:payload AS JSONB), NOW(), NOW())
+                    ON CONFLICT (org_id, dedupe_key) DO NOTHING
+                    """
+                ),
+                {
+                    "oid": int(org_id),
+                    "aid": int(account_id),
+                    "dkey": dedupe_key,
+                    "tkey": thread_key,
+                    "stage": stage,
+                    "max_attempts": int(max_attempts),
+                    "payload": json.dumps(payload, ensure_ascii=False),
+                },
+            )
+        return True
+    except SQLAlchemyError as e:
+        print(f"[DEBUG] enqueue_job failed: {e!r}")
+        return False
+
+
+def claim_jobs(
+    engine: Engine,
+    stage: str,
+    worker_id: str,
+    limit: int = 1,
+    visibility_seconds: int = 300,
+) -> List[Dict[str, Any]]:
+    """
+    Claim up to `limit` runnable jobs of a stage (FOR UPDATE SKIP LOCKED, safe across nodes).
+    A claimed job stays invisible for `visibility_seconds`; if the worker dies it is picked up again.
+    """
+    try:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    """
+                    WITH next AS (
+                        SELECT id
+                        FROM worker_jobs
+                        WHERE stage = :stage
+                          AND (
+                                (status = 'queued' AND run_after <= NOW())
+                             OR (status = 'running' AND locked_until < NOW())
+                          )
+                        ORDER BY run_after, id
+                        LIMIT :lim
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE worker_jobs j
+                    SET status = 'running',
+                        locked_by = :wid,
+                        locked_until = NOW() + (:vis * INTERVAL '1 second'),
+                        attempts = j.attempts + 1,
+                        updated_at = NOW()
+                    FROM next
+                    WHERE j.id = next.id
+                    RETURNING j.id, j.org_id, j.account_id, j.thread_key, j.stage,
+                              j.attempts, j.max_attempts, j.payload
+                    """
+                ),
+                {"stage": stage, "wid": worker_id, "lim": int(limit), "vis": int(visibility_seconds)},
+            ).mappings().all()
+        return [dict(r) for r in rows]
+    except SQLAlchemyError as e:
+        print(f"[DEBUG] claim_jobs failed: {e!r}")
+        return []
+
+
+def _update_claimed(engine: Engine, job_id: int, worker_id: str, set_sql: str, params: Dict[str, Any]) -> bool:
+    """Apply an update only while this worker still holds the claim (stale workers cannot clobber)."""
+    try:
+        with engine.begin() as conn:
+            res = conn.execute(
+                text(
+                    f"""
+                    UPDATE worker_jobs
+                    SET {set_sql},
+                        locked_by = NULL,
+                        locked_until = NULL,
+                        updated_at = NOW()
+                    WHERE id = :id
+                      AND status = 'running'
+                      AND locked_by = :wid
+                    """
+                ),
+                {"id": int(job_id), "wid": worker_id, **params},
+            )
+            return (res.rowcount or 0) == 1
+    except SQLAlchemyError as e:
+        print(f"[DEBUG] worker_jobs update failed job={job_id}: {e!r}")
+        return False
+
+
+def advance_job(engine: Engine, job_id: int, worker_id: str, next_stage: str, payload: Dict[str, Any]) -> bool:
+    """Hand a job to the next stage (fresh attempt budget)."""
+    return _update_claimed(
+        engine,
+        job_id,
+        worker_id,
+        "stage = :stage, status = 'queued', attempts = 0, run_after = NOW(), "
+        "payload = CAST(:payload AS JSONB), last_error = NULL",
+        {"stage": next_stage, "payload": json.dumps(payload, ensure_ascii=False)},
+    )
+
+
+def mark_in_logged(db, job_id: int) -> None:
+    """
+    Set payload.in_logged on a job. Run it on the session that writes the IN audit row, before
+    its commit, so the flag and the row are stored together (retries and defers never log IN twice).
+    """
+    db.execute(
+        text(
+            """
+            UPDATE worker_jobs
+            SET payload = payload || CAST('{"in_logged": true}' AS JSONB),
+                updated_at = NOW()
+            WHERE id = :id
+            """
+        ),
+        {"id": int(job_id)},
+    )
+
+
+def finish_job(engine: Engine, job_id: int, worker_id: str, status: str = "done", error: Optional[str] = None) -> bool:
+    """Terminal states: done | skipped | dead."""
+    return _update_claimed(
+        engine,
+        job_id,
+        worker_id,
+        "status = :status, last_error = COALESCE(:err, last_error)",
+        {"status": status, "err": (error or None) and error[:2000]},
+    )
+
+
+def retry_job(engine: Engine, job_id: int, worker_id: str, error: str) -> str:
+    """
+    Failed attempt: requeue with exponential backoff, or mark dead once max_attempts is reached.
+    Returns the new status ("queued" / "dead"), or "" if the claim was lost.
+    """
+    try:
+        with engine.begin() as conn:
+            row = conn.execute(
+                text(
+                    """
+                    UPDATE worker_jobs
+                    SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+                        run_after = NOW() + (LEAST(:base * POWER(2, GREATEST(attempts - 1, 0)), :cap) * INTERVAL '1 second'),
+                        last_error = :err,
+                        locked_by = NULL,
+                        locked_until = NULL,
+                        updated_at = NOW()
+                    WHERE id = :id
+                      AND status = 'running'
+                      AND locked_by = :wid
+                    RETURNING status
+                    """
+                ),
+                {
+                    "id": int(job_id),
+                    "wid": worker_id,
+                    "err": (error or "")[:2000],
+                    "base": JOB_RETRY_BASE_SECONDS,
+                    "cap": JOB_RETRY_MAX_SECONDS,
+                },
+            ).fetchone()
+        return row[0] if row else ""
+    except SQLAlchemyError as e:
+        print(f"[DEBUG] retry_job failed job={job_id}: {e!r}")
+        return ""
+
+
+def defer_job(engine: Engine, job_id: int, worker_id: str, delay_seconds: int, reason: str = "") -> bool:
+    """Put a job back without counting the attempt (rate limit, no credits, thread busy, toggle off)."""
+    return _update_claimed(
+        engine,
+        job_id,
+        worker_id,
+        "status = 'queued', attempts = GREATEST(attempts - 1, 0), "
+        "run_after = NOW() + (:delay * INTERVAL '1 second'), last_error = :reason",
+        {"delay": int(delay_seconds), "reason": reason or None},
+    )
+
+
+def count_open_jobs(engine: Engine, org_id: int) -> int:
+    """Jobs of an org that may still send a reply (used to keep ingest within the hourly budget)."""
+    try:
+        with engine.connect() as conn:
+            n = conn.execute(
+                text(
+                    """
+                    SELECT COUNT(*)
+                    FROM worker_jobs
+                    WHERE org_id = :oid
+                      AND status IN ('queued', 'running')
+                    """
+                ),
+                {"oid": int(org_id)},
+            ).scalar()
+        return int(n or 0)
+    except SQLAlchemyError:
+        return 0
+
+
+def thread_has_open_job(engine: Engine, org_id: int, thread_key: str, exclude_id: int) -> bool:
+    """True if another job of the same thread is already past generation (waiting for delivery)."""
+    if not thread_key:
+        return False
+    try:
+        with engine.connect() as conn:
+            row = conn.execute(
+                text(
+                    """
+                    SELECT 1
+                    FROM worker_jobs
+                    WHERE org_id = :oid
+                      AND thread_key = :tkey
+                      AND id <> :id
+                      AND stage = 'deliver'
+                      AND status IN ('queued', 'running')
+                    LIMIT 1
+                    """
+                ),
+                {"oid": int(org_id), "tkey": thread_key, "id": int(exclude_id or 0)},
+            ).fetchone()
+        return bool(row)
+    except SQLAlchemyError:
+        return False
+
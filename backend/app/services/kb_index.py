@@ -0,0 +1,130 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple
+
+# KBs up to this size are sent whole (retrieval only pays off for large KBs)
+KB_FULL_MAX_CHARS = int(os.getenv("KB_FULL_MAX_CHARS", "6000"))
+KB_CHUNK_CHARS = int(os.getenv("KB_CHUNK_CHARS", "800"))
+KB_TOP_K = int(os.getenv("KB_TOP_K", "5"))
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)?")
+_STOPWORDS = frozenset(
+    """
+    a an the and or but if of to in on at by for with from as is are was were be been being
+    it its this that these those i me my we our you your he she they them their there here
+    what which who whom when where why how can could would should will shall may might do does did
+    have has had not no yes so than then too very just also about into over under please hi hello
+    dear thanks thank regards sir madam kindly want need know like get
+    """.split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if len(t) > 1 and t not in _STOPWORDS]
+
+
+def chunk_kb(kb_text: str, max_chars: int = KB_CHUNK_CHARS) -> List[str]:
+    """Split on blank lines / lines, packing consecutive paragraphs up to max_chars per chunk."""
+    paras = [p.strip() for p in re.split(r"\n\s*\n", kb_text or "") if p.strip()]
+    pieces = []
+    for p in paras:
+        if len(p) <= max_chars:
+            pieces.append(p)
+            continue
+        # Long paragraph (scraped pages often have no blank lines): fall back to single lines
+        buf = ""
+        for line in p.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            while len(line) > max_chars:
+                cut = line.rfind(" ", 0, max_chars)
+                cut = cut if cut > max_chars // 2 else max_chars
+                if buf:
+                    pieces.append(buf)
+                    buf = ""
+                pieces.append(line[:cut].strip())
+                line = line[cut:].strip()
+            if buf and len(buf) + 1 + len(line) > max_chars:
+                pieces.append(buf)
+                buf = ""
+            buf = f"{buf}\n{line}" if buf else line
+        if buf:
+            pieces.append(buf)
+
+    chunks, cur = [], ""
+    for piece in pieces:
+        if cur and len(cur) + 2 + len(piece) > max_chars:
+            chunks.append(cur)
+            cur = ""
+        cur = f"{cur}\n\n{piece}" if cur else piece
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+class KbIndex:
+    """BM25 index over the chunks of one org's KB."""
+
+    def __init__(self, kb_text: str, content_hash: str):
+        self.content_hash = content_hash
+        self.chunks = chunk_kb(kb_text)
+        self._tf = [Counter(tokenize(c)) for c in self.chunks]
+        self._len = [sum(tf.values()) for tf in self._tf]
+        n = len(self.chunks)
+        self._avgdl = (sum(self._len) / n) if n else 0.0
+        df = Counter()
+        for tf in self._tf:
+            df.update(tf.keys())
+        self._idf = {t: math.log(1 + (n - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+
+    def search(self, query: str, k: int = KB_TOP_K) -> List[Tuple[int, float]]:
+        """Top-k (chunk index, score) with score > 0, best first."""
+        q = [t for t in set(tokenize(query)) if t in self._idf]
+        if not q or not self.chunks:
+            return []
+        scores = []
+        for i, tf in enumerate(self._tf):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._len[i] / (self._avgdl or 1.0))
+            s = 0.0
+            for t in q:
+                f = tf.get(t)
+                if f:
+                    s += self._idf[t] * f * (BM25_K1 + 1) / (f + norm)
+            if s > 0:
+                scores.append((i, s))
+        scores.sort(key=lambda x: x[1], reverse=True)
+        return scores[:k]
+
+
+_indexes: Dict[int, KbIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def kb_content_hash(kb_text: str) -> str:
+    return hashlib.sha1((kb_text or "").encode("utf-8")).hexdigest()
+
+
+def get_kb_index(org_id: int, kb_text: str) -> KbIndex:
+    """Per-org index, rebuilt only when the KB content hash changes."""
+    h = kb_content_hash(kb_text)
+    with _indexes_lock:
+        idx = _indexes.get(int(org_id))
+        if idx is not None and idx.content_hash == h:
+            return idx
+    idx = KbIndex(kb_text, h)
+    with _indexes_lock:
+        _indexes[int(org_id)] = idx
+    return idx
+
+
+def use_full_kb(kb_text: str) -> bool:
+    return len((kb_text or "").strip()) <= KB_FULL_MAX_CHARS
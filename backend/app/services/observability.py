@@ -71,6 +71,41 @@ def upsert_worker_status(
     db.commit()
 
 
+# conversation_threads.recent_messages keeps this many messages, each cut to this many chars
+THREAD_RECENT_MESSAGES = 12
+THREAD_RECENT_MAX_CHARS = 4000
+
+_THREAD_UPSERT_SQL = """
+    INSERT INTO conversation_threads AS t (
+        org_id, thread_key, first_at, last_in_at, last_out_at, last_message_at,
+        message_count, last_customer_email, last_subject, recent_messages
+    )
+    VALUES (
+        :oid, :tkey, now(),
+        CASE WHEN CAST(:dir AS text) = 'IN' THEN now() END,
+        CASE WHEN CAST(:dir AS text) = 'OUT' THEN now() END,
+        now(), 1, :email, :subject,
+        jsonb_build_array(jsonb_build_object('direction', CAST(:dir AS text), 'at', now(), 'text', CAST(:body AS text)))
+    )
+    ON CONFLICT (org_id, thread_key) DO UPDATE SET
+        last_in_at = GREATEST(t.last_in_at, EXCLUDED.last_in_at),
+        last_out_at = GREATEST(t.last_out_at, EXCLUDED.last_out_at),
+        last_message_at = GREATEST(t.last_message_at, EXCLUDED.last_message_at),
+        message_count = t.message_count + 1,
+        last_customer_email = COALESCE(EXCLUDED.last_customer_email, t.last_customer_email),
+        last_subject = COALESCE(EXCLUDED.last_subject, t.last_subject),
+        recent_messages = (
+            SELECT COALESCE(jsonb_agg(w.e ORDER BY w.n), '[]'::jsonb)
+            FROM (
+                SELECT e, n
+                FROM jsonb_array_elements(t.recent_messages || EXCLUDED.recent_messages) WITH ORDINALITY AS x(e, n)
+                ORDER BY n DESC
+                LIMIT :keep
+            ) w
+        )
+"""
+
+
 def log_conversation(
     db: Session,
     *,
@@ -87,7 +122,8 @@ def log_conversation(
     ai_model: Optional[str] = None,
     ai_tokens_in: Optional[int] = None,
     ai_tokens_out: Optional[int] = None,
-    
+    ai_latency_ms: Optional[int] = None,
+    ai_retries: Optional[int] = None,
 ) -> None:
     row = ConversationAudit(
         org_id=org_id,
@@ -101,8 +137,59 @@ def log_conversation(
         ai_model=ai_model,
         ai_tokens_in=ai_tokens_in,
         ai_tokens_out=ai_tokens_out,
+        ai_latency_ms=ai_latency_ms,
+        ai_retries=ai_retries,
         in_reply_to=in_reply_to,
         references_header=references_header,
 
     )
     db.add(row)
+    # Per-thread state, committed with the audit row
+    db.execute(
+        text(_THREAD_UPSERT_SQL),
+        {
+            "oid": org_id,
+            "tkey": thread_key,
+            "dir": direction,
+            "email": customer_email,
+            "subject": subject[:998] if subject else subject,
+            "body": (body_text or "").strip()[:THREAD_RECENT_MAX_CHARS],
+            "keep": THREAD_RECENT_MESSAGES,
+        },
+    )
+
+
+def llm_usage_by_day(db: Session, *, days: int = 7, org_id: Optional[int] = None) -> list[dict]:
+    """
+    Per org and UTC day over OUT rows: replies, prompt/completion tokens, LLM retries and
+    p50/p95 generation latency (rows without a latency, e.g. reply-cache hits, are not in the percentiles).
+    """
+    rows = db.execute(
+        text(
+            """
+            SELECT org_id,
+                   (created_at AT TIME ZONE 'utc')::date AS day,
+                   COUNT(*) AS replies,
+                   COALESCE(SUM(ai_tokens_in), 0) AS tokens_in,
+                   COALESCE(SUM(ai_tokens_out), 0) AS tokens_out,
+                   COALESCE(SUM(ai_retries), 0) AS retries,
+                   COUNT(ai_latency_ms) AS llm_calls,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY ai_latency_ms) AS p50_latency_ms,
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY ai_latency_ms) AS p95_latency_ms
+            FROM conversation_audit
+            WHERE direction = 'OUT'
+              AND created_at >= (now() - (:days || ' days')::interval)
+              AND (CAST(:org_id AS BIGINT) IS NULL OR org_id = :org_id)
+            GROUP BY org_id, day
+            ORDER BY day DESC, COALESCE(SUM(ai_tokens_in), 0) + COALESCE(SUM(ai_tokens_out), 0) DESC
+            """
+        ),
+        {"days": int(days), "org_id": org_id},
+    ).mappings().all()
+    out = []
+    for r in rows:
+        d = dict(r)
+        for k in ("p50_latency_ms", "p95_latency_ms"):
+            d[k] = int(round(d[k])) if d[k] is not None else None
+        out.append(d)
+    return out
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+# Cached org settings are reused for this long before a cheap fingerprint re-check
+ORG_SETTINGS_TTL_SECONDS = int(os.getenv("ORG_SETTINGS_TTL_SECONDS", "60"))
+
+_SETTINGS_COLUMNS = """
+    name, support_name, support_email, website, website_url, kb_text, system_prompt,
+    auto_reply, auto_reply_enabled, max_replies_per_hour, cooldown_hours, prompt_token_budget
+"""
+
+# md5 over every cached column: detects edits (incl. kb_text) without transferring the KB.
+# A JSON array, not concat_ws: NULL stays distinct from '' and values cannot shift between columns.
+_FINGERPRINT_SQL = """
+    md5(json_build_array(name, support_name, support_email, website, website_url,
+                         md5(kb_text), md5(system_prompt),
+                         auto_reply, auto_reply_enabled, max_replies_per_hour, cooldown_hours,
+                         prompt_token_budget)::text)
+"""
+
+
+def default_org_settings(org_id: int) -> dict:
+    return with_trusted_identity({
+        "org_id": int(org_id),
+        "settings_version": None,
+        "org_name": f"Org{org_id}",
+        "support_name": f"Tenant{org_id} Support",
+        "support_email": "",
+        "website": "",
+        "website_url": "",
+        "kb_text": "",
+        "system_prompt": "",
+        "auto_reply": 1,
+        "auto_reply_enabled": 1,
+        "max_replies_per_hour": 10,
+        "cooldown_hours": 24,
+        "prompt_token_budget": None,
+    })
+
+
+def with_trusted_identity(settings: dict) -> dict:
+    """
+    Precompute what is_trusted_sender() needs:
+    - trusted_emails: org support_email (if set)
+    - trusted_domain: support_email domain, else website domain
+    """
+    support_email = (settings.get("support_email") or "").strip().lower()
+    trusted_emails = set()
+    if support_email and "@" in support_email:
+        trusted_emails.add(support_email)
+
+    website = (settings.get("website") or settings.get("website_url") or "").strip().lower()
+    org_domain = ""
+    if "://" in website:
+        org_domain = website.split("://", 1)[1].split("/", 1)[0]
+    elif website:
+        org_domain = website.split("/", 1)[0]
+
+    if support_email and "@" in support_email:
+        org_domain = support_email.split("@", 1)[1]
+
+    settings["trusted_emails"] = frozenset(trusted_emails)
+    settings["trusted_domain"] = (org_domain or "").replace("www.", "").strip()
+    return settings
+
+
+def load_org_settings(engine, org_id: int):
+    """Read one org row. Returns (settings, fingerprint); (defaults, None) if the org is missing."""
+    with engine.connect() as conn:
+        row = conn.execute(
+            text(f"SELECT {_SETTINGS_COLUMNS}, {_FINGERPRINT_SQL} AS fp FROM organizations WHERE id = :org_id"),
+            {"org_id": org_id},
+        ).mappings().first()
+
+    if not row:
+        return default_org_settings(org_id), None
+
+    settings = {
+        "org_id": int(org_id),
+        # Changes whenever any cached column changes (e.g. prompt prefix cache key)
+        "settings_version": row["fp"],
+        "org_name": (row["name"] or f"Org{org_id}"),
+        "support_name": (row["support_name"] or f"Tenant{org_id} Support"),
+        "support_email": (row["support_email"] or ""),
+        "website": (row["website"] or ""),
+        "website_url": (row["website_url"] or ""),
+        "kb_text": (row["kb_text"] or ""),
+        "system_prompt": (row["system_prompt"] or ""),
+        "auto_reply": int(row["auto_reply"] or 1),
+        "auto_reply_enabled": 1 if bool(row["auto_reply_enabled"]) else 0,
+        "max_replies_per_hour": int(row["max_replies_per_hour"] or 10),
+        "cooldown_hours": int(row["cooldown_hours"] or 24),
+        "prompt_token_budget": row["prompt_token_budget"],
+    }
+    return with_trusted_identity(settings), row["fp"]
+
+
+def org_settings_fingerprint(engine, org_id: int):
+    with engine.connect() as conn:
+        return conn.execute(
+            text(f"SELECT {_FINGERPRINT_SQL} FROM organizations WHERE id = :org_id"),
+            {"org_id": org_id},
+        ).scalar()
+
+
+def get_auto_reply_enabled(engine, org_id: int) -> bool:
+    """Live enterprise toggle only (no KB / prompt transfer). Missing org -> enabled, like the defaults."""
+    with engine.connect() as conn:
+        v = conn.execute(
+            text("SELECT auto_reply_enabled FROM organizations WHERE id = :org_id"),
+            {"org_id": org_id},
+        ).scalar()
+    return True if v is None else bool(v)
+
+
+class OrgSettingsCache:
+    """
+    In-process org settings cache.
+
+    - Entries are served from memory for ttl seconds.
+    - After that, a fingerprint query decides: unchanged -> extend, changed -> reload the row.
+    - invalidate(org_id) / invalidate() drop entries right away (admin edits in this process).
+    Callers get a shallow copy, so mutating the returned dict never touches the cache.
+    """
+
+    def __init__(self, engine, ttl: int = ORG_SETTINGS_TTL_SECONDS):
+        self.engine = engine
+        self.ttl = ttl
+        self._entries = {}  # org_id -> (settings, fingerprint, checked_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.reloads = 0
+
+    def get(self, org_id: int) -> dict:
+        org_id = int(org_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(org_id)
+
+        if entry:
+            settings, fp, checked_at = entry
+            if now - checked_at < self.ttl:
+                self.hits += 1
+                return dict(settings)
+            if fp is not None and org_settings_fingerprint(self.engine, org_id) == fp:
+                with self._lock:
+                    self._entries[org_id] = (settings, fp, now)
+                self.hits += 1
+                return dict(settings)
+
+        settings, fp = load_org_settings(self.engine, org_id)
+        self.reloads += 1
+        with self._lock:
+            self._entries[org_id] = (settings, fp, now)
+        return dict(settings)
+
+    def invalidate(self, org_id: int = None):
+        with self._lock:
+            if org_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(org_id), None)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_org_settings_cache() -> OrgSettingsCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from app.db import engine
+                _cache = OrgSettingsCache(engine)
+    return _cache
+
+
+def invalidate_org_settings(org_id: int = None):
+    """Hook for code that edits organizations (no-op if nothing was cached in this process)."""
+    if _cache is not None:
+        _cache.invalidate(org_id)
@@ -0,0 +1,349 @@
+import os
+import threading
+import time
+import uuid
+from typing import Iterable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+try:
+    import redis  # optional: only needed when REDIS_URL points at a redis-server
+except ImportError:  # pragma: no cover
+    redis = None
+
+# Optional fast path for dedupe / hourly rate / thread locks.
+#   REDIS_URL=""                 -> disabled, everything goes to Postgres (default)
+#   REDIS_URL="redis://host:6379/0"
+#   REDIS_URL="memory://"        -> in-process fake (single worker process, dev/tests)
+# Postgres stays the source of truth: processed ids and reply_sent usage are still written
+# there, and every primitive returns None on Redis errors so callers fall back to Postgres.
+REDIS_URL = (os.getenv("REDIS_URL") or "").strip()
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "aimail")
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+# After a Redis error, go straight to Postgres for this long (no timeout per call while Redis is down)
+REDIS_RETRY_SECONDS = int(os.getenv("REDIS_RETRY_SECONDS", "30"))
+
+# Warm-up markers: while present, the Redis copy is complete for that org (rebuilt from PG otherwise)
+PROCESSED_WARM_SECONDS = 6 * 3600
+RATE_WARM_SECONDS = 24 * 3600
+
+
+class InProcessRedis:
+    """
+    Minimal thread-safe stand-in for the redis-py commands used here
+    (set/get/exists/delete/pexpire, zadd/zcard/zremrangebyscore, pipeline).
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def _alive(self, key) -> bool:
+        exp = self._expires.get(key)
+        if exp is not None and time.monotonic() >= exp:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def set(self, name, value, ex=None, px=None, nx=False):
+        with self._lock:
+            if nx and self._alive(name):
+                return None
+            self._data[name] = str(value)
+            self._expires.pop(name, None)
+            ttl = (px / 1000.0) if px else ex
+            if ttl:
+                self._expires[name] = time.monotonic() + ttl
+            return True
+
+    def get(self, name):
+        with self._lock:
+            return self._data.get(name) if self._alive(name) else None
+
+    def exists(self, *names) -> int:
+        with self._lock:
+            return sum(1 for n in names if self._alive(n))
+
+    def delete(self, *names) -> int:
+        with self._lock:
+            n = 0
+            for k in names:
+                if self._alive(k):
+                    n += 1
+                self._data.pop(k, None)
+                self._expires.pop(k, None)
+            return n
+
+    def pexpire(self, name, ms) -> bool:
+        with self._lock:
+            if not self._alive(name):
+                return False
+            self._expires[name] = time.monotonic() + ms / 1000.0
+            return True
+
+    def expire(self, name, seconds) -> bool:
+        return self.pexpire(name, int(seconds * 1000))
+
+    def pexpire_if_value(self, name, value, ms) -> bool:
+        """Same as _PEXPIRE_IF_OWNER_LUA, atomic under the lock."""
+        with self._lock:
+            if not self._alive(name) or self._data[name] != str(value):
+                return False
+            self._expires[name] = time.monotonic() + ms / 1000.0
+            return True
+
+    def zadd(self, name, mapping) -> int:
+        with self._lock:
+            if not self._alive(name):
+                self._data[name] = {}
+            z = self._data[name]
+            added = sum(1 for m in mapping if m not in z)
+            z.update({m: float(s) for m, s in mapping.items()})
+            return added
+
+    def zremrangebyscore(self, name, min, max) -> int:
+        lo = float("-inf") if min == "-inf" else float(min)
+        hi = float("inf") if max == "+inf" else float(max)
+        with self._lock:
+            if not self._alive(name):
+                return 0
+            z = self._data[name]
+            gone = [m for m, s in z.items() if lo <= s <= hi]
+            for m in gone:
+                del z[m]
+            return len(gone)
+
+    def zcard(self, name) -> int:
+        with self._lock:
+            return len(self._data[name]) if self._alive(name) else 0
+
+    def pipeline(self, transaction=True):
+        return _InProcessPipeline(self)
+
+
+class _InProcessPipeline:
+    def __init__(self, r: InProcessRedis):
+        self._r = r
+        self._ops = []
+
+    def __getattr__(self, name):
+        fn = getattr(self._r, name)
+
+        def queue(*args, **kwargs):
+            self._ops.append((fn, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        with self._r._lock:
+            out = [fn(*a, **k) for fn, a, k in self._ops]
+        self._ops = []
+        return out
+
+
+_client = None
+_client_lock = threading.Lock()
+_down_until = 0.0
+# Bumped on every Redis error: writes made while Redis was down only reached Postgres,
+# so this process re-warms its Redis copies from Postgres afterwards.
+_warm_epoch = 0
+
+
+def set_redis_client(client) -> None:
+    """Inject a client (redis.Redis, InProcessRedis, or None to disable)."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def get_redis():
+    """Shared client for REDIS_URL, or None when the fast path is disabled/unavailable."""
+    global _client
+    if time.monotonic() < _down_until:
+        return None
+    if _client is not None or not REDIS_URL:
+        return _client
+    with _client_lock:
+        if _client is None:
+            if REDIS_URL.startswith("memory://"):
+                _client = InProcessRedis()
+            elif redis is None:
+                print("[DEBUG] REDIS_URL is set but the redis package is not installed; using Postgres only")
+                return None
+            else:
+                _client = redis.Redis.from_url(
+                    REDIS_URL,
+                    decode_responses=True,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+                )
+    return _client
+
+
+def configured() -> bool:
+    """True when locks live in Redis (REDIS_URL usable or a client injected), even while it is down."""
+    if _client is not None:
+        return True
+    return bool(REDIS_URL) and (REDIS_URL.startswith("memory://") or redis is not None)
+
+
+def _mark_down(what: str, e: Exception) -> None:
+    global _down_until, _warm_epoch
+    _down_until = time.monotonic() + REDIS_RETRY_SECONDS
+    _warm_epoch += 1
+    print(f"[DEBUG] redis {what} failed (Postgres for {REDIS_RETRY_SECONDS}s): {e!r}")
+
+
+def _key(*parts) -> str:
+    return ":".join([REDIS_PREFIX] + [str(p) for p in parts])
+
+
+# ---------------------- processed Message-IDs ----------------------
+def _warm_processed(r, engine: Engine, org_id: int, days: int) -> None:
+    """Copy the org's last-N-days processed ids from Postgres once, so Redis misses mean "unseen"."""
+    warm = _key("processed_warm", org_id, days, _warm_epoch)
+    if r.exists(warm):
+        return
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT message_id, EXTRACT(EPOCH FROM (created_at + (:days || ' days')::interval - now()))
+            FROM processed_message_ids
+            WHERE org_id = :org_id
+              AND created_at >= (now() - (:days || ' days')::interval)
+        """), {"org_id": int(org_id), "days": int(days)}).fetchall()
+    pipe = r.pipeline(transaction=False)
+    for mid, left in rows:
+        if left and left > 1:
+            pipe.set(_key("processed", org_id, mid), 1, ex=int(left))
+    pipe.set(warm, 1, ex=PROCESSED_WARM_SECONDS)
+    pipe.execute()
+
+
+def processed_unseen(engine: Engine, org_id: int, message_ids: Iterable[str], days: int = 14) -> Optional[set]:
+    """Subset of normalized ids NOT processed in the last N days, or None (use Postgres)."""
+    r = get_redis()
+    if r is None:
+        return None
+    mids = [m for m in dict.fromkeys(message_ids or []) if m]
+    if not mids:
+        return set()
+    try:
+        _warm_processed(r, engine, org_id, days)
+        pipe = r.pipeline(transaction=False)
+        for m in mids:
+            pipe.exists(_key("processed", org_id, m))
+        hits = pipe.execute()
+        return {m for m, hit in zip(mids, hits) if not hit}
+    except Exception as e:
+        _mark_down("processed_unseen", e)
+        return None
+
+
+def processed_add(org_id: int, message_id: str, days: int = 14) -> None:
+    """Mirror a processed id into Redis (the Postgres insert is done by the caller)."""
+    r = get_redis()
+    if r is None or not message_id:
+        return
+    try:
+        r.set(_key("processed", org_id, message_id), 1, ex=int(days) * 86400)
+    except Exception as e:
+        _mark_down("processed_add", e)
+
+
+# ---------------------- hourly reply rate (sliding window) ----------------------
+def _warm_rate(r, engine: Engine, org_id: int) -> None:
+    warm = _key("rate_warm", org_id, _warm_epoch)
+    if r.exists(warm):
+        return
+    window = _key("sent", org_id)
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT id, qty, EXTRACT(EPOCH FROM created_at)
+            FROM org_usage
+            WHERE org_id = :oid
+              AND event = 'reply_sent'
+              AND created_at >= (NOW() AT TIME ZONE 'utc') - INTERVAL '1 hour'
+        """), {"oid": int(org_id)}).fetchall()
+    members = {}
+    for usage_id, qty, ts in rows:
+        for i in range(max(1, int(qty or 1))):
+            members[f"u{usage_id}.{i}"] = float(ts)
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(window)
+    if members:
+        pipe.zadd(window, members)
+        pipe.expire(window, 3600)
+    pipe.set(warm, 1, ex=RATE_WARM_SECONDS)
+    pipe.execute()
+
+
+def replies_last_hour(engine: Engine, org_id: int) -> Optional[int]:
+    """Replies sent in the last 60 minutes from the Redis window, or None (use Postgres)."""
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        _warm_rate(r, engine, org_id)
+        window = _key("sent", org_id)
+        pipe = r.pipeline(transaction=False)
+        pipe.zremrangebyscore(window, "-inf", time.time() - 3600)
+        pipe.zcard(window)
+        return int(pipe.execute()[1] or 0)
+    except Exception as e:
+        _mark_down("replies_last_hour", e)
+        return None
+
+
+def record_reply_sent(org_id: int, qty: int = 1) -> None:
+    """Add sent replies to the window (org_usage is still written by log_usage)."""
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        window = _key("sent", org_id)
+        now = time.time()
+        pipe = r.pipeline(transaction=False)
+        pipe.zadd(window, {f"r{uuid.uuid4().hex}": now for _ in range(max(1, int(qty or 1)))})
+        pipe.expire(window, 3600)
+        pipe.execute()
+    except Exception as e:
+        _mark_down("record_reply_sent", e)
+
+
+# ---------------------- thread locks ----------------------
+# Compare-and-extend in one step: a GET then PEXPIRE could extend a lock that expired and
+# was taken by another worker in between.
+_PEXPIRE_IF_OWNER_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _pexpire_if_owner(r, key: str, owner: str, ttl_ms: int) -> bool:
+    if isinstance(r, InProcessRedis):
+        return r.pexpire_if_value(key, owner, ttl_ms)
+    return bool(r.eval(_PEXPIRE_IF_OWNER_LUA, 1, key, owner, ttl_ms))
+
+
+def try_lock(org_id: int, thread_key: str, worker_id: str, ttl_seconds: int) -> Optional[bool]:
+    """
+    SET NX PX lock per (org, thread). Same owner may re-enter (TTL is refreshed atomically).
+    Returns True/False, or None when Redis is disabled or unavailable (see configured()).
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    key = _key("lock", org_id, thread_key)
+    ttl_ms = int(ttl_seconds * 1000)
+    try:
+        if r.set(key, worker_id, px=ttl_ms, nx=True):
+            return True
+        return _pexpire_if_owner(r, key, worker_id, ttl_ms)
+    except Exception as e:
+        _mark_down("try_lock", e)
+        return None
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Reuse a generated reply for the same question to the same org (same KB / settings version).
+REPLY_CACHE_ENABLED = os.getenv("REPLY_CACHE_ENABLED", "1").strip() != "0"
+REPLY_CACHE_TTL_SECONDS = int(os.getenv("REPLY_CACHE_TTL_SECONDS", str(6 * 3600)))
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "1000"))
+
+_SUBJECT_PREFIX_RE = re.compile(r"^\s*((re|fw|fwd)\s*:\s*)+", re.IGNORECASE)
+_QUOTE_HEADER_RE = re.compile(r"^\s*(on .{0,200}wrote:|-----\s*original message\s*-----)", re.IGNORECASE | re.MULTILINE)
+_NON_WORD_RE = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_question(subject: str, body: str) -> str:
+    """Subject without Re:/Fwd:, body without quoted history, lowercased, punctuation/whitespace collapsed."""
+    subject = _SUBJECT_PREFIX_RE.sub("", subject or "")
+    body = body or ""
+    m = _QUOTE_HEADER_RE.search(body)
+    if m:
+        body = body[: m.start()]
+    body = "\n".join(line for line in body.splitlines() if not line.lstrip().startswith(">"))
+    text_ = f"{subject}\n{body}".lower()
+    return _NON_WORD_RE.sub(" ", text_).strip()
+
+
+def reply_cache_key(org_id: int, kb_version: str, subject: str, body: str, thread_context: str) -> Optional[str]:
+    """Cache key, or None when the cache must be bypassed (disabled, thread context, empty question)."""
+    if not REPLY_CACHE_ENABLED or (thread_context or "").strip():
+        return None
+    q = normalize_question(subject, body)
+    if not q:
+        return None
+    raw = f"{int(org_id)}\x1f{kb_version or ''}\x1f{q}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ReplyCache:
+    """Thread-safe LRU with TTL; counts hits and misses."""
+
+    def __init__(self, max_entries: int = REPLY_CACHE_MAX_ENTRIES, ttl: int = REPLY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, reply: str) -> None:
+        with self._lock:
+            self._entries[key] = (reply, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+reply_cache = ReplyCache()
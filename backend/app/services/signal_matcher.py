@@ -0,0 +1,37 @@
+from typing import FrozenSet, Iterable
+
+try:
+    import ahocorasick  # optional: pyahocorasick (C automaton, one pass per text)
+except ImportError:  # pragma: no cover
+    ahocorasick = None
+
+
+class SignalMatcher:
+    """
+    Which of a fixed set of needles occur as substrings of a text (same answer as `needle in text`
+    for each needle, overlapping matches included). Build once at import, then hits() per field.
+
+    With pyahocorasick the text is scanned once by a C automaton; without it, every needle is
+    still checked with one C-level `in` scan per field (about the cost of the old per-check scans).
+    """
+
+    def __init__(self, needles: Iterable[str]):
+        self.needles = tuple(dict.fromkeys(n for n in needles if n))
+        self._automaton = None
+        if ahocorasick is not None and self.needles:
+            a = ahocorasick.Automaton()
+            for n in self.needles:
+                a.add_word(n, n)
+            a.make_automaton()
+            self._automaton = a
+
+    @property
+    def backend(self) -> str:
+        return "aho-corasick" if self._automaton is not None else "substring"
+
+    def hits(self, text: str) -> FrozenSet[str]:
+        if not text:
+            return frozenset()
+        if self._automaton is not None:
+            return frozenset(n for _, n in self._automaton.iter(text))
+        return frozenset(n for n in self.needles if n in text)
@@ -0,0 +1,121 @@
+import atexit
+import hashlib
+import logging
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+logger = logging.getLogger("ai_mail_worker")
+
+# Reused connections idle longer than this are checked with NOOP before sending
+NOOP_AFTER_SECONDS = 15
+# Drop connections idle longer than this (most providers close them around 5-10 min anyway)
+MAX_IDLE_SECONDS = 240
+# Reconnect after this many messages on one connection (some providers cap it)
+MAX_MESSAGES_PER_CONNECTION = 100
+
+
+class _Entry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.smtp = None
+        self.last_used = 0.0
+        self.sent = 0
+
+
+class SmtpPool:
+    """
+    Authenticated SMTP connections keyed by (host, port, username, password hash).
+
+    send() reuses the account's connection across messages and cycles, validates it with
+    NOOP after NOOP_AFTER_SECONDS idle, and reconnects when the server dropped it.
+    Sends for the same account are serialized; different accounts send in parallel.
+    """
+
+    def __init__(self, timeout: int = 60):
+        self.timeout = timeout
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.handshakes = 0
+
+    @staticmethod
+    def _key(host: str, port: int, username: str, password: str) -> tuple:
+        pw = hashlib.sha1((password or "").encode("utf-8")).hexdigest()[:12]
+        return (host, int(port), (username or "").lower(), pw)
+
+    def _entry(self, key) -> _Entry:
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None:
+                e = self._entries[key] = _Entry()
+            return e
+
+    def _connect(self, host: str, port: int, username: str, password: str):
+        if int(port) == 465:
+            smtp = smtplib.SMTP_SSL(host, port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(host, port, timeout=self.timeout)
+            smtp.ehlo()
+            smtp.starttls()
+            smtp.ehlo()
+        smtp.login(username, password)
+        self.handshakes += 1
+        return smtp
+
+    @staticmethod
+    def _quit(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _usable(self, e: _Entry) -> bool:
+        if e.smtp is None:
+            return False
+        idle = time.monotonic() - e.last_used
+        if idle > MAX_IDLE_SECONDS or e.sent >= MAX_MESSAGES_PER_CONNECTION:
+            return False
+        if idle > NOOP_AFTER_SECONDS:
+            try:
+                code, _ = e.smtp.noop()
+                return code == 250
+            except (smtplib.SMTPException, OSError):
+                return False
+        return True
+
+    def send(self, host: str, port: int, username: str, password: str, msg: EmailMessage) -> None:
+        """Send one message on the pooled connection. Raises on failure (connection is dropped)."""
+        e = self._entry(self._key(host, port, username, password))
+        with e.lock:
+            if not self._usable(e):
+                if e.smtp is not None:
+                    self._quit(e.smtp)
+                e.smtp = None
+                e.smtp = self._connect(host, port, username, password)
+                e.sent = 0
+            try:
+                e.smtp.send_message(msg)
+            except Exception:
+                self._quit(e.smtp)
+                e.smtp = None
+                raise
+            e.sent += 1
+            e.last_used = time.monotonic()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for e in entries:
+            with e.lock:
+                if e.smtp is not None:
+                    self._quit(e.smtp)
+                    e.smtp = None
+
+
+smtp_pool = SmtpPool()
+atexit.register(smtp_pool.close_all)
@@ -0,0 +1,57 @@
+from typing import Optional
+
+from sqlalchemy import text
+
+
+def get_sync_state(engine, account_id: int) -> Optional[dict]:
+    """
+    Returns the incremental-sync cursor for a mailbox:
+    {"uidvalidity", "last_uid", "highestmodseq"} or None if never synced.
+    """
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("""
+                SELECT uidvalidity, last_uid, highestmodseq
+                FROM imap_sync_state
+                WHERE account_id = :aid
+            """),
+            {"aid": int(account_id)},
+        ).mappings().first()
+    return dict(row) if row else None
+
+
+def save_sync_state(
+    engine,
+    account_id: int,
+    org_id: int,
+    uidvalidity: int,
+    last_uid: int,
+    highestmodseq: Optional[int] = None,
+) -> None:
+    """
+    Upsert the cursor. last_uid never moves backwards for the same UIDVALIDITY.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                INSERT INTO imap_sync_state (account_id, org_id, uidvalidity, last_uid, highestmodseq, updated_at)
+                VALUES (:aid, :oid, :uv, :last_uid, :modseq, NOW())
+                ON CONFLICT (account_id) DO UPDATE
+                SET org_id        = EXCLUDED.org_id,
+                    last_uid      = CASE
+                                        WHEN imap_sync_state.uidvalidity = EXCLUDED.uidvalidity
+                                        THEN GREATEST(imap_sync_state.last_uid, EXCLUDED.last_uid)
+                                        ELSE EXCLUDED.last_uid
+                                    END,
+                    uidvalidity   = EXCLUDED.uidvalidity,
+                    highestmodseq = EXCLUDED.highestmodseq,
+                    updated_at    = NOW()
+            """),
+            {
+                "aid": int(account_id),
+                "oid": int(org_id),
+                "uv": int(uidvalidity),
+                "last_uid": int(last_uid),
+                "modseq": int(highestmodseq) if highestmodseq is not None else None,
+            },
+        )
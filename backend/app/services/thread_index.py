@@ -0,0 +1,88 @@
+import re
+from typing import Optional
+
+from sqlalchemy import text
+
+# Outgoing References keep the thread root plus the newest ids (RFC 5322 3.6.4 allows trimming)
+REFERENCES_MAX_IDS = 20
+
+_MSGID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def _norm(mid: Optional[str]) -> str:
+    mid = (mid or "").strip().lower()
+    if mid.startswith("<") and mid.endswith(">"):
+        mid = mid[1:-1].strip()
+    return mid
+
+
+def thread_message_ids(message_id: Optional[str], in_reply_to: Optional[str], references: Optional[str]) -> list:
+    """
+    Normalized ids (lowercase, no <>) an email belongs with: its own Message-ID, In-Reply-To,
+    then References newest first. Unique, in that order.
+    """
+    ids = [message_id] + _MSGID_RE.findall(in_reply_to or "") + list(reversed(_MSGID_RE.findall(references or "")))
+    out = []
+    for mid in ids:
+        mid = _norm(mid)
+        if mid and mid not in out:
+            out.append(mid)
+    return out
+
+
+def resolve_thread_key(engine, org_id: int, message_ids: list) -> Optional[str]:
+    """
+    Canonical thread key for an email: one primary-key lookup over every id it references.
+    When several are indexed (threads that were split before), the oldest mapping wins.
+    None when none of them is known yet.
+    """
+    if not message_ids:
+        return None
+    with engine.connect() as conn:
+        return conn.execute(
+            text("""
+                SELECT thread_key
+                FROM message_thread_index
+                WHERE org_id = :oid AND message_id = ANY(:mids)
+                ORDER BY created_at, message_id
+                LIMIT 1
+            """),
+            {"oid": int(org_id), "mids": list(message_ids)},
+        ).scalar()
+
+
+def index_thread_messages(db, org_id: int, thread_key: str, message_ids: list) -> None:
+    """
+    Map message ids to thread_key (first mapping wins). Runs on the caller's session /
+    connection so it commits together with the conversation_audit row.
+    """
+    mids = [m for m in (message_ids or []) if m]
+    if not mids or not thread_key:
+        return
+    db.execute(
+        text("""
+            INSERT INTO message_thread_index (org_id, message_id, thread_key)
+            SELECT :oid, mid, :tkey
+            FROM unnest(CAST(:mids AS text[])) AS mid
+            ON CONFLICT (org_id, message_id) DO NOTHING
+        """),
+        {"oid": int(org_id), "tkey": thread_key, "mids": mids},
+    )
+
+
+def reply_references(message_id: Optional[str], in_reply_to: Optional[str], references: Optional[str]) -> Optional[str]:
+    """
+    References for a reply (RFC 5322 3.6.4): the parent's References (else its In-Reply-To),
+    then the parent's Message-ID. Root + newest ids when the chain is long.
+    """
+    parent = _MSGID_RE.findall(message_id or "")
+    if not parent:
+        return None
+    chain = _MSGID_RE.findall(references or "") or _MSGID_RE.findall(in_reply_to or "")[:1]
+    ids = []
+    for mid in chain + parent[:1]:
+        if mid not in ids:
+            ids.append(mid)
+    if len(ids) > REFERENCES_MAX_IDS:
+        ids = ids[:1] + ids[-(REFERENCES_MAX_IDS - 1):]
+    return " ".join(ids)
@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta, timezone
 from sqlalchemy import text
 
+from app.services import redis_fast
+
 
 def _utcnow() -> datetime:
     return datetime.now(timezone.utc)
@@ -20,14 +22,24 @@ def try_acquire_thread_lock(
     cooldown_seconds: int,
     worker_id: str,
     ttl_seconds: int,
-) -> bool:
+) -> bool | None:
     """
     One row per (org_id, thread_key). Acquire rules:
     - Insert if no row exists.
     - If row exists and is expired -> takeover (update).
     - If row exists and is owned by same worker_id -> allow re-enter (idempotent).
     - Else -> deny (someone else holds unexpired lock).
+    With REDIS_URL set the lock is a Redis SET NX PX key and this table is not used.
+    Returns None while Redis is configured but unreachable: Redis locks are never written
+    here, so taking the row could run next to another worker's Redis lock on the same
+    thread. The caller retries later instead (fail closed).
     """
+    fast = redis_fast.try_lock(org_id, thread_key, worker_id, ttl_seconds)
+    if fast is not None:
+        return fast
+    if redis_fast.configured():
+        return None
+
     now = _utcnow()
     bucket_start = _bucket_start(now, cooldown_seconds)
     expires_at = now + timedelta(seconds=ttl_seconds)
@@ -0,0 +1,146 @@
+import os
+from typing import List, Optional
+
+# Whole prompt (system + user) budget per email; organizations.prompt_token_budget overrides it
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+# Bounded reply length (max_tokens on the completion)
+REPLY_MAX_TOKENS = int(os.getenv("REPLY_MAX_TOKENS", "600"))
+
+# Budgets below this are treated as misconfigured and raised to it
+MIN_PROMPT_TOKEN_BUDGET = 1500
+# Fixed part of the user prompt (section headers, subject, sender)
+USER_PROMPT_OVERHEAD_TOKENS = 80
+# Share of the variable budget each section may take before the next one is served;
+# whatever a section leaves unused flows to the sections after it
+BODY_SHARE = 0.40
+KB_SHARE = 0.60  # of what is left after the body
+# The new email always keeps at least this much, even when the system prompt is huge
+BODY_MIN_TOKENS = 300
+
+TRUNCATED_MARK = "\n[...truncated]"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate: ~4 ASCII chars per token, plus extra for multi-byte
+    characters (non-Latin scripts tokenize to roughly one token per character).
+    """
+    if not text:
+        return 0
+    n = len(text)
+    extra = len(text.encode("utf-8")) - n
+    return (n + 3) // 4 + (extra + 1) // 2
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens (at a line / word boundary when one is close), marking the cut."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    # Binary search on the character count (the estimate is monotonic in the prefix length)
+    lo, hi = 0, len(text)
+    limit = max_tokens - estimate_tokens(TRUNCATED_MARK)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text[:lo]
+    for sep in ("\n", " "):
+        pos = cut.rfind(sep)
+        if pos > lo * 0.8:
+            cut = cut[:pos]
+            break
+    return cut.rstrip() + TRUNCATED_MARK
+
+
+def org_prompt_budget(org_settings: dict) -> int:
+    budget = org_settings.get("prompt_token_budget") or PROMPT_TOKEN_BUDGET
+    return max(int(budget), MIN_PROMPT_TOKEN_BUDGET)
+
+
+def allocate_prompt(
+    budget: int,
+    system_prompt: str,
+    body: str,
+    kb_chunks: List[str],
+    thread_exchanges: List[str],
+    max_output_tokens: Optional[int] = None,
+) -> dict:
+    """
+    Split one email's prompt budget, in priority order:
+      1. system rules (the cached per-org prefix, never cut: its bytes must stay stable)
+      2. the new email body (up to BODY_SHARE of what is left, never below BODY_MIN_TOKENS)
+      3. KB chunks in relevance order, whole chunks only (up to KB_SHARE of the rest)
+      4. thread history, newest exchange first, whole exchanges (the newest one may be cut)
+    Unused share flows down; any slack left at the end goes back to a truncated body.
+
+    kb_chunks: best first. thread_exchanges: oldest first (as load_thread_exchanges returns them).
+    Returns {"body", "kb_chunks" (selected, input order), "thread" (oldest first),
+    "max_tokens", "tokens": {...}, "dropped": {...}}.
+    """
+    system_tokens = estimate_tokens(system_prompt)
+    remaining = max(budget - system_tokens - USER_PROMPT_OVERHEAD_TOKENS, 0)
+
+    # 2. body
+    body = body or ""
+    body_tokens = estimate_tokens(body)
+    body_cap = max(int(remaining * BODY_SHARE), BODY_MIN_TOKENS)
+    body_out = truncate_to_tokens(body, body_cap)
+    body_used = estimate_tokens(body_out)
+    remaining = max(remaining - body_used, 0)
+
+    # 3. KB chunks
+    kb_cap = int(remaining * KB_SHARE)
+    kb_selected, kb_used = [], 0
+    for i, chunk in enumerate(kb_chunks or []):
+        t = estimate_tokens(chunk)
+        if kb_used + t <= kb_cap:
+            kb_selected.append(i)
+            kb_used += t
+    remaining -= kb_used
+
+    # 4. thread history, newest first
+    thread_rev, thread_used = [], 0
+    for ex in reversed(thread_exchanges or []):
+        t = estimate_tokens(ex)
+        if thread_used + t <= remaining:
+            thread_rev.append(ex)
+            thread_used += t
+            continue
+        if not thread_rev:
+            # The latest exchange alone is too big: keep its beginning
+            cut = truncate_to_tokens(ex, remaining)
+            if cut:
+                thread_rev.append(cut)
+                thread_used += estimate_tokens(cut)
+        break
+    remaining -= thread_used
+
+    # Slack goes back to the body if it was cut
+    if body_out != body and remaining > 0:
+        body_out = truncate_to_tokens(body, body_used + remaining)
+        remaining += body_used - estimate_tokens(body_out)
+        body_used = estimate_tokens(body_out)
+
+    return {
+        "body": body_out,
+        "kb_chunks": [kb_chunks[i] for i in kb_selected],
+        "thread": list(reversed(thread_rev)),
+        "max_tokens": int(max_output_tokens or REPLY_MAX_TOKENS),
+        "tokens": {
+            "budget": budget,
+            "system": system_tokens,
+            "body": body_used,
+            "kb": kb_used,
+            "thread": thread_used,
+            "total": system_tokens + USER_PROMPT_OVERHEAD_TOKENS + body_used + kb_used + thread_used,
+        },
+        "dropped": {
+            "body_tokens": body_tokens - body_used,
+            "kb_chunks": len(kb_chunks or []) - len(kb_selected),
+            "thread_exchanges": len(thread_exchanges or []) - len(thread_rev),
+        },
+    }
@@ -0,0 +1,345 @@
+"""
+Compare the compiled signal classifier in worker_imap (scan_signals + is_* filters) with the
+previous per-needle implementation, and time both per message.
+
+Usage:
+    python bench_classifier.py [n_random_messages]
+
+Checks identical results (incl. the is_real_enquiry reason) on fixed edge cases and random
+messages built from the filter needles, then prints per-message cost for growing body sizes.
+"""
+import random
+import sys
+import time
+
+import worker_imap as w
+from worker_imap import DEBUG, IGNORE_KEYWORDS, IGNORE_SENDERS
+from app.services import signal_matcher
+
+N_RANDOM = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+
+
+# ---------------------- previous implementation (reference) ----------------------
+def legacy_is_ignored_email(text_lower: str) -> bool:
+    """
+    Pass lowercase text. Returns True if it's marketing/system based on static lists.
+    """
+    if not text_lower:
+        return False
+    if any(k in text_lower for k in IGNORE_KEYWORDS):
+        return True
+    if any(s in text_lower for s in IGNORE_SENDERS):
+        return True
+    return False
+
+
+def legacy_is_bulk_header(hdr_lower: str) -> tuple[bool, str]:
+    """
+    Header-only bulk/list detector (safe for pre-select). Returns (is_bulk, reason).
+    Keep this STRICT. Do not use body text here.
+    """
+    h = (hdr_lower or "").lower()
+    checks = [
+        ("auto-submitted: auto-generated", "auto_generated"),
+        ("auto-submitted: auto-replied", "auto_replied"),
+        ("precedence: bulk", "precedence_bulk"),
+        ("precedence: junk", "precedence_junk"),
+        ("precedence: list", "precedence_list"),
+                ("list-id:", "list_id"),
+        ("feedback-id:", "feedback_id"),
+    ]
+    for needle, reason in checks:
+        if needle in h:
+            return True, reason
+    return False, ""
+
+def legacy_is_security_alert_email(subject: str, body: str, raw_headers) -> bool:
+    """
+    STRICT system/security filter.
+    Return True only when we are highly confident the message is automated security/system noise
+    (bounces, delivery reports, auto-generated alerts, list mail).
+    """
+    subj = (subject or "").lower()
+    text_ = (body or "").lower()
+
+    # raw_headers can be dict-like or string; normalize
+    try:
+        hdr_str = "\n".join([f"{k}: {v}" for k, v in (raw_headers or {}).items()]).lower()
+    except Exception:
+        hdr_str = str(raw_headers or "").lower()
+
+    combined = f"{subj}\n{text_}\n{hdr_str}"
+
+    # Strong automated/system signals (headers)
+    auto_header_signals = (
+        "auto-submitted: auto-generated" in combined
+        or "auto-submitted: auto-replied" in combined
+        or "x-autoreply" in combined
+        or "x-auto-response-suppress" in combined
+        or "precedence: bulk" in combined
+        or "precedence: junk" in combined
+        or "precedence: list" in combined
+        or "list-id:" in combined
+        or "feedback-id:" in combined
+    )
+
+    # Bounce / DSN / delivery failure patterns
+    bounce_signals = (
+        "mailer-daemon" in combined
+        or "postmaster@" in combined
+        or "delivery status notification" in combined
+        or "undelivered mail" in combined
+        or "returned mail" in combined
+        or "diagnostic-code:" in combined
+        or "final-recipient:" in combined
+        or "x-failed-recipients:" in combined
+        or "report-type=delivery-status" in combined
+        or "message/delivery-status" in combined
+    )
+
+    # Security-alert style keywords (NOT enough alone to skip)
+    security_keywords = (
+        "security alert" in combined
+        or "suspicious sign" in combined
+        or "new sign-in" in combined
+        or "new login" in combined
+        or "unusual activity" in combined
+        or "verify your account" in combined
+        or "password reset" in combined
+        or "reset your password" in combined
+        or "2-step verification" in combined
+        or "two-step verification" in combined
+        or "verification code" in combined
+        or "one-time password" in combined
+        or "otp" in combined
+    )
+
+    # The key rule:
+    # - Always skip bounces/DSNs
+    # - Skip security alerts ONLY if also auto-generated (headers) or clearly bulk/list
+    if bounce_signals:
+        return True
+
+    if security_keywords and auto_header_signals:
+        return True
+
+    return False
+
+
+def legacy_is_real_enquiry(
+    subject: str,
+    sender: str,
+    body: str,
+    raw_headers: str = "",
+    trusted_sender: bool = False,
+) -> bool:
+    s = (subject or "").lower().strip()
+    f = (sender or "").lower().strip()
+    b = (body or "").lower().strip()
+    h = (raw_headers or "").lower().strip()
+
+    combined = "\n".join([s, f, h, b])
+    combined_h = "\n".join([s, f, h])
+
+    # debug reason tracker
+    legacy_is_real_enquiry.last_reason = ""
+
+    # Bulk signals: check ONLY subject+from+headers (NOT body)
+    bulk_signals = [
+        "list-id", "list-help", "list-post",
+        "unsubscribe", "manage preferences", "view in browser",
+        "you are receiving this email because", "email preferences",
+        "newsletter", "promotion", "campaign", "marketing",
+    ]
+    hit = next((x for x in bulk_signals if x in combined_h), None)
+    if hit and (not trusted_sender):
+        legacy_is_real_enquiry.last_reason = f"bulk:{hit}"
+        return False
+
+    # Strict security/system filter (bypass for trusted)
+    if (not trusted_sender) and legacy_is_security_alert_email(subject, body, raw_headers):
+        legacy_is_real_enquiry.last_reason = "security_alert"
+        return False
+
+    # Static ignore lists (keywords + senders). This checks combined (includes body)
+    ignored = legacy_is_ignored_email(combined)
+    if DEBUG:
+        print(f"[DEBUG legacy_is_real_enquiry] ignored={ignored} trusted_sender={trusted_sender}")
+
+    if (not trusted_sender) and ignored:
+        legacy_is_real_enquiry.last_reason = "ignored_static"
+        return False
+
+    # Subject contains enquiry-like signals
+    if 3 <= len(s) <= 90:
+        subject_signals = [
+            "web", "website", "design", "developer", "consultant",
+            "seo", "marketing", "app", "service", "quote", "pricing", "cost", "fees"
+        ]
+        if any(x in s for x in subject_signals):
+            legacy_is_real_enquiry.last_reason = "ok"
+            return True
+
+    # Positive intent signals anywhere in combined
+    positive = [
+        "enquiry", "inquiry", "quote", "quotation", "estimate",
+        "pricing", "price", "fees", "fee", "cost",
+        "demo", "trial", "meeting", "schedule", "call", "callback",
+        "support", "help", "issue", "problem", "error", "unable", "not working",
+        "refund", "cancel",
+        "admission", "join", "apply", "register",
+        "need", "require", "looking for", "want to", "i want", "i need",
+        "web design", "web developer", "developer", "consultant",
+        "ui", "ux", "digital marketing", "branding", "app development",
+    ]
+    if any(p in combined for p in positive):
+        legacy_is_real_enquiry.last_reason = "ok"
+        return True
+
+    # Human-ish short body with question
+    if 20 <= len(b) <= 600:
+        human_signals = ["hi", "hello", "dear", "please", "kindly", "thanks", "thank you"]
+        if any(hs in b for hs in human_signals) or "?" in b:
+            legacy_is_real_enquiry.last_reason = "ok"
+            return True
+
+    return False
+
+
+# ---------------------- corpus ----------------------
+NEEDLES = list(w._signal_matcher.needles)
+NOISE = [
+    "hello", "regards", "the", "course", "batch", "timing", "thanks", "Σ", "İstanbul", "ÜBER",
+    "K", "build", "guide", "this", "which", "\n", "  ", "\t", "?", "!", "@", ".", ":", "-",
+]
+HEADER_LINES = [
+    "Auto-Submitted: auto-generated", "Auto-Submitted: auto-replied", "Precedence: bulk",
+    "Precedence: list", "List-Id: <news.example.com>", "Feedback-ID: 123:abc", "X-Autoreply: yes",
+    "From: Mailer-Daemon <mailer-daemon@x.com>", "Message-ID: <a@b.c>", "Subject: Hi",
+]
+
+
+def random_text(rnd, n_tokens):
+    parts = []
+    for _ in range(n_tokens):
+        tok = rnd.choice(NEEDLES) if rnd.random() < 0.15 else rnd.choice(NOISE)
+        if rnd.random() < 0.2:
+            tok = tok.upper()
+        elif rnd.random() < 0.1:
+            tok = tok.title()
+        parts.append(tok)
+        parts.append(rnd.choice([" ", "", "\n", " "]))
+    return "".join(parts)
+
+
+def random_message(rnd):
+    subject = random_text(rnd, rnd.randint(0, 12))
+    sender = rnd.choice(["", "John <john@example.com>", "noreply@news.io", "MAILER-DAEMON@x.com"]) + random_text(rnd, rnd.randint(0, 2))
+    body = random_text(rnd, rnd.choice([0, 3, 8, 40, 150, 600]))
+    headers = "\n".join(rnd.sample(HEADER_LINES, rnd.randint(0, 3))) + random_text(rnd, rnd.randint(0, 3))
+    return subject, sender, body, headers
+
+
+FIXED = [
+    ("Course fees?", "a@b.com", "Hi, what are the fees for the web course?", ""),
+    ("Newsletter", "news@shop.com", "Our summer promotion", "List-Id: <x>"),
+    ("Delivery Status Notification (Failure)", "mailer-daemon@googlemail.com", "Diagnostic-Code: smtp; 550", ""),
+    ("Security alert", "no-reply@accounts.google.com", "New sign-in on Windows", "Auto-Submitted: auto-generated"),
+    ("Security alert", "it@company.com", "New sign-in from your account", ""),
+    ("", "", "", ""),
+    ("   ", "x", "   ?   ", None),
+    ("hi", "", "a" * 19 + "?", ""),
+    ("Question", "", "Could you share the brochure for the course? " * 13, ""),
+    ("İNQUIRY", "", "SİGN", ""),
+    ("KELVİN", "", "Thank you", ""),
+]
+
+
+def results_legacy(subject, sender, body, headers, trusted):
+    r = legacy_is_real_enquiry(subject, sender, body, raw_headers=headers or "", trusted_sender=trusted)
+    return (
+        r,
+        legacy_is_real_enquiry.last_reason,
+        legacy_is_security_alert_email(subject, body, headers),
+        legacy_is_security_alert_email(subject, body, {"List-Id": headers or ""}),
+        legacy_is_ignored_email(f"{subject}\n{sender}\n{body}".lower()),
+        legacy_is_bulk_header((headers or "").lower()),
+    )
+
+
+def results_new(subject, sender, body, headers, trusted):
+    signals = w.scan_signals(subject, sender, body, headers or "")
+    r, reason = w.is_real_enquiry(subject, sender, body, raw_headers=headers or "", trusted_sender=trusted, signals=signals)
+    return (
+        r,
+        reason,
+        w.is_security_alert_email(subject, body, headers),
+        w.is_security_alert_email(subject, body, {"List-Id": headers or ""}),
+        w.is_ignored_email(f"{subject}\n{sender}\n{body}".lower()),
+        w.is_bulk_header((headers or "").lower()),
+    )
+
+
+# Needles must not span the "\n" joins or the stripped edges of the old combined strings
+bad = [n for n in NEEDLES if "\n" in n or n != n.strip()]
+print("needles:", len(NEEDLES), "unsafe needles:", bad)
+
+# Both backends: the configured one, and the plain-substring fallback (no pyahocorasick)
+matchers = [w._signal_matcher]
+if w._signal_matcher.backend != "substring":
+    saved, signal_matcher.ahocorasick = signal_matcher.ahocorasick, None
+    matchers.append(signal_matcher.SignalMatcher(NEEDLES))
+    signal_matcher.ahocorasick = saved
+
+rnd = random.Random(1234)
+cases = FIXED + [random_message(rnd) for _ in range(N_RANDOM)]
+mismatches = 0
+for matcher in matchers:
+    w._signal_matcher = matcher
+    reasons = {}
+    for subject, sender, body, headers in cases:
+        for trusted in (False, True):
+            old = results_legacy(subject, sender, body, headers, trusted)
+            new = results_new(subject, sender, body, headers, trusted)
+            reasons[old[1]] = reasons.get(old[1], 0) + 1
+            if old != new:
+                mismatches += 1
+                if mismatches <= 5:
+                    print("MISMATCH", (subject[:60], sender[:40], body[:60], headers), trusted, old, new)
+    print(f"[{matcher.backend}] cases={len(cases) * 2} mismatches={mismatches} reasons={reasons}")
+
+
+# ---------------------- per-message cost ----------------------
+def gate_legacy(subject, sender, body, hdr):
+    legacy_is_security_alert_email(subject, body, hdr)
+    legacy_is_real_enquiry(subject, sender, body, raw_headers=hdr)
+
+
+def gate_new(subject, sender, body, hdr):
+    signals = w.scan_signals(subject, sender, body, hdr)
+    w.is_security_alert_email(subject, body, hdr, signals=signals)
+    w.is_real_enquiry(subject, sender, body, raw_headers=hdr, signals=signals)
+
+
+def per_message_ms(fn, msg, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(*msg)
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+# Newsletter-like text that hits nothing: the worst case for per-needle scans (every scan runs to the end)
+filler = "Our batch timings for the coming month are listed below in detail. "
+hdr = "From: John <john@example.com>\nSubject: Batch timings\nMessage-ID: <x@y.z>\n"
+for matcher in matchers:
+    w._signal_matcher = matcher
+    print(f"\n[{matcher.backend}] {'body':>10} {'legacy ms':>10} {'new ms':>10} {'speedup':>8}")
+    for size in (1_000, 10_000, 100_000, 1_000_000):
+        body = (filler * (size // len(filler) + 1))[:size]
+        msg = ("Batch timings", "John <john@example.com>", body, hdr)
+        repeat = max(3, 2_000_000 // (size * 10))
+        old_ms = per_message_ms(gate_legacy, msg, repeat)
+        new_ms = per_message_ms(gate_new, msg, repeat)
+        print(f"{'':{len(matcher.backend) + 2}} {size:>10} {old_ms:>10.3f} {new_ms:>10.3f} {old_ms / new_ms:>7.1f}x")
+
+sys.exit(1 if (mismatches or bad) else 0)
@@ -0,0 +1,248 @@
+"""
+Check the partial body fetch (app/services/imap_body.py) against the full-message parse:
+plain / html-only / alternative / related / attachments / base64 / quoted-printable / charsets,
+a 20 MB attachment (only the text part may be downloaded), byte-capped bodies, and
+real-world BODYSTRUCTURE responses (literals, NIL, extension data).
+
+A small fake IMAP connection answers RFC822.SIZE, BODYSTRUCTURE, BODY.PEEK[<section>]<0.n> and
+BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.n> from the message bytes and counts the bytes it sends.
+
+Usage:
+    python check_body_fetch.py
+"""
+import re
+import sys
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.policy import default
+
+from app.services.imap_body import (
+    fetch_body_text,
+    message_body_text,
+    parse_fetch_structure,
+    select_text_part,
+)
+
+
+# ---------- fake server ----------
+def _q(s):
+    return "NIL" if s is None else '"' + str(s).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _raw_payload(part) -> bytes:
+    payload = part.get_payload()
+    return payload.encode("utf-8", "surrogateescape") if isinstance(payload, str) else b""
+
+
+def bodystructure(part) -> str:
+    """BODYSTRUCTURE of a (compat32-parsed) message, as an IMAP server would send it."""
+    if part.is_multipart():
+        children = "".join(bodystructure(p) for p in part.get_payload())
+        return f"({children} {_q(part.get_content_subtype())} ({_q('boundary')} {_q(part.get_boundary())}) NIL NIL NIL)"
+    params = " ".join(f"{_q(k)} {_q(v)}" for k, v in (part.get_params() or [])[1:]) or None
+    params = f"({params})" if params else "NIL"
+    raw = _raw_payload(part)
+    cte = part.get("Content-Transfer-Encoding", "7bit")
+    disp = part.get_content_disposition()
+    fname = part.get_filename()
+    disp = f"({_q(disp)} ({_q('filename')} {_q(fname)}))" if disp and fname else (f"({_q(disp)} NIL)" if disp else "NIL")
+    out = f"({_q(part.get_content_maintype())} {_q(part.get_content_subtype())} {params} NIL NIL {_q(cte)} {len(raw)}"
+    if part.get_content_maintype() == "text":
+        out += " %d" % raw.count(b"\n")
+    return out + f" NIL {disp} NIL NIL)"
+
+
+def section_bytes(msg, section: str) -> bytes:
+    part = msg
+    if msg.is_multipart():
+        for n in section.split("."):
+            part = part.get_payload()[int(n) - 1]
+    return _raw_payload(part)
+
+
+class FakeImap:
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.msg = message_from_bytes(raw)
+        self.sent = 0
+        self.commands = []
+
+    def uid(self, cmd, uid, what):
+        self.commands.append(what)
+        if what == "(RFC822.SIZE BODYSTRUCTURE)":
+            line = f"1 (UID {uid} RFC822.SIZE {len(self.raw)} BODYSTRUCTURE {bodystructure(self.msg)})".encode()
+            self.sent += len(line)
+            return "OK", [line]
+        if what == "(BODY.PEEK[])":
+            self.sent += len(self.raw)
+            return "OK", [(f"1 (UID {uid} BODY[] {{{len(self.raw)}}}".encode(), self.raw), b")"]
+        m = re.match(r"\(BODY\.PEEK\[HEADER\] BODY\.PEEK\[TEXT\]<0\.(\d+)>\)", what)
+        if m:
+            cut = self.raw.index(b"\n\n") + 2
+            header, body = self.raw[:cut], self.raw[cut:][: int(m.group(1))]
+            self.sent += len(header) + len(body)
+            return "OK", [
+                (f"1 (UID {uid} BODY[HEADER] {{{len(header)}}}".encode(), header),
+                (f" BODY[TEXT]<0> {{{len(body)}}}".encode(), body),
+                b")",
+            ]
+        m = re.match(r"\(BODY\.PEEK\[([\d.]+)\]<0\.(\d+)>\)", what)
+        data = section_bytes(self.msg, m.group(1))[: int(m.group(2))]
+        self.sent += len(data)
+        return "OK", [(f"1 (UID {uid} BODY[{m.group(1)}]<0> {{{len(data)}}}".encode(), data), b")"]
+
+
+# ---------- checks ----------
+failures = 0
+
+
+def check(name, ok, detail=""):
+    global failures
+    failures += 0 if ok else 1
+    print(f"{'OK  ' if ok else 'FAIL'} {name}" + (f": {detail}" if detail else ""))
+
+
+def norm(s):
+    return "\n".join(line.rstrip() for line in (s or "").replace("\r\n", "\n").strip().splitlines())
+
+
+def base(subject="Fees?"):
+    m = EmailMessage()
+    m["From"] = "Alice <alice@cust.com>"
+    m["To"] = "info@org.com"
+    m["Subject"] = subject
+    m["Message-ID"] = "<m1@cust.com>"
+    return m
+
+
+def compare(name, m: EmailMessage, max_sent=None):
+    raw = m.as_bytes()
+    imap = FakeImap(raw)
+    text, info = fetch_body_text(imap, 101)
+    expected = message_body_text(message_from_bytes(raw, policy=default))
+    check(f"{name}: same text as full parse", norm(text) == norm(expected), f"{text[:60]!r} vs {expected[:60]!r}")
+    if max_sent is not None:
+        check(f"{name}: bytes sent {imap.sent} <= {max_sent} (message {len(raw)})", imap.sent <= max_sent)
+    return text, info, imap
+
+
+QUESTION = "Hello,\nWhat are the fees for the data science course? Is there an EMI option?\nThanks, Alice\n"
+HTML = "<html><head><style>p{color:red}</style></head><body><p>Hello,</p><p>What are the <b>fees</b> &amp; dates?</p></body></html>"
+
+# 1. plain single part
+m = base()
+m.set_content(QUESTION)
+compare("plain", m)
+
+# 2. html only (single part): converted to text
+m = base()
+m.set_content(HTML, subtype="html")
+text, info, _ = compare("html only", m)
+check("html only: tags dropped", "<" not in text and "fees & dates?" in text, repr(text))
+
+# 3. alternative: plain wins
+m = base()
+m.set_content(QUESTION)
+m.add_alternative(HTML, subtype="html")
+text, info, _ = compare("alternative", m)
+check("alternative: section 1", info["section"] == "1" and info["type"] == "text/plain", str(info))
+
+# 4. plain + 20 MB attachment: only the text part goes over the wire
+m = base()
+m.set_content(QUESTION)
+m.add_attachment(b"\x00" * (20 * 1024 * 1024), maintype="application", subtype="pdf", filename="brochure.pdf")
+text, info, imap = compare("20MB attachment", m, max_sent=4096)
+
+# 5. text attachment before the body part is not taken for the body
+m = base()
+m.set_content(QUESTION)
+m.add_attachment("col1,col2\n1,2\n", subtype="csv", filename="data.csv")
+m.add_attachment("notes attached as text", filename="notes.txt")
+compare("text attachment", m)
+
+# 6. html alternative inside related with an inline image, plus an attachment
+m = base()
+m.set_content(HTML, subtype="html")
+m.add_related(b"\x89PNG" + b"\x00" * 5000, maintype="image", subtype="png", cid="<logo>")
+m.add_attachment(b"%PDF" + b"\x00" * 100_000, maintype="application", subtype="pdf", filename="a.pdf")
+text, info, _ = compare("related html + attachment", m, max_sent=2048)
+check("related: html section 1.1", info["section"] == "1.1" and info["type"] == "text/html", str(info))
+
+# 7. base64 / quoted-printable / non-UTF-8 charsets
+for cte in ("base64", "quoted-printable"):
+    m = base()
+    m.set_content("Bonjour, quel est le prix ? Merci. " * 20 + "café €", cte=cte)
+    compare(f"utf-8 {cte}", m)
+m = base()
+m.set_content("Prix du cours ? Réponse rapide svp.", charset="iso-8859-1", cte="quoted-printable")
+compare("latin-1 quoted-printable", m)
+m = base()
+m.set_content("価格はいくらですか？" * 10, charset="utf-8", cte="base64")
+compare("CJK base64", m)
+
+# 8. huge body: capped at IMAP_BODY_MAX_BYTES, decoded cleanly up to the cut
+for cte in ("base64", "quoted-printable", "8bit"):
+    m = base()
+    big = ("Ligne de question très longue avec accents éàü — " * 40 + "\n") * 400
+    m.set_content(big, cte=cte)
+    raw = m.as_bytes()
+    imap = FakeImap(raw)
+    text, info = fetch_body_text(imap, 101, max_bytes=65536)
+    check(f"capped {cte}: truncated, bounded", info["truncated"] and imap.sent <= 65536 + 1024, f"sent={imap.sent}")
+    check(f"capped {cte}: prefix of full text", big.startswith(text) and "�" not in text, f"len={len(text)}")
+
+# 9. only attachments: empty body, no download
+m = base()
+m.add_attachment(b"\x00" * 500_000, maintype="application", subtype="zip", filename="x.zip")
+raw = m.as_bytes()
+imap = FakeImap(raw)
+text, info = fetch_body_text(imap, 101)
+check("attachments only: empty, one round trip", text == "" and len(imap.commands) == 1, str(info))
+
+# 10. real-world BODYSTRUCTURE responses
+samples = [
+    # Gmail: alternative with extension data
+    ([b'12 (UID 7 RFC822.SIZE 5230 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 1250 30 NIL NIL NIL)'
+      b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 3100 60 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "000abc") NIL NIL))'],
+     "1", "text/plain", 5230),
+    # Outlook: mixed(alternative(plain, html), pdf attachment) with a literal file name
+    ([(b'3 (UID 9 RFC822.SIZE 912345 BODYSTRUCTURE ((("text" "plain" ("charset" "us-ascii") NIL NIL "7bit" 410 12 NIL NIL NIL NIL)'
+       b'("text" "html" ("charset" "us-ascii") NIL NIL "quoted-printable" 2300 40 NIL NIL NIL NIL) "alternative" ("boundary" "b2") NIL NIL NIL)'
+       b'("application" "pdf" ("name" {13}', b'fees "v2".pdf'),
+      b') NIL NIL "base64" 900000 NIL ("attachment" ("filename" "fees.pdf" "size" "657000")) NIL NIL) "mixed" ("boundary" "b1") NIL "en-US" NIL))'],
+     "1.1", "text/plain", 912345),
+    # attachment disposition on a text/plain part placed first
+    ([b'5 (UID 11 RFC822.SIZE 800 BODYSTRUCTURE (("text" "plain" ("name" "log.txt") NIL NIL "7bit" 300 8 NIL ("attachment" ("filename" "log.txt")) NIL NIL)'
+      b'("text" "plain" ("charset" "utf-8") NIL NIL "8bit" 120 3 NIL ("inline" NIL) NIL NIL) "mixed" ("boundary" "x") NIL NIL NIL))'],
+     "2", "text/plain", 800),
+    # single part, no extension data
+    ([b'1 (UID 2 RFC822.SIZE 400 BODYSTRUCTURE ("text" "html" ("charset" "windows-1252") NIL NIL "quoted-printable" 200 9))'],
+     "1", "text/html", 400),
+]
+for i, (data, section, ctype, size) in enumerate(samples, 1):
+    got_size, structure = parse_fetch_structure(data)
+    sec, info = select_text_part(structure) if structure else (None, None)
+    check(f"sample {i}: section {sec} {info and info['type']}", got_size == size and sec == section and info["type"] == ctype)
+
+# 11. unparsable BODYSTRUCTURE: falls back to the full message (small) / the capped body start (huge)
+class BrokenStructure(FakeImap):
+    def uid(self, cmd, uid, what):
+        if what == "(RFC822.SIZE BODYSTRUCTURE)":
+            self.commands.append(what)
+            return "OK", [f"1 (UID {uid} RFC822.SIZE {len(self.raw)} BODYSTRUCTURE (\"text\" ".encode()]
+        return super().uid(cmd, uid, what)
+
+
+m = base()
+m.set_content(QUESTION)
+imap = BrokenStructure(m.as_bytes())
+text, info = fetch_body_text(imap, 101)
+check("broken structure: full fetch fallback", info["mode"] == "full" and norm(text) == norm(QUESTION), str(info))
+m.add_attachment(b"\x00" * (3 * 1024 * 1024), maintype="application", subtype="pdf", filename="big.pdf")
+imap = BrokenStructure(m.as_bytes())
+text, info = fetch_body_text(imap, 101, max_bytes=65536)
+check("broken structure, 3 MB: capped body start", info["mode"] == "capped" and norm(text) == norm(QUESTION), str(info))
+check("broken structure, 3 MB: bytes sent bounded", imap.sent <= 65536 + 1024 and info["truncated"], f"sent={imap.sent}")
+
+print(f"failures={failures}")
+sys.exit(1 if failures else 0)
@@ -0,0 +1,154 @@
+"""
+Regression check: get_decision_snapshot() must agree with the individual worker helpers.
+
+Usage:
+    python check_decision_snapshot.py [org_id] [limit] [seed_threads]
+
+Compares every field for recent conversation_audit rows of the org plus a few edge
+cases (empty ids, unknown thread/sender). Exits with status 1 on any mismatch.
+
+The snapshot and the thread helpers both read conversation_threads, so the thread state
+(snapshot thread_recent, thread_needs_reply() used under the thread lock) and the
+conversation_threads row itself are checked against a direct conversation_audit aggregate
+instead (last IN / OUT per thread_key):
+on the org's existing threads, and on seed_threads random IN/OUT sequences written
+through log_conversation() under a scratch org id (deleted again at the end).
+"""
+import random
+import sys
+
+from sqlalchemy import text
+
+from app.db import SessionLocal, engine
+from app.services.decision_snapshot import get_decision_snapshot
+from app.services.observability import log_conversation
+import worker_imap as w
+
+ORG_ID = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+LIMIT = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+SEED_THREADS = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+SEED_ORG_ID = 987654321  # no such org: seeded rows are easy to find and delete
+COOLDOWN_HOURS = 24
+
+
+def helpers(org_id, message_id, thread_key, sender_email, hours):
+    return {
+        "already_replied": w.already_replied(org_id, message_id),
+        "sender_recent": w.replied_to_sender_recently(org_id, sender_email, hours=hours),
+    }
+
+
+def audit_thread(org_id, thread_key, hours):
+    """Thread state straight from conversation_audit (what conversation_threads must mirror)."""
+    with engine.connect() as conn:
+        r = conn.execute(text("""
+            SELECT MIN(created_at) AS first_at,
+                   MAX(created_at) FILTER (WHERE direction = 'IN') AS last_in_at,
+                   MAX(created_at) FILTER (WHERE direction = 'OUT') AS last_out_at,
+                   MAX(created_at) AS last_message_at,
+                   COUNT(*) AS message_count,
+                   COALESCE(MAX(created_at) FILTER (WHERE direction = 'OUT')
+                            >= (NOW() AT TIME ZONE 'utc') - (:hrs * INTERVAL '1 hour'), false) AS thread_recent
+            FROM conversation_audit
+            WHERE org_id = :oid AND thread_key = :tkey AND :tkey <> ''
+        """), {"oid": org_id, "tkey": thread_key or "", "hrs": int(hours)}).mappings().first()
+    r = dict(r)
+    last_in, last_out = r["last_in_at"], r["last_out_at"]
+    r["thread_needs_reply"] = (not thread_key) or last_out is None or bool(last_in and last_in > last_out)
+    return r
+
+
+def thread_row(org_id, thread_key):
+    with engine.connect() as conn:
+        r = conn.execute(text("""
+            SELECT first_at, last_in_at, last_out_at, last_message_at, message_count
+            FROM conversation_threads
+            WHERE org_id = :oid AND thread_key = :tkey
+        """), {"oid": org_id, "tkey": thread_key or ""}).mappings().first()
+    return dict(r) if r else None
+
+
+def compare_thread(org_id, thread_key, hours, exact_row=True) -> dict:
+    """Differences between snapshot / thread_needs_reply / conversation_threads and the audit aggregate."""
+    ref = audit_thread(org_id, thread_key, hours)
+    got = {
+        "thread_recent": get_decision_snapshot(engine, org_id, "", thread_key, "", hours)["thread_recent"],
+        "thread_needs_reply": w.thread_needs_reply(org_id, thread_key),
+    }
+    diff = {k: (got[k], ref[k]) for k in got if got[k] != ref[k]}
+    if thread_key and ref["message_count"]:
+        row = thread_row(org_id, thread_key) or {}
+        # Backfilled threads only know the rows that existed at migration time: compare
+        # counts / first_at exactly only for threads written through log_conversation.
+        keys = ("first_at", "last_in_at", "last_out_at", "last_message_at", "message_count") if exact_row \
+            else ("last_in_at", "last_out_at", "last_message_at")
+        diff.update({f"row.{k}": (row.get(k), ref[k]) for k in keys if row.get(k) != ref[k]})
+    return diff
+
+
+mismatches = 0
+
+# 1) existing rows of the org: non-thread fields vs helpers, thread fields vs audit aggregate
+with engine.connect() as conn:
+    rows = conn.execute(text("""
+        SELECT COALESCE(email_message_id, ''), COALESCE(thread_key, ''), COALESCE(customer_email, '')
+        FROM conversation_audit
+        WHERE org_id = :oid
+        ORDER BY created_at DESC
+        LIMIT :lim
+    """), {"oid": ORG_ID, "lim": LIMIT}).fetchall()
+
+cases = [tuple(r) for r in rows] + [
+    ("", "", ""),
+    ("no-such-id@example.com", "m:<no-such-thread@example.com>", "nobody@example.com"),
+]
+
+for mid, tkey, email in cases:
+    # snapshot first: it must not depend on rows the helpers create as a side effect
+    snap = get_decision_snapshot(engine, ORG_ID, mid, tkey, email, COOLDOWN_HOURS)
+    ref = helpers(ORG_ID, mid, tkey, email, COOLDOWN_HOURS)
+    diff = {k: (snap[k], ref[k]) for k in ref if snap[k] != ref[k]}
+    diff.update(compare_thread(ORG_ID, tkey, COOLDOWN_HOURS, exact_row=False))
+    if diff:
+        mismatches += 1
+        print("MISMATCH", (mid, tkey, email), diff)
+
+print(f"org={ORG_ID} cases={len(cases)} mismatches={mismatches}")
+
+# 2) seeded threads: random interleaved IN/OUT sequences through the real upsert
+rng = random.Random(7)
+keys = [f"s:check-{i:04d}" for i in range(SEED_THREADS)]
+script = [(k, d) for k in keys for d in rng.choices(("IN", "OUT"), weights=(3, 2), k=rng.randint(1, 6))]
+rng.shuffle(script)
+
+seed_mismatches = 0
+try:
+    for i, (tkey, direction) in enumerate(script):
+        db = SessionLocal()
+        try:
+            log_conversation(
+                db,
+                org_id=SEED_ORG_ID,
+                thread_key=tkey,
+                direction=direction,
+                customer_email=f"c{i}@check.example" if i % 5 else None,
+                subject=f"Check {i}",
+                body_text=f"message {i}",
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    for tkey in keys + ["s:check-missing"]:
+        for hours in (COOLDOWN_HOURS, 0):
+            diff = compare_thread(SEED_ORG_ID, tkey, hours)
+            if diff:
+                seed_mismatches += 1
+                print("SEED MISMATCH", (tkey, hours), diff)
+finally:
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM conversation_threads WHERE org_id = :oid"), {"oid": SEED_ORG_ID})
+        conn.execute(text("DELETE FROM conversation_audit WHERE org_id = :oid"), {"oid": SEED_ORG_ID})
+
+print(f"seeded threads={len(keys)} messages={len(script)} mismatches={seed_mismatches}")
+sys.exit(1 if mismatches or seed_mismatches else 0)
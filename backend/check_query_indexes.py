@@ -0,0 +1,167 @@
+"""
+Check that the worker's hot pre-send queries are served by the indexes added in
+4e8a1c6f0b27 (conversation_audit OUT sender / OUT message id, org_usage org+event+time):
+    replied_to_sender_recently()  -> ix_conversation_audit_out_sender
+    already_replied()             -> ix_conversation_audit_out_message
+    replies_sent_last_hour()      -> ix_org_usage_org_event_created
+    get_decision_snapshot()       -> both conversation_audit indexes
+
+The SQL is captured from the real helpers (not copied), then run under EXPLAIN ANALYZE.
+
+Usage:
+    python check_query_indexes.py              # current data, report only (plans on tiny tables mean little)
+    python check_query_indexes.py 10000000     # seed that many rows first, then assert
+
+Seeding runs in ONE transaction that is rolled back at the end (synthetic orgs, 4/5 of the rows
+in conversation_audit, 1/5 in org_usage). Use a scratch database: a 10M-row rollback still
+leaves dead tuples for autovacuum. With a seed, exits with status 1 when a query does not use its index.
+"""
+import sys
+import time
+
+from sqlalchemy import event, text
+
+from app.db import engine
+from app.services.decision_snapshot import get_decision_snapshot
+import worker_imap as w
+
+SEED_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+SEED_ORGS = 200
+SEED_SENDERS = 50000
+SEED_DAYS = 180
+COOLDOWN_HOURS = 24
+
+EXPECTED = {
+    "replied_to_sender_recently": {"ix_conversation_audit_out_sender"},
+    "already_replied": {"ix_conversation_audit_out_message"},
+    "replies_sent_last_hour": {"ix_org_usage_org_event_created"},
+    "get_decision_snapshot": {
+        "ix_conversation_audit_out_sender",
+        "ix_conversation_audit_out_message",
+    },
+}
+
+
+# ---------- seed ----------
+def seed(conn, rows: int) -> list:
+    org_ids = [
+        r[0]
+        for r in conn.execute(
+            text("""
+                INSERT INTO organizations (name)
+                SELECT 'index-check-' || g FROM generate_series(1, :n) AS g
+                RETURNING id
+            """),
+            {"n": SEED_ORGS},
+        ).fetchall()
+    ]
+    # Pairs of rows: IN then OUT for the same inbound Message-ID (what log_conversation writes).
+    # Mixed-case addresses so lower(customer_email) matters; timestamps spread over SEED_DAYS.
+    conn.execute(
+        text("""
+            INSERT INTO conversation_audit
+                (org_id, thread_key, customer_email, subject, direction, email_message_id, created_at)
+            SELECT (CAST(:orgs AS bigint[]))[1 + (g / 2) % :n_orgs],
+                   's:seed' || (g / 8),
+                   'Customer' || ((g / 2) % :senders) || '@Seed-Mail.example',
+                   'Question ' || (g / 8),
+                   CASE WHEN g % 2 = 0 THEN 'IN' ELSE 'OUT' END,
+                   '<seed' || (g / 2) || '@seed-mail.example>',
+                   now() - ((g / 2) * 7919 % (:days * 86400)) * INTERVAL '1 second'
+            FROM generate_series(CAST(0 AS bigint), :rows - 1) AS g
+        """),
+        {"orgs": org_ids, "n_orgs": len(org_ids), "senders": SEED_SENDERS, "days": SEED_DAYS, "rows": rows * 4 // 5},
+    )
+    conn.execute(
+        text("""
+            INSERT INTO org_usage (org_id, event, qty, created_at)
+            SELECT (CAST(:orgs AS int[]))[1 + g % :n_orgs],
+                   (ARRAY['reply_sent', 'reply_sent', 'smtp_failed', 'blocked_no_credits'])[1 + g % 4],
+                   1,
+                   now() - (g * 7919 % (:days * 86400)) * INTERVAL '1 second'
+            FROM generate_series(CAST(0 AS bigint), :rows - 1) AS g
+        """),
+        {"orgs": org_ids, "n_orgs": len(org_ids), "days": SEED_DAYS, "rows": rows // 5},
+    )
+    conn.execute(text("ANALYZE organizations"))
+    conn.execute(text("ANALYZE conversation_audit"))
+    conn.execute(text("ANALYZE org_usage"))
+    return org_ids
+
+
+# ---------- capture the helpers' SQL ----------
+captured = {}
+_label = [None]
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _capture(conn, cursor, statement, parameters, context, executemany):
+    if _label[0] and _label[0] not in captured:
+        captured[_label[0]] = (statement, parameters)
+
+
+def capture(label, fn, *args):
+    _label[0] = label
+    try:
+        fn(*args)
+    finally:
+        _label[0] = None
+
+
+def index_names(plan: dict) -> set:
+    out = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        out |= index_names(child)
+    return out
+
+
+# ---------- run ----------
+failures = 0
+with engine.connect() as conn:
+    trans = conn.begin()
+    try:
+        if SEED_ROWS:
+            t0 = time.time()
+            org_ids = seed(conn, SEED_ROWS)
+            print(f"seeded rows={SEED_ROWS} orgs={len(org_ids)} in {time.time() - t0:.1f}s (rolled back at exit)")
+            org_id = org_ids[0]
+        else:
+            org_id = conn.execute(text("SELECT COALESCE(MAX(org_id), 1) FROM conversation_audit")).scalar()
+
+        sample = conn.execute(
+            text("""
+                SELECT customer_email, email_message_id
+                FROM conversation_audit
+                WHERE org_id = :oid AND direction = 'OUT'
+                ORDER BY created_at DESC
+                LIMIT 1
+            """),
+            {"oid": org_id},
+        ).fetchone()
+        email = ((sample and sample[0]) or "nobody@example.com").strip().lower()
+        mid = (sample and sample[1]) or "<no-such-id@example.com>"
+
+        capture("replied_to_sender_recently", w.replied_to_sender_recently, org_id, email, COOLDOWN_HOURS)
+        capture("already_replied", w.already_replied, org_id, mid)
+        capture("replies_sent_last_hour", w.replies_sent_last_hour, org_id)
+        capture("get_decision_snapshot", get_decision_snapshot, engine, org_id, mid, "", email, COOLDOWN_HOURS)
+
+        for label, expected in EXPECTED.items():
+            if label not in captured:
+                failures += 1
+                print(f"FAIL {label}: no SQL captured (REDIS_URL set?)")
+                continue
+            statement, params = captured[label]
+            plan = conn.exec_driver_sql("EXPLAIN (ANALYZE, FORMAT JSON) " + statement, params).scalar()[0]
+            used = index_names(plan["Plan"])
+            missing = expected - used
+            failures += 1 if missing and SEED_ROWS else 0
+            print(
+                f"{'OK  ' if not missing else ('FAIL' if SEED_ROWS else 'WARN')} {label}: {plan['Execution Time']:.2f} ms"
+                f" indexes={sorted(used)}" + (f" missing={sorted(missing)}" if missing else "")
+            )
+    finally:
+        trans.rollback()
+
+print(f"org={org_id} failures={failures}")
+sys.exit(1 if failures else 0)
@@ -0,0 +1,101 @@
+"""
+Check the Redis fast path against Postgres.
+
+Usage:
+    python check_redis_fast.py [org_id]                 # in-process fake
+    REDIS_URL=redis://localhost:6379/15 python check_redis_fast.py [org_id]
+
+Uses its own key prefix, so it does not touch the worker's keys on a shared redis-server.
+"""
+import os
+import sys
+import time
+import uuid
+
+os.environ["REDIS_PREFIX"] = f"aimail-check-{uuid.uuid4().hex[:8]}"
+if not os.getenv("REDIS_URL"):
+    os.environ["REDIS_URL"] = "memory://"
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import redis_fast
+import worker_imap as w
+
+ORG_ID = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+failures = 0
+
+
+def check(name, got, want):
+    global failures
+    ok = got == want
+    failures += 0 if ok else 1
+    print(f"{'OK  ' if ok else 'FAIL'} {name}: got={got!r} expected={want!r}")
+
+
+def pg_unseen(mids):
+    redis_fast.set_redis_client(None)
+    saved, redis_fast.REDIS_URL = redis_fast.REDIS_URL, ""
+    try:
+        return w.processed_db_unseen(ORG_ID, mids)
+    finally:
+        redis_fast.REDIS_URL = saved
+        redis_fast.set_redis_client(client)
+
+
+def pg_rate():
+    redis_fast.set_redis_client(None)
+    saved, redis_fast.REDIS_URL = redis_fast.REDIS_URL, ""
+    try:
+        return w.replies_sent_last_hour(ORG_ID)
+    finally:
+        redis_fast.REDIS_URL = saved
+        redis_fast.set_redis_client(client)
+
+
+client = redis_fast.get_redis()
+print("backend:", type(client).__name__)
+
+# processed ids: known ids from PG plus new ones
+with engine.connect() as conn:
+    known = [r[0] for r in conn.execute(text(
+        "SELECT message_id FROM processed_message_ids WHERE org_id = :o ORDER BY created_at DESC LIMIT 20"
+    ), {"o": ORG_ID}).fetchall()]
+fresh = [f"check-{uuid.uuid4().hex}@example.com" for _ in range(3)]
+check("processed_unseen", redis_fast.processed_unseen(engine, ORG_ID, known + fresh), pg_unseen(known + fresh))
+
+w.processed_db_add(ORG_ID, fresh[0])
+check("processed_unseen after add", redis_fast.processed_unseen(engine, ORG_ID, fresh), pg_unseen(fresh))
+
+# hourly rate window
+check("replies_last_hour", redis_fast.replies_last_hour(engine, ORG_ID), pg_rate())
+
+# thread locks: owner re-enters, others are denied, expiry frees it
+tkey = f"check:{uuid.uuid4().hex}"
+check("lock first", redis_fast.try_lock(ORG_ID, tkey, "worker-a", 1), True)
+check("lock re-enter", redis_fast.try_lock(ORG_ID, tkey, "worker-a", 1), True)
+check("lock other", redis_fast.try_lock(ORG_ID, tkey, "worker-b", 1), False)
+time.sleep(1.1)
+check("lock expired, other takes it", redis_fast.try_lock(ORG_ID, tkey, "worker-b", 1), True)
+check("old owner cannot re-enter", redis_fast.try_lock(ORG_ID, tkey, "worker-a", 1), False)
+
+# Redis down: the thread lock fails closed instead of taking the reply_thread_locks row
+from app.services.thread_lock import try_acquire_thread_lock
+
+down_key = f"check:{uuid.uuid4().hex}"
+redis_fast._mark_down("check", RuntimeError("simulated outage"))
+check("lock while down", try_acquire_thread_lock(engine, ORG_ID, down_key, 60, "worker-a", 60), None)
+redis_fast._down_until = 0.0
+with engine.connect() as conn:
+    pg_rows = conn.execute(text("SELECT COUNT(*) FROM reply_thread_locks WHERE org_id = :o AND thread_key = :k"),
+                           {"o": ORG_ID, "k": down_key}).scalar()
+check("no Postgres lock row while down", pg_rows, 0)
+check("lock after recovery", try_acquire_thread_lock(engine, ORG_ID, down_key, 60, "worker-a", 60), True)
+
+# cleanup of the check's own PG row
+with engine.begin() as conn:
+    conn.execute(text("DELETE FROM processed_message_ids WHERE org_id = :o AND message_id = :m"),
+                 {"o": ORG_ID, "m": fresh[0]})
+
+print(f"failures={failures}")
+sys.exit(1 if failures else 0)
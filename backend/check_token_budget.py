@@ -0,0 +1,95 @@
+"""
+Check the prompt token budget (app/services/token_budget.py) on pathological inputs:
+very long threads, one giant exchange, a huge email body, a system prompt over budget,
+multi-byte text, and build_prompt() end to end.
+
+Usage:
+    python check_token_budget.py
+"""
+import sys
+
+from app.services.token_budget import (
+    BODY_MIN_TOKENS,
+    TRUNCATED_MARK,
+    USER_PROMPT_OVERHEAD_TOKENS,
+    allocate_prompt,
+    estimate_tokens,
+    truncate_to_tokens,
+)
+
+failures = 0
+
+
+def check(name, ok, detail=""):
+    global failures
+    failures += 0 if ok else 1
+    print(f"{'OK  ' if ok else 'FAIL'} {name}" + (f": {detail}" if detail else ""))
+
+
+def exchange(i, size):
+    return f"[{i}] (2026-03-01)\nCustomer:\n{'q' * size}\n\nAssistant:\n{'a' * size}\n"
+
+
+SYSTEM = "rules " * 400  # ~600 tokens
+BUDGET = 4000
+
+# 1. short inputs pass through untouched
+r = allocate_prompt(BUDGET, SYSTEM, "What are the fees?", ["kb one", "kb two"], [exchange(1, 50)])
+check("short: unchanged", r["body"] == "What are the fees?" and r["kb_chunks"] == ["kb one", "kb two"]
+      and r["thread"] == [exchange(1, 50)], str(r["dropped"]))
+
+# 2. 500 exchanges of 8k chars each: within budget, newest kept, chronological order
+thread = [exchange(i, 4000) for i in range(1, 501)]
+r = allocate_prompt(BUDGET, SYSTEM, "body", [], thread)
+check("long thread: within budget", r["tokens"]["total"] <= BUDGET, str(r["tokens"]))
+check("long thread: newest kept", bool(r["thread"]) and r["thread"][-1].startswith("[500]"))
+check("long thread: chronological", all(
+    int(a[1:a.index("]")]) < int(b[1:b.index("]")]) for a, b in zip(r["thread"], r["thread"][1:])))
+
+# 3. one giant latest exchange: truncated, not dropped
+r = allocate_prompt(BUDGET, SYSTEM, "body", [], [exchange(1, 10), exchange(2, 200_000)])
+check("giant exchange: kept truncated", len(r["thread"]) == 1 and r["thread"][0].endswith(TRUNCATED_MARK))
+check("giant exchange: within budget", r["tokens"]["total"] <= BUDGET, str(r["tokens"]))
+
+# 4. huge body (pasted log / forwarded chain): cut, but keeps its beginning and the slack
+body = "Hello, please see below.\n" + ("x" * 80 + "\n") * 5000
+r = allocate_prompt(BUDGET, SYSTEM, body, ["kb"], [])
+check("huge body: truncated", r["body"].startswith("Hello, please see below.") and r["body"].endswith(TRUNCATED_MARK))
+check("huge body: within budget", r["tokens"]["total"] <= BUDGET, str(r["tokens"]))
+check("huge body: uses slack", r["tokens"]["total"] >= BUDGET - 50, str(r["tokens"]))
+
+# 5. system prompt alone over budget: body keeps its minimum, history/KB dropped
+r = allocate_prompt(BUDGET, "s" * 40_000, "b" * 10_000, ["kb"], thread[:3])
+check("system over budget: body minimum", r["tokens"]["body"] >= BODY_MIN_TOKENS - 10, str(r["tokens"]))
+check("system over budget: no history", r["thread"] == [] and r["kb_chunks"] == [])
+
+# 6. KB chunks are taken in relevance order, whole chunks only
+kb = ["best " * 600, "second " * 200, "third " * 2000]
+r = allocate_prompt(BUDGET, SYSTEM, "body", kb, [])
+check("kb: best chunks first, whole", r["kb_chunks"] == kb[:2], str(r["dropped"]))
+
+# 7. multi-byte text is not under-estimated
+check("estimate: CJK ~1 token/char", estimate_tokens("价格" * 500) >= 1000, str(estimate_tokens("价格" * 500)))
+cut = truncate_to_tokens("价格是多少 " * 2000, 300)
+check("truncate: CJK within limit", estimate_tokens(cut) <= 300, str(estimate_tokens(cut)))
+
+# 8. build_prompt() end to end with a pathological thread and a large KB
+import worker_imap as w
+
+settings = {
+    "org_id": 0,
+    "settings_version": None,
+    "org_name": "Check Org",
+    "kb_text": "\n\n".join(f"Section {i}: course fees and duration details " + "lorem " * 150 for i in range(60)),
+    "prompt_token_budget": BUDGET,
+}
+system_prompt, user_prompt, max_tokens = w.build_prompt(
+    settings, "Fees?", "a@b.c", "What are the course fees?", [exchange(i, 4000) for i in range(1, 200)]
+)
+total = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+check("build_prompt: within budget", total <= BUDGET + USER_PROMPT_OVERHEAD_TOKENS, f"total={total}")
+check("build_prompt: email last", user_prompt.rstrip().endswith("What are the course fees?"))
+check("build_prompt: max_tokens set", max_tokens > 0, str(max_tokens))
+
+print(f"failures={failures}")
+sys.exit(1 if failures else 0)
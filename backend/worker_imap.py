@@ -20,29 +20,90 @@ import re
 import hashlib
 import time
 import imaplib
-import smtplib
 import uuid
 import socket
+import signal
 import traceback
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from email import message_from_bytes
+from email import message_from_string
 from email.policy import default
+from email.utils import make_msgid
 from email.message import EmailMessage
 
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 
 from app.db import engine, SessionLocal
-from app.services.billing_guard import get_remaining_credits, consume_credits, log_usage
+from app.services.billing_guard import get_credit_lease_manager, log_usage
 from app.services.observability import upsert_worker_status, log_conversation, now_utc
+from app.services.sync_state import get_sync_state, save_sync_state
+from app.services.imap_session import ImapSession
+from app.services.smtp_pool import smtp_pool
+from app.services.decision_snapshot import get_decision_snapshot
+from app.services import redis_fast
+from app.services.kb_index import KB_TOP_K, get_kb_index, kb_content_hash, use_full_kb
+from app.services.reply_cache import reply_cache, reply_cache_key
+from app.services.token_budget import allocate_prompt, estimate_tokens, org_prompt_budget
+from app.services.signal_matcher import SignalMatcher
+from app.services.imap_body import fetch_body_text
+from app.services.thread_index import (
+    index_thread_messages,
+    reply_references,
+    resolve_thread_key,
+    thread_message_ids,
+)
+from app.services.filter_rules import get_filter_rules_cache
+from app.services.job_queue import (
+    STAGE_GENERATE,
+    STAGE_DELIVER,
+    enqueue_job,
+    claim_jobs,
+    advance_job,
+    finish_job,
+    mark_in_logged,
+    retry_job,
+    defer_job,
+    count_open_jobs,
+    thread_has_open_job,
+)
+from app.services.org_settings_cache import get_org_settings_cache, get_auto_reply_enabled, with_trusted_identity
 from app.models import Organization, EmailAccount
 
 POLL_SECONDS = int(os.getenv("POLL_SECONDS", "60"))
 
+# Concurrency: how many mailboxes are processed at once (1 = old sequential behavior),
+# and how many of them may belong to the same org at the same time.
+WORKER_CONCURRENCY = max(1, int(os.getenv("WORKER_CONCURRENCY", "1")))
+WORKER_ORG_CONCURRENCY = max(1, int(os.getenv("WORKER_ORG_CONCURRENCY", "1")))
+
+# Max eligible emails handled per account per cycle (1 = old one-email-per-cycle behavior).
+WORKER_BATCH_SIZE = max(1, int(os.getenv("WORKER_BATCH_SIZE", "1")))
+
+# poll = reconnect to every mailbox each POLL_SECONDS (default)
+# idle = IMAP IDLE push per mailbox, polling only as fallback (see run_idle_forever)
+WORKER_MODE = (os.getenv("WORKER_MODE", "poll") or "poll").strip().lower()
+IDLE_FULL_SYNC_SECONDS = int(os.getenv("IDLE_FULL_SYNC_SECONDS", "900"))
+
+# Durable job queue (worker_jobs). Empty = old inline pipeline in one loop.
+# Otherwise a comma list of the stages this node runs, e.g. "ingest,generate,deliver",
+# or "generate" on an extra node that only scales out LLM calls.
+WORKER_STAGES = {s.strip().lower() for s in os.getenv("WORKER_STAGES", "").split(",") if s.strip()}
+QUEUE_MODE = bool(WORKER_STAGES)
+GENERATE_CONCURRENCY = max(1, int(os.getenv("GENERATE_CONCURRENCY", "2")))
+DELIVER_CONCURRENCY = max(1, int(os.getenv("DELIVER_CONCURRENCY", "2")))
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", "2"))
+GENERATE_VISIBILITY_SECONDS = int(os.getenv("GENERATE_VISIBILITY_SECONDS", "300"))
+DELIVER_VISIBILITY_SECONDS = int(os.getenv("DELIVER_VISIBILITY_SECONDS", "180"))
+# How long a job waits when it cannot run yet (rate limit, no credits, toggle off, thread busy)
+QUEUE_DEFER_SECONDS = int(os.getenv("QUEUE_DEFER_SECONDS", "300"))
+
 # --- Windows/Console UTF-8 safety (prevents UnicodeEncodeError) ---
 try:
     if hasattr(sys.stdout, "reconfigure"):
@@ -56,27 +117,39 @@ except Exception:
 DEBUG = os.getenv("DEBUG", "0") == "1"
 
 
-def processed_db_seen(org_id: int, message_id: str, days: int = 14) -> bool:
-    """Return True if (org_id,message_id) was seen in last N days."""
-    if not message_id:
-        return False
-    mid = message_id.strip().lower()
-    if mid.startswith("<") and mid.endswith(">"):
-        mid = mid[1:-1].strip()
+def processed_db_unseen(org_id: int, message_ids: list, days: int = 14) -> set:
+    """
+    Bulk version of processed_db_seen: one query for many Message-IDs.
+    Takes normalized ids (lowercase, no <>) and returns the subset NOT seen in the last N days.
+    On DB errors everything is treated as unseen (same as processed_db_seen returning False).
+    """
+    mids = {m for m in (message_ids or []) if m}
+    if not mids:
+        return set()
+    fast = redis_fast.processed_unseen(engine, org_id, mids, days=days)
+    if fast is not None:
+        return fast
     try:
-        with engine.begin() as conn:
-            row = conn.execute(text("""
-                SELECT 1
+        with engine.connect() as conn:
+            rows = conn.execute(text("""
+                SELECT message_id
                 FROM processed_message_ids
                 WHERE org_id = :org_id
-                  AND message_id = :mid
+                  AND message_id = ANY(:mids)
                   AND created_at >= (now() - (:days || ' days')::interval)
-                LIMIT 1
-            """), {"org_id": int(org_id), "mid": mid, "days": int(days)}).fetchone()
-        return bool(row)
+            """), {"org_id": int(org_id), "mids": list(mids), "days": int(days)}).fetchall()
+        return mids - {r[0] for r in rows}
     except Exception as e:
-        print(f"[DEBUG] processed_db_seen failed: {e!r}")
+        print(f"[DEBUG] processed_db_unseen failed: {e!r}")
+        return mids
+
+
+def processed_db_seen(org_id: int, message_id: str, days: int = 14) -> bool:
+    """Return True if (org_id,message_id) was seen in last N days."""
+    mid = norm_mid(message_id)
+    if not mid:
         return False
+    return mid not in processed_db_unseen(org_id, [mid], days=days)
 
 
 def processed_db_add(org_id: int, message_id: str):
@@ -95,6 +168,25 @@ def processed_db_add(org_id: int, message_id: str):
             """), {"org_id": int(org_id), "mid": mid})
     except Exception as e:
         print(f"[DEBUG] processed_db_add failed: {e!r}")
+    redis_fast.processed_add(org_id, mid)
+
+
+def processed_db_add_many(org_id: int, message_ids: list):
+    """Bulk processed_db_add for normalized ids (one INSERT)."""
+    mids = sorted({m for m in (message_ids or []) if m})
+    if not mids:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO processed_message_ids (org_id, message_id)
+                SELECT :org_id, mid FROM unnest(CAST(:mids AS text[])) AS mid
+                ON CONFLICT (org_id, message_id) DO NOTHING
+            """), {"org_id": int(org_id), "mids": mids})
+    except Exception as e:
+        print(f"[DEBUG] processed_db_add_many failed: {e!r}")
+    for mid in mids:
+        redis_fast.processed_add(org_id, mid)
 
 def draft_db_add_engine(engine, org_id: int, message_id: str, from_email: str, to_email: str, subject: str, body: str, draft_text: str):
     """
@@ -127,6 +219,48 @@ AIMAIL_DRAFT_ONLY = os.getenv('AIMAIL_DRAFT_ONLY', '1').strip()  # 1=draft-only,
 INBOX_FOLDER = "INBOX"
 SCAN_LAST_N = 30  # scan last N emails for a non-marketing one (reduce load)
 
+# Incremental sync: remember UIDVALIDITY + last UID per mailbox (imap_sync_state) and only
+# search UIDs above it. 0 = old UNSEEN/NEW/RECENT/SINCE search on every cycle.
+IMAP_INCREMENTAL_SYNC = os.getenv("IMAP_INCREMENTAL_SYNC", "1") != "0"
+MAX_NEW_UIDS = 50  # new UIDs considered per cycle (oldest first); the rest wait for the next cycle
+
+# Headers pulled for every candidate in ONE UID FETCH (Message-ID for dedupe + what the
+# header scan / bulk detector / filters look at).
+CANDIDATE_HEADER_FIELDS = (
+    "FROM SUBJECT DATE MESSAGE-ID REFERENCES IN-REPLY-TO LIST-UNSUBSCRIBE LIST-ID "
+    "PRECEDENCE AUTO-SUBMITTED FEEDBACK-ID X-AUTOREPLY X-AUTO-RESPONSE-SUPPRESS"
+)
+HEADER_FETCH_CHUNK = 50  # UIDs per FETCH round trip
+
+# Server-side SEARCH exclusions: mail the client-side checks would drop anyway (is_bulk_header
+# markers, noreply senders) never becomes a candidate. Probed once per IMAP host (see
+# server_prefilter_ok); unsupported servers and orgs with allow rules search unfiltered.
+IMAP_SEARCH_PREFILTER = os.getenv("IMAP_SEARCH_PREFILTER", "1") != "0"
+PREFILTER_PROBE_TTL_SECONDS = int(os.getenv("PREFILTER_PROBE_TTL_SECONDS", "21600"))
+PREFILTER_PROBE_UIDS = 200  # newest UIDs compared filtered vs unfiltered by the probe
+SEARCH_EXCLUDE_HEADERS = [
+    ("AUTO-SUBMITTED", "auto-generated"),
+    ("AUTO-SUBMITTED", "auto-replied"),
+    ("PRECEDENCE", "bulk"),
+    ("PRECEDENCE", "junk"),
+    ("PRECEDENCE", "list"),
+    ("LIST-ID", ""),  # empty string: any message that has the header
+    ("FEEDBACK-ID", ""),
+]
+SEARCH_EXCLUDE_FROM = ["noreply", "no-reply", "donotreply", "mailer-daemon", "postmaster"]
+
+# Outgoing SMTP (connections are pooled per account, see app/services/smtp_pool.py)
+SMTP_HOST = os.getenv("SMTP_HOST", "smtpout.secureserver.net")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_RETRIES = 3
+
+# OpenAI: our own retry loop (client-side retries off) so attempts and latency end up in conversation_audit
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRYABLE = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+
+# Credits are spent from per-org leased blocks (app.services.billing_guard.CreditLeaseManager)
+credit_leases = get_credit_lease_manager(engine)
+
 # ---------- logging (analytics-friendly) ----------
 LOGS_DIR = os.path.join(os.path.dirname(__file__), "logs")
 os.makedirs(LOGS_DIR, exist_ok=True)
@@ -168,6 +302,76 @@ IGNORE_SENDERS = [
     "sender-sib", "sendib", "mailchimp", "sendgrid.net", "campaign-", "email.",
 ]
 
+# ✅ Header-only bulk/list markers, in reporting order (is_bulk_header)
+BULK_HEADER_CHECKS = [
+    ("auto-submitted: auto-generated", "auto_generated"),
+    ("auto-submitted: auto-replied", "auto_replied"),
+    ("precedence: bulk", "precedence_bulk"),
+    ("precedence: junk", "precedence_junk"),
+    ("precedence: list", "precedence_list"),
+    ("list-id:", "list_id"),
+    ("feedback-id:", "feedback_id"),
+]
+
+# ✅ is_security_alert_email signals (subject + body + headers)
+AUTO_HEADER_SIGNALS = [
+    "auto-submitted: auto-generated", "auto-submitted: auto-replied",
+    "x-autoreply", "x-auto-response-suppress",
+    "precedence: bulk", "precedence: junk", "precedence: list",
+    "list-id:", "feedback-id:",
+]
+BOUNCE_SIGNALS = [
+    "mailer-daemon", "postmaster@", "delivery status notification", "undelivered mail",
+    "returned mail", "diagnostic-code:", "final-recipient:", "x-failed-recipients:",
+    "report-type=delivery-status", "message/delivery-status",
+]
+SECURITY_KEYWORDS = [
+    "security alert", "suspicious sign", "new sign-in", "new login", "unusual activity",
+    "verify your account", "password reset", "reset your password",
+    "2-step verification", "two-step verification", "verification code",
+    "one-time password", "otp",
+]
+
+# ✅ is_real_enquiry signals
+# Bulk signals: subject+from+headers only (NOT body); the first listed hit is the reported reason
+ENQUIRY_BULK_SIGNALS = [
+    "list-id", "list-help", "list-post",
+    "unsubscribe", "manage preferences", "view in browser",
+    "you are receiving this email because", "email preferences",
+    "newsletter", "promotion", "campaign", "marketing",
+]
+ENQUIRY_SUBJECT_SIGNALS = [
+    "web", "website", "design", "developer", "consultant",
+    "seo", "marketing", "app", "service", "quote", "pricing", "cost", "fees",
+]
+ENQUIRY_POSITIVE_SIGNALS = [
+    "enquiry", "inquiry", "quote", "quotation", "estimate",
+    "pricing", "price", "fees", "fee", "cost",
+    "demo", "trial", "meeting", "schedule", "call", "callback",
+    "support", "help", "issue", "problem", "error", "unable", "not working",
+    "refund", "cancel",
+    "admission", "join", "apply", "register",
+    "need", "require", "looking for", "want to", "i want", "i need",
+    "web design", "web developer", "developer", "consultant",
+    "ui", "ux", "digital marketing", "branding", "app development",
+]
+HUMAN_SIGNALS = ["hi", "hello", "dear", "please", "kindly", "thanks", "thank you", "?"]
+
+# Every filter needle in one matcher: each field is scanned once per message and the
+# filters below are set lookups on the hits (same results as the old per-needle `in` checks)
+_signal_matcher = SignalMatcher(
+    IGNORE_KEYWORDS + IGNORE_SENDERS + [n for n, _ in BULK_HEADER_CHECKS]
+    + AUTO_HEADER_SIGNALS + BOUNCE_SIGNALS + SECURITY_KEYWORDS
+    + ENQUIRY_BULK_SIGNALS + ENQUIRY_SUBJECT_SIGNALS + ENQUIRY_POSITIVE_SIGNALS + HUMAN_SIGNALS
+)
+_IGNORE_SET = frozenset(IGNORE_KEYWORDS + IGNORE_SENDERS)
+_AUTO_HEADER_SET = frozenset(AUTO_HEADER_SIGNALS)
+_BOUNCE_SET = frozenset(BOUNCE_SIGNALS)
+_SECURITY_SET = frozenset(SECURITY_KEYWORDS)
+_SUBJECT_SET = frozenset(ENQUIRY_SUBJECT_SIGNALS)
+_POSITIVE_SET = frozenset(ENQUIRY_POSITIVE_SIGNALS)
+_HUMAN_SET = frozenset(HUMAN_SIGNALS)
+
 # ---------- helpers ----------
 def read_text_file(path: str) -> str:
     p = Path(path)
@@ -213,17 +417,38 @@ def extract_email(from_header: str) -> str:
         return m.group(1).strip()
     return from_header.strip().strip('"')
 
+def _header_text(raw_headers) -> str:
+    # raw_headers can be dict-like or string; normalize
+    try:
+        return "\n".join([f"{k}: {v}" for k, v in (raw_headers or {}).items()]).lower()
+    except Exception:
+        return str(raw_headers or "").lower()
+
+
+def scan_signals(subject: str, sender: str, body: str, raw_headers) -> dict:
+    """
+    Filter signal hits per field, each lowercased field scanned once. Compute once per message
+    and pass as signals= to is_security_alert_email / is_real_enquiry.
+    """
+    s = (subject or "").lower()
+    b = (body or "").lower()
+    return {
+        "subject": _signal_matcher.hits(s),
+        "sender": _signal_matcher.hits((sender or "").lower()),
+        "headers": _signal_matcher.hits(_header_text(raw_headers)),
+        "body": _signal_matcher.hits(b),
+        "subject_len": len(s.strip()),
+        "body_len": len(b.strip()),
+    }
+
+
 def is_ignored_email(text_lower: str) -> bool:
     """
     Pass lowercase text. Returns True if it's marketing/system based on static lists.
     """
     if not text_lower:
         return False
-    if any(k in text_lower for k in IGNORE_KEYWORDS):
-        return True
-    if any(s in text_lower for s in IGNORE_SENDERS):
-        return True
-    return False
+    return not _IGNORE_SET.isdisjoint(_signal_matcher.hits(text_lower))
 
 
 def is_bulk_header(hdr_lower: str) -> tuple[bool, str]:
@@ -231,81 +456,30 @@ def is_bulk_header(hdr_lower: str) -> tuple[bool, str]:
     Header-only bulk/list detector (safe for pre-select). Returns (is_bulk, reason).
     Keep this STRICT. Do not use body text here.
     """
-    h = (hdr_lower or "").lower()
-    checks = [
-        ("auto-submitted: auto-generated", "auto_generated"),
-        ("auto-submitted: auto-replied", "auto_replied"),
-        ("precedence: bulk", "precedence_bulk"),
-        ("precedence: junk", "precedence_junk"),
-        ("precedence: list", "precedence_list"),
-                ("list-id:", "list_id"),
-        ("feedback-id:", "feedback_id"),
-    ]
-    for needle, reason in checks:
-        if needle in h:
+    hits = _signal_matcher.hits((hdr_lower or "").lower())
+    for needle, reason in BULK_HEADER_CHECKS:
+        if needle in hits:
             return True, reason
     return False, ""
 
-def is_security_alert_email(subject: str, body: str, raw_headers) -> bool:
+def is_security_alert_email(subject: str, body: str, raw_headers, signals: dict | None = None) -> bool:
     """
     STRICT system/security filter.
     Return True only when we are highly confident the message is automated security/system noise
     (bounces, delivery reports, auto-generated alerts, list mail).
     """
-    subj = (subject or "").lower()
-    text_ = (body or "").lower()
-
-    # raw_headers can be dict-like or string; normalize
-    try:
-        hdr_str = "\n".join([f"{k}: {v}" for k, v in (raw_headers or {}).items()]).lower()
-    except Exception:
-        hdr_str = str(raw_headers or "").lower()
-
-    combined = f"{subj}\n{text_}\n{hdr_str}"
+    if signals is None:
+        signals = scan_signals(subject, "", body, raw_headers)
+    combined = signals["subject"] | signals["body"] | signals["headers"]
 
     # Strong automated/system signals (headers)
-    auto_header_signals = (
-        "auto-submitted: auto-generated" in combined
-        or "auto-submitted: auto-replied" in combined
-        or "x-autoreply" in combined
-        or "x-auto-response-suppress" in combined
-        or "precedence: bulk" in combined
-        or "precedence: junk" in combined
-        or "precedence: list" in combined
-        or "list-id:" in combined
-        or "feedback-id:" in combined
-    )
+    auto_header_signals = not _AUTO_HEADER_SET.isdisjoint(combined)
 
     # Bounce / DSN / delivery failure patterns
-    bounce_signals = (
-        "mailer-daemon" in combined
-        or "postmaster@" in combined
-        or "delivery status notification" in combined
-        or "undelivered mail" in combined
-        or "returned mail" in combined
-        or "diagnostic-code:" in combined
-        or "final-recipient:" in combined
-        or "x-failed-recipients:" in combined
-        or "report-type=delivery-status" in combined
-        or "message/delivery-status" in combined
-    )
+    bounce_signals = not _BOUNCE_SET.isdisjoint(combined)
 
     # Security-alert style keywords (NOT enough alone to skip)
-    security_keywords = (
-        "security alert" in combined
-        or "suspicious sign" in combined
-        or "new sign-in" in combined
-        or "new login" in combined
-        or "unusual activity" in combined
-        or "verify your account" in combined
-        or "password reset" in combined
-        or "reset your password" in combined
-        or "2-step verification" in combined
-        or "two-step verification" in combined
-        or "verification code" in combined
-        or "one-time password" in combined
-        or "otp" in combined
-    )
+    security_keywords = not _SECURITY_SET.isdisjoint(combined)
 
     # The key rule:
     # - Always skip bounces/DSNs
@@ -323,103 +497,37 @@ def is_trusted_sender(sender_email: str, org_settings: dict) -> bool:
     Allow bypass of security/system filter for trusted senders.
     - Org support_email (if set)
     - Org domain (from website or support_email)
+    Uses trusted_emails / trusted_domain precomputed by the org settings cache.
     """
     se = (sender_email or "").strip().lower()
     if not se or "@" not in se:
         return False
 
-    trusted = set()
-
-    support_email = (org_settings.get("support_email") or "").strip().lower()
-    if support_email and "@" in support_email:
-        trusted.add(support_email)
-
-    website = (org_settings.get("website") or org_settings.get("website_url") or "").strip().lower()
-    org_domain = ""
-    if "://" in website:
-        org_domain = website.split("://", 1)[1].split("/", 1)[0]
-    elif website:
-        org_domain = website.split("/", 1)[0]
-
-    if support_email and "@" in support_email:
-        org_domain = support_email.split("@", 1)[1]
-
-    org_domain = (org_domain or "").replace("www.", "").strip()
-    if org_domain:
-        if se.endswith("@" + org_domain):
-            return True
-
-    return se in trusted
-
-def get_body_text(msg) -> str:
-    """
-    Prefer plain text. Avoid attachments.
-    """
-    try:
-        body_part = msg.get_body(preferencelist=("plain",))
-        if body_part:
-            return body_part.get_content() or ""
-    except Exception:
-        pass
+    if "trusted_domain" not in org_settings:
+        org_settings = with_trusted_identity(dict(org_settings))
 
-    try:
-        if msg.is_multipart():
-            for part in msg.walk():
-                ctype = part.get_content_type()
-                disp = str(part.get("Content-Disposition") or "").lower()
-                if "attachment" in disp:
-                    continue
-                if ctype == "text/plain":
-                    return part.get_content() or ""
-        else:
-            return msg.get_content() or ""
-    except Exception:
-        pass
+    org_domain = org_settings["trusted_domain"]
+    if org_domain and se.endswith("@" + org_domain):
+        return True
 
-    return ""
+    return se in org_settings["trusted_emails"]
 
 # ---------------------- Postgres-backed settings / history ----------------------
 def get_org_settings(org_id: int) -> dict:
     """
-    Load org settings from Postgres (organizations).
+    Load org settings from Postgres (organizations), via the in-process TTL cache.
     Keeps same return keys as old SQLite function, to avoid breaking logic.
     """
-    with SessionLocal() as db:
-        org = db.query(Organization).filter(Organization.id == org_id).first()
-
-    if not org:
-        return {
-            "org_name": f"Org{org_id}",
-            "support_name": f"Tenant{org_id} Support",
-            "support_email": "",
-            "website": "",
-            "website_url": "",
-            "kb_text": "",
-            "system_prompt": "",
-            "auto_reply": 1,
-            "auto_reply_enabled": 1,
-            "max_replies_per_hour": 10,
-            "cooldown_hours": 24,
-        }
-
-    return {
-        "org_name": (org.name or f"Org{org_id}"),
-        "support_name": (getattr(org, "support_name", None) or f"Tenant{org_id} Support"),
-        "support_email": (getattr(org, "support_email", None) or ""),
-        "website": (getattr(org, "website", None) or ""),
-        "website_url": (getattr(org, "website_url", None) or ""),
-        "kb_text": (getattr(org, "kb_text", None) or ""),
-        "system_prompt": (getattr(org, "system_prompt", None) or ""),
-        "auto_reply": int(getattr(org, "auto_reply", 1) or 1),
-        "auto_reply_enabled": 1 if bool(getattr(org, "auto_reply_enabled", True)) else 0,
-        "max_replies_per_hour": int(getattr(org, "max_replies_per_hour", 10) or 10),
-        "cooldown_hours": int(getattr(org, "cooldown_hours", 24) or 24),
-    }
+    return get_org_settings_cache().get(org_id)
 
 def replies_sent_last_hour(org_id: int) -> int:
     """
-    Count replies in last 60 minutes using org_usage table (Postgres).
+    Count replies in last 60 minutes using org_usage table (Postgres),
+    or the Redis sliding window when REDIS_URL is set.
     """
+    fast = redis_fast.replies_last_hour(engine, org_id)
+    if fast is not None:
+        return fast
     try:
         with engine.connect() as conn:
             res = conn.execute(
@@ -471,7 +579,7 @@ def make_thread_key(
 
 def replied_to_thread_recently(org_id: int, thread_key: str, hours: int) -> bool:
     """
-    Cooldown check: uses conversation_audit OUT rows (Postgres).
+    Cooldown check: last OUT of the thread (conversation_threads primary-key read).
     """
     if not thread_key:
         return False
@@ -481,12 +589,10 @@ def replied_to_thread_recently(org_id: int, thread_key: str, hours: int) -> bool
                 text(
                     """
                     SELECT 1
-                    FROM conversation_audit
+                    FROM conversation_threads
                     WHERE org_id = :oid
                       AND thread_key = :tkey
-                      AND direction = 'OUT'
-                      AND created_at >= (NOW() AT TIME ZONE 'utc') - (:hrs * INTERVAL '1 hour')
-                    LIMIT 1
+                      AND last_out_at >= (NOW() AT TIME ZONE 'utc') - (:hrs * INTERVAL '1 hour')
                     """
                 ),
                 {"oid": org_id, "tkey": thread_key, "hrs": int(hours)},
@@ -554,10 +660,8 @@ def thread_needs_reply(org_id: int, thread_key: str) -> bool:
             row = conn.execute(
                 text(
                     """
-                    SELECT
-                        MAX(CASE WHEN direction = 'IN' THEN created_at END) AS last_in,
-                        MAX(CASE WHEN direction = 'OUT' THEN created_at END) AS last_out
-                    FROM conversation_audit
+                    SELECT last_in_at, last_out_at
+                    FROM conversation_threads
                     WHERE org_id = :oid
                       AND thread_key = :tkey
                     """
@@ -585,21 +689,15 @@ def mark_replied(org_id: int, message_id: str):
     """
     return
 
-def mark_seen_by_relogin(a: EmailAccount, imap_host: str, imap_port: int, mid):
-    """
-    Because we logout before OpenAI (good), we re-login only to mark the chosen email as Seen.
-    Prevents repeated re-processing load.
-    """
-    try:
-        im = imaplib.IMAP4_SSL(imap_host, imap_port)
-        im.login(a.imap_username, a.imap_password)
-        im.select(INBOX_FOLDER)
-        im.store(mid, "+FLAGS", "\\Seen")
-        im.logout()
-    except Exception:
-        pass
-
-def send_smtp_safe(a: EmailAccount, to_email: str, subject: str, body: str) -> bool:
+def send_smtp_safe(
+    a: EmailAccount,
+    to_email: str,
+    subject: str,
+    body: str,
+    message_id: str | None = None,
+    in_reply_to: str | None = None,
+    references: str | None = None,
+) -> bool:
     if not to_email:
         return False
 
@@ -607,53 +705,61 @@ def send_smtp_safe(a: EmailAccount, to_email: str, subject: str, body: str) -> b
     msg_out["From"] = a.email
     msg_out["To"] = to_email
     msg_out["Subject"] = subject
+    if message_id:
+        msg_out["Message-ID"] = message_id
+    if in_reply_to:
+        msg_out["In-Reply-To"] = in_reply_to
+    if references:
+        msg_out["References"] = references
     msg_out.set_content(body)
 
-    for attempt in range(3):
+    for attempt in range(SMTP_RETRIES):
         try:
-            print(f"SMTP attempt {attempt+1}/3")
-            with smtplib.SMTP("smtpout.secureserver.net", 587, timeout=60) as smtp:
-                smtp.ehlo()
-                smtp.starttls()
-                smtp.ehlo()
-                time.sleep(1)
-                smtp.login(a.email, a.imap_password)
-                time.sleep(1)
-                smtp.send_message(msg_out)
+            print(f"SMTP attempt {attempt+1}/{SMTP_RETRIES}")
+            smtp_pool.send(SMTP_HOST, SMTP_PORT, a.email, a.imap_password, msg_out)
             print("SMTP SUCCESS")
             return True
         except Exception as e:
             print("SMTP ERROR:", repr(e))
-            time.sleep(3)
+            # The pool dropped the broken connection; back off before reconnecting.
+            if attempt + 1 < SMTP_RETRIES:
+                time.sleep(2 ** attempt)
 
     return False
 
-def load_thread_context(org_id: int, thread_key: str, limit: int = 6) -> str:
+# Safety cap per stored message; the prompt budget (app.services.token_budget) decides what is sent
+THREAD_MESSAGE_MAX_CHARS = 4000
+
+
+def load_thread_exchanges(org_id: int, thread_key: str, limit: int = 6) -> list:
     """
-    Thread context from Postgres conversation_audit (keeps similar formatting).
+    Thread history as formatted exchanges, oldest first (one Customer/Assistant pair each;
+    the last one may be a pending IN). Reads the rolling window in conversation_threads.
     """
     if not thread_key:
-        return ""
+        return []
+    cap = THREAD_MESSAGE_MAX_CHARS
 
     try:
         with engine.connect() as conn:
-            rows = conn.execute(
+            recent = conn.execute(
                 text(
                     """
-                    SELECT direction, body_text, created_at
-                    FROM conversation_audit
+                    SELECT recent_messages
+                    FROM conversation_threads
                     WHERE org_id = :oid AND thread_key = :tkey
-                    ORDER BY created_at DESC
-                    LIMIT :lim
                     """
                 ),
-                {"oid": org_id, "tkey": thread_key, "lim": int(limit) * 2},  # IN+OUT
-            ).fetchall()
+                {"oid": org_id, "tkey": thread_key},
+            ).scalar()
 
-        if not rows:
-            return ""
+        if not recent:
+            return []
 
-        rows = list(reversed(rows))
+        rows = [
+            (m.get("direction"), m.get("text"), datetime.fromisoformat(m["at"]) if m.get("at") else None)
+            for m in recent[-int(limit) * 2:]  # IN+OUT
+        ]
         chunks = []
         i = 1
         pending_in = None
@@ -670,7 +776,7 @@ def load_thread_context(org_id: int, thread_key: str, limit: int = 6) -> str:
                 ai = bt
                 if cust or ai:
                     chunks.append(
-                        f"[{i}] ({pending_time or ts})\nCustomer:\n{cust[:1200]}\n\nAssistant:\n{ai[:1200]}\n"
+                        f"[{i}] ({pending_time or ts})\nCustomer:\n{cust[:cap]}\n\nAssistant:\n{ai[:cap]}\n"
                     )
                     i += 1
                 pending_in = None
@@ -679,12 +785,23 @@ def load_thread_context(org_id: int, thread_key: str, limit: int = 6) -> str:
         # If we ended on an IN without OUT yet:
         if pending_in:
             chunks.append(
-                f"[{i}] ({pending_time or ''})\nCustomer:\n{pending_in[:1200]}\n\nAssistant:\n(pending)\n"
+                f"[{i}] ({pending_time or ''})\nCustomer:\n{pending_in[:cap]}\n\nAssistant:\n(pending)\n"
             )
 
-        return "\n".join(chunks).strip()
+        return chunks
     except Exception:
-        return ""
+        return []
+
+
+def format_thread_context(exchanges: list) -> str:
+    return "\n".join(exchanges).strip()
+
+
+def load_thread_context(org_id: int, thread_key: str, limit: int = 6) -> str:
+    """
+    Thread context from conversation_threads (keeps similar formatting).
+    """
+    return format_thread_context(load_thread_exchanges(org_id, thread_key, limit))
 
 # Keep these as no-op to avoid disturbing old flow/call sites.
 def store_conversation(*args, **kwargs):
@@ -693,71 +810,420 @@ def store_conversation(*args, **kwargs):
 def store_reply_log(*args, **kwargs):
     return
 
-def search_candidate_ids(imap, org_id: int) -> list:
+class SyncProgress:
+    """
+    Per-cycle bookkeeping for the incremental-sync cursor (imap_sync_state).
+    The cursor only moves past UIDs whose outcome is final, so emails left for a later
+    cycle (batch full, rate limit, no credits, errors) are searched again next time.
     """
-    Returns candidate IMAP message sequence IDs to process.
 
+    def __init__(self, uidvalidity: int, highestmodseq, last_uid: int, max_uid: int):
+        self.uidvalidity = uidvalidity
+        self.highestmodseq = highestmodseq
+        self.last_uid = last_uid      # cursor before this cycle
+        self.max_uid = max_uid        # highest UID in the mailbox right now
+        self.window = []              # UIDs (int) considered this cycle
+        self.final = set()
+        self.message_ids = {}         # UID (int) -> normalized Message-ID, from the candidate filter
+        self.complete = True          # False when more new UIDs exist than the window holds
+        self.bootstrap = False        # True when no valid cursor existed before this cycle
+
+    def done(self, uid):
+        self.final.add(int(uid))
+
+    def pending(self) -> list:
+        return [u for u in self.window if u not in self.final]
+
+    def final_message_ids(self) -> list:
+        return [self.message_ids[u] for u in self.final if u in self.message_ids]
+
+    def next_last_uid(self) -> int:
+        pending = self.pending()
+        if pending:
+            return max(self.last_uid, min(pending) - 1)
+        if self.complete:
+            return max(self.last_uid, self.max_uid)
+        return max([self.last_uid] + self.window)
+
+    def next_highestmodseq(self):
+        # Only trust HIGHESTMODSEQ as "nothing changed" marker when everything was handled.
+        if self.complete and not self.pending():
+            return self.highestmodseq
+        return None
+
+
+def _resp_int(imap, code: str):
+    try:
+        _, data = imap.response(code)
+        if data and data[-1] is not None:
+            v = data[-1]
+            v = v.decode() if isinstance(v, bytes) else str(v)
+            return int(v.split()[0])
+    except Exception:
+        pass
+    return None
+
+
+def enable_condstore(imap):
+    """Ask for HIGHESTMODSEQ on SELECT when the server supports CONDSTORE (RFC 7162)."""
+    try:
+        caps = {c.upper() for c in (imap.capabilities or ())}
+        if "CONDSTORE" in caps and "ENABLE" in caps:
+            imap.enable("CONDSTORE")
+    except Exception as e:
+        print(f"[DEBUG] ENABLE CONDSTORE failed: {e!r}")
+
+
+def search_exclusion_criteria() -> list:
+    """SEARCH keys for SEARCH_EXCLUDE_HEADERS / SEARCH_EXCLUDE_FROM (ANDed with the base criteria)."""
+    out = []
+    for field, value in SEARCH_EXCLUDE_HEADERS:
+        out += ["NOT", "HEADER", field, f'"{value}"']
+    for value in SEARCH_EXCLUDE_FROM:
+        out += ["NOT", "FROM", f'"{value}"']
+    return out
+
+
+def client_would_exclude(hdr: str) -> bool:
+    """What the server-side exclusions stand in for: is_bulk_header, or a noreply-style sender."""
+    hdr_l = (hdr or "").lower()
+    if is_bulk_header(hdr_l)[0]:
+        return True
+    sender = header_sender_subject(hdr)[0].lower()
+    return any(v in sender for v in SEARCH_EXCLUDE_FROM)
+
+
+_prefilter_hosts = {}  # host -> (supported, checked_at)
+_prefilter_lock = threading.Lock()
+
+
+def probe_server_prefilter(imap):
+    """
+    Compare the newest PREFILTER_PROBE_UIDS UIDs with and without the exclusions. Supported when
+    the server accepts the criteria and every UID it drops is one the client would drop too
+    (catches servers that reject HEADER "" or treat it as "matches everything").
+    Returns True / False, or None when the mailbox is too empty to tell.
+    """
+    try:
+        st, data = imap.uid("SEARCH", None, "UID", "*")
+        ids = data[0].split() if (st == "OK" and data and data[0]) else []
+        if not ids:
+            return None
+        hi = max(int(x) for x in ids)
+        window = f"{max(hi - PREFILTER_PROBE_UIDS + 1, 1)}:{hi}"
+
+        st, data = imap.uid("SEARCH", None, "UID", window)
+        every = {int(x) for x in (data[0].split() if (st == "OK" and data and data[0]) else [])}
+        st, data = imap.uid("SEARCH", None, "UID", window, *search_exclusion_criteria())
+        if st != "OK":
+            return False
+        kept = {int(x) for x in (data[0].split() if (data and data[0]) else [])}
+    except imaplib.IMAP4.abort:
+        raise
+    except Exception as e:
+        print(f"[DEBUG] prefilter probe failed: {e!r}")
+        return False
+
+    if not every:
+        return None
+    if not kept <= every:
+        return False
+    dropped = sorted(every - kept)[-HEADER_FETCH_CHUNK:]
+    if dropped:
+        try:
+            headers = fetch_headers_bulk(imap, dropped)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            print(f"[DEBUG] prefilter probe header fetch failed: {e!r}")
+            return False
+        if len(headers) < len(dropped) or not all(client_would_exclude(h) for h in headers.values()):
+            return False
+    return True
+
+
+def server_prefilter_ok(imap) -> bool:
+    """Cached per IMAP host for PREFILTER_PROBE_TTL_SECONDS."""
+    host = str(getattr(imap, "host", "") or "").lower()
+    now = time.monotonic()
+    with _prefilter_lock:
+        entry = _prefilter_hosts.get(host)
+    if entry and now - entry[1] < PREFILTER_PROBE_TTL_SECONDS:
+        return entry[0]
+
+    supported = probe_server_prefilter(imap)
+    if supported is None:
+        return False  # nothing to compare yet: search unfiltered, probe again next cycle
+    with _prefilter_lock:
+        _prefilter_hosts[host] = (supported, now)
+    logger.info(f"event=search_prefilter_probe host={host} supported={int(supported)}")
+    return supported
+
+
+def disable_server_prefilter(imap):
+    host = str(getattr(imap, "host", "") or "").lower()
+    with _prefilter_lock:
+        _prefilter_hosts[host] = (False, time.monotonic())
+
+
+def start_sync_progress(imap, a: EmailAccount):
+    """
+    Read UIDVALIDITY / UIDNEXT / HIGHESTMODSEQ after SELECT and load the stored cursor.
+    Returns (progress, state) where state is the stored cursor if it is still valid, else None.
+    progress is None when incremental sync is off or the server gives no UIDVALIDITY.
+    """
+    if not IMAP_INCREMENTAL_SYNC:
+        return None, None
+
+    uidvalidity = _resp_int(imap, "UIDVALIDITY")
+    if uidvalidity is None:
+        return None, None
+    highestmodseq = _resp_int(imap, "HIGHESTMODSEQ")
+    uidnext = _resp_int(imap, "UIDNEXT")
+
+    if uidnext:
+        max_uid = uidnext - 1
+    else:
+        max_uid = 0
+        try:
+            st, data = imap.uid("SEARCH", None, "UID", "*")
+            ids = data[0].split() if (st == "OK" and data and data[0]) else []
+            max_uid = max([int(x) for x in ids] or [0])
+        except Exception:
+            pass
+
+    try:
+        state = get_sync_state(engine, int(a.id))
+    except Exception as e:
+        print(f"[DEBUG] get_sync_state failed: {e!r}")
+        return None, None
+
+    if state and int(state["uidvalidity"]) != uidvalidity:
+        print(f"[SYNC] UIDVALIDITY changed {state['uidvalidity']} -> {uidvalidity}; resetting cursor")
+        state = None
+
+    last_uid = int(state["last_uid"]) if state else 0
+    progress = SyncProgress(uidvalidity, highestmodseq, last_uid, max_uid)
+    progress.bootstrap = state is None
+    return progress, state
+
+
+def commit_sync_progress(a: EmailAccount, progress):
+    if progress is None:
+        return
+    # Final UIDs the cursor may not move past yet (older ones pending or not looked at) are
+    # searched again next cycle: record them so the candidate filter skips them instead of
+    # filling limit_keep with emails that were already decided.
+    processed_db_add_many(int(a.org_id), progress.final_message_ids())
+    if progress.bootstrap and not progress.complete:
+        # First cycle failed half-way: do not persist a cursor at UID 0 (would rescan the mailbox)
+        return
+    try:
+        save_sync_state(
+            engine,
+            int(a.id),
+            int(a.org_id),
+            progress.uidvalidity,
+            progress.next_last_uid(),
+            progress.next_highestmodseq(),
+        )
+    except Exception as e:
+        print(f"[DEBUG] save_sync_state failed: {e!r}")
+
+
+_FETCH_UID_RE = re.compile(rb"UID (\d+)")
+_MESSAGE_ID_RE = re.compile(r"^Message-ID:\s*(.+)\s*$", re.I | re.M)
+
+
+def fetch_headers_bulk(imap, uids: list, fields: str = CANDIDATE_HEADER_FIELDS) -> dict:
+    """
+    Fetch the given header fields for many UIDs in one round trip.
+    Returns {uid(int): header_text}. UIDs the server did not return are missing from the dict.
+    Raises imaplib.IMAP4.error when the FETCH is not OK (so a failure is not read as "no headers").
+    """
+    out = {}
+    if not uids:
+        return out
+    uid_set = ",".join(u.decode() if isinstance(u, bytes) else str(u) for u in uids)
+    st, data = imap.uid("FETCH", uid_set, f"(UID BODY.PEEK[HEADER.FIELDS ({fields})])")
+    if st != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH headers failed: {st} {data!r}"[:300])
+    if not data:
+        return out
+
+    # data = [(b'1 (UID 101 BODY[...] {n}', b'hdr...'), b')', ...]; some servers send UID after the literal
+    for i, item in enumerate(data):
+        if not isinstance(item, tuple) or len(item) < 2:
+            continue
+        m = _FETCH_UID_RE.search(item[0] or b"")
+        if not m and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+            m = _FETCH_UID_RE.search(data[i + 1])
+        if not m:
+            continue
+        out[int(m.group(1))] = safe_decode(item[1]) or ""
+    return out
+
+
+def expunged_uids(imap, uids: list) -> set:
+    """UIDs (int) among `uids` the mailbox no longer has; an OK FETCH silently skips those."""
+    uid_set = ",".join(u.decode() if isinstance(u, bytes) else str(u) for u in uids)
+    st, data = imap.uid("SEARCH", None, "UID", uid_set)
+    if st != "OK":
+        raise imaplib.IMAP4.error(f"UID SEARCH failed: {st} {data!r}"[:300])
+    present = {int(x) for x in (data[0].split() if (data and data[0]) else [])}
+    return {int(u) for u in uids} - present
+
+
+def header_message_id(hdr: str) -> str:
+    m = _MESSAGE_ID_RE.search(hdr or "")
+    return norm_mid(m.group(1)) if m else ""
+
+
+def header_sender_subject(hdr: str) -> tuple[str, str]:
+    """Decoded From / Subject from a HEADER.FIELDS fetch (for org filter rules before the body fetch)."""
+    try:
+        h = message_from_string(hdr or "", policy=default)
+        return str(h.get("From", "") or ""), str(h.get("Subject", "") or "")
+    except Exception:
+        return "", ""
+
+
+def search_candidate_ids(imap, org_id: int, limit_keep: int = 10, progress=None, state=None) -> tuple[list, dict]:
+    """
+    Returns (candidate IMAP UIDs to process, {uid(int): header text}).
+    Headers for the candidates come from batched UID FETCHes (CANDIDATE_HEADER_FIELDS), so the
+    caller does not need to fetch them again.
+
+    Incremental (stored cursor for this UIDVALIDITY): UID SEARCH for UIDs above the cursor only,
+    or nothing at all when HIGHESTMODSEQ is unchanged since the last cycle.
+
+    Bootstrap / no cursor:
     Primary: UNSEEN / NEW / RECENT
-    Fallback: SINCE (last 2 days), take last MAX_IDS
+    Fallback: SINCE (last 2 days)
+    Only the newest limit_keep unprocessed UIDs are returned; when older ones were left out,
+    or a UID's headers could not be fetched, progress.complete is False so no cursor is saved
+    and the next cycle bootstraps again.
 
     Important: Pre-filter candidates by Message-ID against processed_message_ids,
                so we don't keep re-selecting already-processed emails.
+
+    Every SEARCH carries the server-side bulk/list exclusions when the host supports them and
+    the org has no allow rules (an allow rule may let list mail through); collect_batch still
+    runs is_bulk_header on whatever comes back.
     """
     try:
         print("[DEBUG] search_candidate_ids: about to imap.search(...)")
 
-        def _normalize_mid(mid: str) -> str:
-            mid = (mid or "").strip().lower()
-            if mid.startswith("<") and mid.endswith(">"):
-                mid = mid[1:-1].strip()
-            return mid
-
-        def _msgid_for(seq_id: bytes) -> str:
-            # Fetch ONLY Message-ID header (cheap)
-            try:
-                st, data = imap.fetch(seq_id, "(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])")
-                if st != "OK" or not data:
-                    return ""
-                for item in data:
-                    if isinstance(item, tuple) and item[1]:
-                        txt = item[1].decode(errors="ignore")
-                        m2 = re.search(r"^Message-ID:\s*(.+)\s*$", txt, re.I | re.M)
-                        return _normalize_mid(m2.group(1) if m2 else "")
-            except Exception:
-                return ""
-            return ""
-
-        def _filter_unprocessed(seq_ids: list, limit_keep: int = 10) -> list:
-            # iterate newest->oldest, keep only those NOT in processed DB
+        headers = {}
+        exclude = []
+        truncated = False   # last _filter_unprocessed call stopped at limit_keep before the oldest UID
+        undecided = False   # some UID had no header (fetch failed / left out): neither kept nor done
+        if IMAP_SEARCH_PREFILTER and not get_filter_rules_cache().get(org_id).has_allow and server_prefilter_ok(imap):
+            exclude = search_exclusion_criteria()
+        print(f"[DEBUG] search prefilter={'server' if exclude else 'client'}")
+
+        def _search(*criteria):
+            nonlocal exclude
+            if exclude:
+                try:
+                    st, msg = imap.uid("SEARCH", None, *criteria, *exclude)
+                    if st == "OK":
+                        return st, msg
+                except imaplib.IMAP4.abort:
+                    raise
+                except Exception as e:
+                    print(f"[DEBUG] prefiltered search failed: {e!r}")
+                # Server refused the exclusions after all: unfiltered from now on (client-side checks remain)
+                disable_server_prefilter(imap)
+                logger.info(f"event=search_prefilter_fallback org=org{org_id} criteria={' '.join(criteria)}")
+                exclude = []
+            return imap.uid("SEARCH", None, *criteria)
+
+        def _filter_unprocessed(uids: list, limit_keep: int = 10) -> list:
+            # iterate newest->oldest in chunks (one FETCH per chunk), keep only those NOT in processed DB
+            nonlocal truncated, undecided
+            truncated = False
             keep = []
-            for sid in reversed(seq_ids):
-                mid = _msgid_for(sid)
+            newest_first = list(reversed(uids))
+            for i in range(0, len(newest_first), HEADER_FETCH_CHUNK):
+                chunk = newest_first[i:i + HEADER_FETCH_CHUNK]
+                gone = set()
                 try:
-                    dbg_mid = mid
-                    dbg_seen = processed_db_seen(org_id, mid) if mid else None
-                    print('[FILT] sid=%s mid=%s seen=%s' % (sid, dbg_mid, dbg_seen))
+                    headers.update(fetch_headers_bulk(imap, chunk))
+                    missing = [uid for uid in chunk if int(uid) not in headers]
+                    if missing:
+                        # OK FETCH without some UIDs: expunged meanwhile (final) or left out (retry)
+                        gone = expunged_uids(imap, missing)
+                except imaplib.IMAP4.abort:
+                    raise
                 except Exception as e:
-                    print('[FILT] sid=%s mid=<err> seen=<err> e=%r' % (sid, e))
-                if not mid:
-                    continue
-                # processed_db_seen stores lowercased string; we pass normalized no-brackets ID
-                if processed_db_seen(org_id, mid):
-                    continue
-                keep.append(sid)
-                if len(keep) >= limit_keep:
-                    break
+                    print(f"[DEBUG] bulk header fetch failed: {e!r}")
+                if progress is not None:
+                    for uid in gone:
+                        progress.done(uid)
+                # No header at all is not "no Message-ID": leave those UIDs pending so the
+                # cursor stays below them and the next cycle fetches them again
+                fetched = [uid for uid in chunk if int(uid) in headers]
+                if len(fetched) + len(gone) < len(chunk):
+                    undecided = True
+                    print(f"[DEBUG] no header for {len(chunk) - len(fetched) - len(gone)}/{len(chunk)} UIDs; left pending")
+                chunk_mids = {uid: header_message_id(headers[int(uid)]) for uid in fetched}
+                if progress is not None:
+                    progress.message_ids.update({int(uid): mid for uid, mid in chunk_mids.items() if mid})
+                # one query for the whole chunk (ids are normalized: lowercase, no <>)
+                unseen = processed_db_unseen(org_id, list(chunk_mids.values()))
+                for uid in fetched:
+                    mid = chunk_mids[uid]
+                    seen = (mid not in unseen) if mid else None
+                    print('[FILT] uid=%s mid=%s seen=%s' % (uid, mid, seen))
+                    if not mid or seen:
+                        if progress is not None:
+                            progress.done(uid)
+                        continue
+                    keep.append(uid)
+                    if len(keep) >= limit_keep:
+                        # older UIDs were not looked at
+                        truncated = uid != newest_first[-1]
+                        return list(reversed(keep))  # oldest->newest
             return list(reversed(keep))  # oldest->newest
 
+        # 0) Incremental: only UIDs newer than the stored cursor
+        if progress is not None and state is not None:
+            if (
+                progress.highestmodseq is not None
+                and state.get("highestmodseq") is not None
+                and int(state["highestmodseq"]) == progress.highestmodseq
+            ):
+                print(f"[SYNC] HIGHESTMODSEQ unchanged ({progress.highestmodseq}); nothing new")
+                return [], headers
+
+            st, msg = _search("UID", f"{progress.last_uid + 1}:*")
+            uids = msg[0].split() if (st == "OK" and msg and msg[0]) else []
+            # "n:*" always matches the highest UID, even when it is below n
+            uids = sorted((u for u in uids if int(u) > progress.last_uid), key=int)
+            window = uids[:MAX_NEW_UIDS]
+            progress.window = [int(u) for u in window]
+            progress.complete = len(uids) <= MAX_NEW_UIDS
+            print(f"[SYNC] cursor={progress.last_uid} new={len(uids)} window={len(window)} max_uid={progress.max_uid}")
+            if not window:
+                return [], headers
+            return _filter_unprocessed(window, limit_keep=limit_keep), headers
+
         # 1) Primary: UNSEEN / NEW / RECENT
         for q in ("UNSEEN", "NEW", "RECENT"):
             try:
-                st, msg = imap.search(None, q)
+                st, msg = _search(q)
                 ids = msg[0].split() if (st == "OK" and msg and msg[0]) else []
                 print(f"[DEBUG] imap.search {q} status={st} raw_len={len(msg[0]) if (msg and msg[0]) else 0} count={len(ids)}")
                 if ids:
-                    filtered = _filter_unprocessed(ids, limit_keep=10)
+                    filtered = _filter_unprocessed(ids, limit_keep=limit_keep)
                     if filtered:
-                        return filtered
+                        if progress is not None:
+                            progress.window = [int(u) for u in filtered]
+                            progress.complete = not (truncated or undecided)
+                        return filtered, headers
+            except imaplib.IMAP4.abort:
+                raise
             except Exception as e:
                 print(f"[DEBUG] imap.search {q} failed: {e!r}")
 
@@ -767,125 +1233,115 @@ def search_candidate_ids(imap, org_id: int) -> list:
         since_str = since_dt.strftime("%d-%b-%Y")  # IMAP date format
 
         try:
-            st2, msg2 = imap.search(None, "SINCE", since_str)
+            st2, msg2 = _search("SINCE", since_str)
             ids2 = msg2[0].split() if (st2 == "OK" and msg2 and msg2[0]) else []
             print(f"[DEBUG] imap.search SINCE {since_str} status={st2} raw_len={len(msg2[0]) if (msg2 and msg2[0]) else 0} count={len(ids2)}")
 
-            MAX_IDS = 50
-            tail = ids2[-MAX_IDS:]
-            filtered = _filter_unprocessed(tail, limit_keep=10)
+            # Walk the whole SINCE result newest->oldest (processed ones are skipped), so repeated
+            # bootstrap cycles reach older unprocessed mail instead of re-reading the same tail
+            filtered = _filter_unprocessed(ids2, limit_keep=limit_keep)
+            if progress is not None:
+                progress.window = [int(u) for u in filtered]
+                progress.complete = not (truncated or undecided)
             try:
-                dropped = [x for x in tail if x not in filtered]
-                if dropped:
-                    print('[CANDS_DROP] dropped=%s' % (dropped[-20:],))
+                print('[CANDS] since_raw=%s after_filter=%s truncated=%s keep_last10=%s' % (len(ids2), len(filtered), truncated, filtered[-10:]))
             except Exception:
                 pass
-            try:
-                print('[CANDS] since_raw=%s tail=%s after_filter=%s keep_last10=%s' % (len(ids2), len(tail), len(filtered), filtered[-10:]))
-            except Exception:
-                pass
-            return filtered
+            return filtered, headers
+        except imaplib.IMAP4.abort:
+            raise
         except Exception as e:
             print(f"[DEBUG] imap.search SINCE failed: {e!r}")
 
+    except imaplib.IMAP4.abort:
+        # Dead connection: let process_account report it instead of carrying on with no candidates
+        raise
     except Exception as e:
         print(f"[DEBUG] search_candidate_ids exception: {e!r}")
+        if progress is not None:
+            # Unknown state: keep the cursor where it is
+            progress.window = []
+            progress.complete = False
 
-    return []
+    return [], {}
 
 
 # ---------- main ----------
 replied_mids_this_run = set()
 replied_threads_this_run = set()
 
+# Threads currently being handled by THIS process. The Postgres thread lock lets the same
+# worker_id re-enter, so with concurrent accounts we also need an in-process guard.
+_inflight_threads = set()
+_inflight_lock = threading.Lock()
+
+def claim_inflight_thread(org_id: int, thread_key: str) -> bool:
+    if not thread_key:
+        return True
+    k = (int(org_id), thread_key.strip().lower())
+    with _inflight_lock:
+        if k in _inflight_threads:
+            return False
+        _inflight_threads.add(k)
+        return True
+
+def release_inflight_thread(org_id: int, thread_key: str):
+    if not thread_key:
+        return
+    with _inflight_lock:
+        _inflight_threads.discard((int(org_id), thread_key.strip().lower()))
+
 def is_real_enquiry(
     subject: str,
     sender: str,
     body: str,
     raw_headers: str = "",
     trusted_sender: bool = False,
-) -> bool:
-    s = (subject or "").lower().strip()
-    f = (sender or "").lower().strip()
-    b = (body or "").lower().strip()
-    h = (raw_headers or "").lower().strip()
-
-    combined = "\n".join([s, f, h, b])
-    combined_h = "\n".join([s, f, h])
-
-    # debug reason tracker
-    is_real_enquiry.last_reason = ""
+    signals: dict | None = None,
+) -> tuple[bool, str]:
+    """
+    (is_enquiry, reason). reason is "bulk:<signal>", "security_alert", "ignored_static", "ok",
+    or "" when nothing enquiry-like was found. Returned, not stored: accounts run concurrently.
+    """
+    if signals is None:
+        signals = scan_signals(subject, sender, body, raw_headers)
+    hits_h = signals["subject"] | signals["sender"] | signals["headers"]
+    hits = hits_h | signals["body"]
 
     # Bulk signals: check ONLY subject+from+headers (NOT body)
-    bulk_signals = [
-        "list-id", "list-help", "list-post",
-        "unsubscribe", "manage preferences", "view in browser",
-        "you are receiving this email because", "email preferences",
-        "newsletter", "promotion", "campaign", "marketing",
-    ]
-    hit = next((x for x in bulk_signals if x in combined_h), None)
+    hit = next((x for x in ENQUIRY_BULK_SIGNALS if x in hits_h), None)
     if hit and (not trusted_sender):
-        is_real_enquiry.last_reason = f"bulk:{hit}"
-        return False
+        return False, f"bulk:{hit}"
 
     # Strict security/system filter (bypass for trusted)
-    if (not trusted_sender) and is_security_alert_email(subject, body, raw_headers):
-        is_real_enquiry.last_reason = "security_alert"
-        return False
+    if (not trusted_sender) and is_security_alert_email(subject, body, raw_headers, signals=signals):
+        return False, "security_alert"
 
     # Static ignore lists (keywords + senders). This checks combined (includes body)
-    ignored = is_ignored_email(combined)
+    ignored = not _IGNORE_SET.isdisjoint(hits)
     if DEBUG:
         print(f"[DEBUG is_real_enquiry] ignored={ignored} trusted_sender={trusted_sender}")
 
     if (not trusted_sender) and ignored:
-        is_real_enquiry.last_reason = "ignored_static"
-        return False
+        return False, "ignored_static"
 
     # Subject contains enquiry-like signals
-    if 3 <= len(s) <= 90:
-        subject_signals = [
-            "web", "website", "design", "developer", "consultant",
-            "seo", "marketing", "app", "service", "quote", "pricing", "cost", "fees"
-        ]
-        if any(x in s for x in subject_signals):
-            is_real_enquiry.last_reason = "ok"
-            return True
+    if 3 <= signals["subject_len"] <= 90:
+        if not _SUBJECT_SET.isdisjoint(signals["subject"]):
+            return True, "ok"
 
     # Positive intent signals anywhere in combined
-    positive = [
-        "enquiry", "inquiry", "quote", "quotation", "estimate",
-        "pricing", "price", "fees", "fee", "cost",
-        "demo", "trial", "meeting", "schedule", "call", "callback",
-        "support", "help", "issue", "problem", "error", "unable", "not working",
-        "refund", "cancel",
-        "admission", "join", "apply", "register",
-        "need", "require", "looking for", "want to", "i want", "i need",
-        "web design", "web developer", "developer", "consultant",
-        "ui", "ux", "digital marketing", "branding", "app development",
-    ]
-    if any(p in combined for p in positive):
-        is_real_enquiry.last_reason = "ok"
-        return True
+    if not _POSITIVE_SET.isdisjoint(hits):
+        return True, "ok"
 
-    # Human-ish short body with question
-    if 20 <= len(b) <= 600:
-        human_signals = ["hi", "hello", "dear", "please", "kindly", "thanks", "thank you"]
-        if any(hs in b for hs in human_signals) or "?" in b:
-            is_real_enquiry.last_reason = "ok"
-            return True
+    # Human-ish short body with greeting/politeness or a question
+    if 20 <= signals["body_len"] <= 600:
+        if not _HUMAN_SET.isdisjoint(signals["body"]):
+            return True, "ok"
 
-    return False
-
-def build_prompt(org_settings: dict, subject: str, sender: str, body: str, thread_context: str) -> tuple[str, str]:
-    kb_text = (org_settings.get("kb_text") or "").strip()
-    org_name = (org_settings.get("org_name") or org_settings.get("name") or "our institute").strip()
-    support_name = (org_settings.get("support_name") or "Support Team").strip()
-    support_email = (org_settings.get("support_email") or "").strip()
-    website = (org_settings.get("website") or org_settings.get("website_url") or "").strip()
-    base_sys = (org_settings.get("system_prompt") or "").strip()
+    return False, ""
 
-    GLOBAL_BASE_SYSTEM_PROMPT = """
+GLOBAL_BASE_SYSTEM_PROMPT = """
 You are an AI email support assistant inside a multi-tenant SaaS platform.
 
 NON-NEGOTIABLE RULES:
@@ -896,6 +1352,44 @@ NON-NEGOTIABLE RULES:
 5) Keep replies concise, structured, and actionable. Prefer bullet points.
 """.strip()
 
+# Per-org system prompt prefix, keyed by org settings version (see build_prompt_prefix)
+PROMPT_PREFIX_CACHE_SIZE = 256
+_prompt_prefix_cache: "OrderedDict[str, str]" = OrderedDict()
+_prompt_prefix_lock = threading.Lock()
+
+
+def _prompt_prefix_key(org_settings: dict) -> str:
+    version = org_settings.get("settings_version")
+    if version:
+        return f"{org_settings.get('org_id')}:{version}"
+    raw = "\x1f".join(
+        str(org_settings.get(k) or "")
+        for k in ("org_name", "support_name", "support_email", "website", "website_url", "system_prompt", "kb_text")
+    )
+    return "h:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def build_prompt_prefix(org_settings: dict) -> str:
+    """
+    Stable system prompt for one org: global rules, org system prompt, policy, website, KB
+    (large KBs are not in the prefix: their relevant chunks go into the user prompt).
+    Identical bytes for every email of the org (provider-side prefix caching), built once per
+    org settings version and kept in a small LRU.
+    """
+    key = _prompt_prefix_key(org_settings)
+    with _prompt_prefix_lock:
+        cached = _prompt_prefix_cache.get(key)
+        if cached is not None:
+            _prompt_prefix_cache.move_to_end(key)
+            return cached
+
+    kb_text = (org_settings.get("kb_text") or "").strip()
+    org_name = (org_settings.get("org_name") or org_settings.get("name") or "our institute").strip()
+    support_name = (org_settings.get("support_name") or "Support Team").strip()
+    support_email = (org_settings.get("support_email") or "").strip()
+    website = (org_settings.get("website") or org_settings.get("website_url") or "").strip()
+    base_sys = (org_settings.get("system_prompt") or "").strip()
+
     policy = f"""
 You are the official email support assistant for {org_name}.
 
@@ -910,639 +1404,1200 @@ Hard rules:
   {support_email}
 """.strip()
 
-    system_prompt = (
+    prefix = (
         GLOBAL_BASE_SYSTEM_PROMPT
         + "\n\n"
         + base_sys
         + "\n\n"
         + policy
+        + "\n\nORG WEBSITE (reference only):\n"
+        + (website if website else "(not provided)")
         + "\n\nKB:\n"
-        + kb_text
+        + (
+            (kb_text if kb_text else "(not provided)")
+            if use_full_kb(kb_text)
+            else "(large KB: the sections relevant to each email are given in the user message under KB EXCERPTS)"
+        )
     ).strip()
 
-    user_prompt = f"""INCOMING EMAIL
-Subject: {subject}
-From: {sender}
+    with _prompt_prefix_lock:
+        _prompt_prefix_cache[key] = prefix
+        while len(_prompt_prefix_cache) > PROMPT_PREFIX_CACHE_SIZE:
+            _prompt_prefix_cache.popitem(last=False)
+    return prefix
 
-Message:
-{body}
 
-ORG WEBSITE (reference only):
-{website if website else "(not provided)"}
+# An answered exchange in load_thread_context() output (not just the current pending IN)
+_COMPLETED_EXCHANGE_RE = re.compile(r"Assistant:\n(?!\(pending\))")
+
+# Per-thread stats of the last build_prompt() call (for the prompt_tokens log line)
+_prompt_stats = threading.local()
+
+
+def kb_excerpts(org_settings: dict, subject: str, body: str) -> list:
+    """
+    Top-k KB chunks for this email as (position in KB, chunk), best first (BM25, index rebuilt
+    when the KB changes). [] = KB is in the prefix.
+    """
+    kb_text = (org_settings.get("kb_text") or "").strip()
+    if use_full_kb(kb_text):
+        return []
+    idx = get_kb_index(int(org_settings.get("org_id") or 0), kb_text)
+    ranked = [(i, idx.chunks[i]) for i, _ in idx.search(f"{subject}\n{body}", k=KB_TOP_K)]
+    if not ranked:
+        # Nothing matched (e.g. "please send details"): the first sections are usually the overview
+        ranked = list(enumerate(idx.chunks[:2]))
+    logger.info(
+        f"event=kb_retrieval org=org{org_settings.get('org_id')} chunks={len(idx.chunks)} selected={len(ranked)} "
+        f"kb_tokens={estimate_tokens(kb_text)} selected_tokens={estimate_tokens(''.join(c for _, c in ranked))}"
+    )
+    return ranked
+
+
+def build_prompt(
+    org_settings: dict, subject: str, sender: str, body: str, thread_exchanges: list
+) -> tuple[str, str, int]:
+    """
+    System prompt = cached per-org prefix (small KB included once).
+    User prompt = only the per-email part: relevant KB excerpts (large KB), thread context,
+    and the new email last, fitted into the org's prompt token budget (app.services.token_budget).
+    Returns (system_prompt, user_prompt, max_tokens for the reply).
+    """
+    system_prompt = build_prompt_prefix(org_settings)
+
+    ranked = kb_excerpts(org_settings, subject, body)
+    alloc = allocate_prompt(
+        org_prompt_budget(org_settings),
+        system_prompt,
+        body,
+        [c for _, c in ranked],
+        thread_exchanges,
+    )
+    # Selected chunks back in KB order so related sections read naturally
+    keep = set(alloc["kb_chunks"])
+    excerpts = [c for _, c in sorted(ranked) if c in keep]
+    kb_part = ""
+    if excerpts:
+        kb_part = "KB EXCERPTS (most relevant to this email):\n" + "\n\n---\n\n".join(excerpts) + "\n\n"
+    _prompt_stats.kb_excerpt_tokens = estimate_tokens("".join(excerpts))
+
+    thread_context = format_thread_context(alloc["thread"])
+    tk, dropped = alloc["tokens"], alloc["dropped"]
+    logger.info(
+        f"event=prompt_budget org=org{org_settings.get('org_id')} budget={tk['budget']} system={tk['system']} "
+        f"body={tk['body']} kb={tk['kb']} thread={tk['thread']} total={tk['total']} max_tokens={alloc['max_tokens']} "
+        f"dropped_body_tokens={dropped['body_tokens']} dropped_kb_chunks={dropped['kb_chunks']} "
+        f"dropped_exchanges={dropped['thread_exchanges']}"
+    )
 
-RECENT THREAD CONTEXT (latest first):
+    user_prompt = kb_part + f"""RECENT THREAD CONTEXT (latest first):
 {thread_context if thread_context else "(none)"}
 
-ORG KNOWLEDGE BASE (KB):
-{kb_text if kb_text else "(not provided)"}
+INCOMING EMAIL
+Subject: {subject}
+From: {sender}
+
+Message:
+{alloc["body"]}
 """
-    return system_prompt, user_prompt
+    return system_prompt, user_prompt, alloc["max_tokens"]
+
+def load_active_accounts() -> list:
+    with Session(engine) as db:
+        accounts = (
+            db.query(EmailAccount)
+            .join(Organization, EmailAccount.org_id == Organization.id)
+            .filter(Organization.auto_reply_enabled == True)
+            .all()
+        )
+    print(f"[DEBUG] accounts_found={len(accounts)}")
+    return accounts
+
 
 def main():
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
     # Initial heartbeat
+    report_worker_status()
+    credit_leases.release_expired()
+
+    accounts = load_active_accounts()
+    run_accounts(accounts, client, model)
+
+
+def run_idle_forever():
+    """
+    WORKER_MODE=idle: keep an IMAP IDLE session per mailbox and run the pipeline as soon as
+    a server reports new mail. Accounts whose server has no IDLE (or whose IDLE session is
+    down) are still polled every POLL_SECONDS; healthy IDLE accounts get a safety poll every
+    IDLE_FULL_SYNC_SECONDS in case a notification was missed.
+    """
+    from app.services.imap_idle import IdleSupervisor
+
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+    supervisor = IdleSupervisor()
+    last_polled = {}
+
+    try:
+        while True:
+            try:
+                report_worker_status()
+                credit_leases.release_expired()
+                accounts = load_active_accounts()
+                supervisor.sync(accounts)
+
+                # Next poll per account: POLL_SECONDS without a healthy IDLE session, else the
+                # IDLE_FULL_SYNC_SECONDS safety poll. A wake of one account never polls the others.
+                def next_poll(a):
+                    interval = IDLE_FULL_SYNC_SECONDS if supervisor.is_push_healthy(a.id) else POLL_SECONDS
+                    return last_polled.get(int(a.id), 0) + interval
+
+                now = time.monotonic()
+                due = [a for a in accounts if now >= next_poll(a)]
+                if due:
+                    run_accounts(due, client, model)
+                    for a in due:
+                        last_polled[int(a.id)] = time.monotonic()
+
+                # Sleep until a notification or the next scheduled poll, whichever comes first
+                now = time.monotonic()
+                timeout = min([POLL_SECONDS] + [next_poll(a) - now for a in accounts])
+                woken = supervisor.wait_for_mail(timeout=max(1.0, timeout))
+                if woken:
+                    woken_accounts = [a for a in accounts if int(a.id) in woken]
+                    logger.info(f"event=idle_wake accounts={len(woken_accounts)}")
+                    run_accounts(woken_accounts, client, model)
+                    for a in woken_accounts:
+                        last_polled[int(a.id)] = time.monotonic()
+            except Exception as e:
+                logger.exception(f"event=worker_error org=system kind=idle_loop error={e!r}")
+                time.sleep(POLL_SECONDS)
+    finally:
+        supervisor.stop_all()
+        credit_leases.release_all()
+
+
+def _interleave_by_org(accounts: list) -> list:
+    """
+    Round-robin accounts across orgs so one tenant with many mailboxes
+    cannot occupy every pool slot while waiting on its own org limit.
+    """
+    by_org = {}
+    for a in accounts:
+        by_org.setdefault(int(a.org_id), []).append(a)
+    out = []
+    queues = list(by_org.values())
+    while queues:
+        nxt = []
+        for q in queues:
+            out.append(q.pop(0))
+            if q:
+                nxt.append(q)
+        queues = nxt
+    return out
+
+def run_accounts(accounts: list, client: OpenAI, model: str):
+    """
+    Process all accounts for one cycle.
+    WORKER_CONCURRENCY=1 keeps the old one-by-one loop; >1 uses a bounded thread pool,
+    with at most WORKER_ORG_CONCURRENCY accounts of the same org running at once.
+    """
+    t0 = time.monotonic()
+
+    if WORKER_CONCURRENCY <= 1 or len(accounts) <= 1:
+        for a in accounts:
+            process_account(a, client, model)
+    else:
+        org_slots = {
+            int(a.org_id): threading.BoundedSemaphore(WORKER_ORG_CONCURRENCY)
+            for a in accounts
+        }
+
+        def _run_bounded(a):
+            with org_slots[int(a.org_id)]:
+                process_account(a, client, model)
+
+        ordered = _interleave_by_org(accounts)
+        with ThreadPoolExecutor(
+            max_workers=min(WORKER_CONCURRENCY, len(ordered)),
+            thread_name_prefix="acct",
+        ) as pool:
+            futures = {pool.submit(_run_bounded, a): a for a in ordered}
+            for fut in as_completed(futures):
+                a = futures[fut]
+                try:
+                    fut.result()
+                except Exception:
+                    logger.exception(f"event=worker_error org=org{a.org_id} kind=account_task account={a.imap_username}")
+
+    elapsed = time.monotonic() - t0
+    logger.info(
+        f"event=cycle_done accounts={len(accounts)} concurrency={WORKER_CONCURRENCY} "
+        f"org_concurrency={WORKER_ORG_CONCURRENCY} seconds={elapsed:.1f} "
+        f"smtp_handshakes={smtp_pool.handshakes} reply_cache_hits={reply_cache.hits} "
+        f"reply_cache_misses={reply_cache.misses}"
+    )
+
+
+def report_worker_status(**fields):
+    """Heartbeat into worker_status (same defaults as upsert_worker_status)."""
     db = SessionLocal()
     try:
+        upsert_worker_status(db, worker_id=WORKER_ID, last_run_at=now_utc(), **fields)
+        db.commit()
+    finally:
+        db.close()
+
+
+def collect_batch(
+    session: ImapSession,
+    a: EmailAccount,
+    org_id: int,
+    org_settings: dict,
+    cooldown_hours: int,
+    limit: int,
+) -> tuple[list[dict], "SyncProgress | None"]:
+    """
+    Phase 1: select up to `limit` eligible emails and run all IMAP-side gates.
+    Skipped emails get a queued Seen flag; eligible ones are returned as job dicts.
+    Also returns the sync progress for this cycle (None when incremental sync is not used).
+    """
+    org_slug = f"org{org_id}"
+    jobs = []
+    batch_threads = set()
+    progress = None
+
+    print(f"Connecting IMAP: {a.imap_username}")
+    imap = session.imap
+    progress, state = start_sync_progress(imap, a)
+
+    candidate_ids, headers = search_candidate_ids(
+        imap, org_id, limit_keep=max(10, limit), progress=progress, state=state
+    )
+    # DEBUG: dump unseen ids (extra SEARCH, so only when debugging)
+    if DEBUG:
+        try:
+            st_dbg, msg_dbg = imap.uid("SEARCH", None, 'UNSEEN')
+            ids_dbg = msg_dbg[0].split() if (st_dbg=='OK' and msg_dbg and msg_dbg[0]) else []
+            print(f"[DEBUG] worker-session UNSEEN ids={len(ids_dbg)} last5={ids_dbg[-5:]}")
+        except Exception as e:
+            print(f"[DEBUG] worker-session UNSEEN probe failed: {e}")
+    if not candidate_ids:
+        print("No candidate emails found (UNSEEN/NEW/RECENT empty; SINCE fallback may also be empty).\n")
+        return jobs, progress
+
+    # Org allow/deny rules (compiled per org, cached by rules version)
+    rules = get_filter_rules_cache().get(org_id)
+
+    # choose non-marketing emails based on headers (newest first)
+    scanned_n = 0
+    bulk_skipped_n = 0
+    bulk_reason_counts = {}
+    for mid in reversed(candidate_ids[-SCAN_LAST_N:]):
+        if len(jobs) >= limit:
+            break
+
+        hdr = headers.get(int(mid))
+        if hdr is None:
+            continue
+        hdr_l = hdr.lower()
+        scanned_n += 1
+
+        # Org rules before the body fetch: deny skips the message, allow bypasses the bulk check
+        rule_action = None
+        if rules:
+            h_sender, h_subject = header_sender_subject(hdr)
+            rule_action, rule = rules.evaluate_headers(h_sender, h_subject, hdr)
+            if rule_action == "deny":
+                bulk_skipped_n += 1
+                bulk_reason_counts["org_rule"] = bulk_reason_counts.get("org_rule", 0) + 1
+                logger.info(f"event=rule_skip org={org_slug} phase=headers rule={rule['id']} from={extract_email(h_sender)}")
+                processed_db_add(org_id, header_message_id(hdr))
+                if progress is not None:
+                    progress.done(mid)
+                continue
+
+        is_bulk, bulk_reason = is_bulk_header(hdr_l) if rule_action != "allow" else (False, "")
+        if is_bulk:
+            bulk_skipped_n += 1
+            bulk_reason_counts[bulk_reason] = bulk_reason_counts.get(bulk_reason, 0) + 1
+            if DEBUG:
+                print(f"[DEBUG] header-skip mid={mid} reason={bulk_reason}")
+            if progress is not None:
+                progress.done(mid)
+            continue
+
+        job = gate_message(session, mid, hdr, org_id, org_settings, cooldown_hours, batch_threads)
+        if job:
+            jobs.append(job)
+            if job["thread_key_n"]:
+                batch_threads.add(job["thread_key_n"])
+        elif job is None and progress is not None:
+            progress.done(mid)
+
+    if not jobs:
+        print("No suitable (non-marketing/system) emails found.\n")
+    # Header scan summary
+    try:
+        top = sorted(bulk_reason_counts.items(), key=lambda kv: kv[1], reverse=True)[:3]
+        top_s = ', '.join(['%s=%s' % (kk, vv) for kk, vv in top]) if top else ''
+        print('[HDRSCAN] scanned=%s bulk_skipped=%s selected=%s top=%s' % (scanned_n, bulk_skipped_n, len(jobs), top_s))
+    except Exception:
+        pass
+    logger.info(f"event=batch_selected org={org_slug} selected={len(jobs)} limit={limit} scanned={scanned_n}")
+    # Do NOT mark bulk-skipped messages as Seen here; it can hide real enquiries.
+    return jobs, progress
+
+
+def gate_message(
+    session: ImapSession,
+    mid,
+    hdr: str,
+    org_id: int,
+    org_settings: dict,
+    cooldown_hours: int,
+    batch_threads: set,
+) -> dict | None | bool:
+    """
+    Fetch one email (by UID) and apply the IMAP-side gates (dedupe, cooldowns, security/enquiry filters).
+    Returns a job dict when the email should get a reply, None when it is skipped for good,
+    or False when it could not be fetched (retry next cycle).
+    """
+    org_slug = f"org{org_id}"
+
+    # Body: only the text part (BODYSTRUCTURE first), never the attachments; headers come from hdr
+    body, fetch_info = fetch_body_text(session.imap, mid)
+    if body is None:
+        print("Failed to fetch email body.\n")
+        return False
+    logger.info(
+        f"event=body_fetched org={org_slug} uid={int(mid)} size={fetch_info['size']} mode={fetch_info['mode']} "
+        f"section={fetch_info['section']} type={fetch_info['type']} bytes={fetch_info['fetched']} "
+        f"truncated={int(fetch_info['truncated'])}"
+    )
+
+    msg = message_from_string(hdr or "", policy=default)
+
+    subject = msg.get("Subject", "") or ""
+    sender = msg.get("From", "") or ""
+    message_id = (msg.get("Message-ID", "") or "").strip()
+    message_id_n = norm_mid(message_id) or ""
+
+    sender_email = extract_email(sender)
+
+    in_reply_to = (msg.get("In-Reply-To") or "").strip() or None
+    references_header = (msg.get("References") or "").strip() or None
+
+    # Canonical thread: any already-indexed id this email references, else the header/subject key
+    thread_key = resolve_thread_key(
+        engine, org_id, thread_message_ids(message_id, in_reply_to, references_header)
+    ) or make_thread_key(org_id, sender_email, subject, in_reply_to, references_header)
+    thread_key_n = (thread_key or "").strip().lower() if thread_key else ""
+
+    print("\nSelected Email:")
+    print("Subject:", subject)
+    print("From:", sender)
+    print("Message-ID:", message_id)
+    # processed_message_ids was already checked for the whole candidate set (search_candidate_ids)
+    print("Thread-Key:", thread_key)
+
+    logger.info(f"event=email_selected org={org_slug} message_id={message_id_n} thread_key={thread_key}")
+
+    # Org allow/deny rules on the full message (allow = trusted: built-in filters are bypassed)
+    rules = get_filter_rules_cache().get(org_id)
+    rule_action, rule = rules.evaluate({"sender": sender, "subject": subject, "headers": hdr, "body": body})
+    if rule_action == "deny":
+        logger.info(f"event=rule_skip org={org_slug} phase=body rule={rule['id']} from={sender_email} thread_key={thread_key}")
+        print(f"Denied by org filter rule {rule['id']} — Skipping.\n")
+        processed_db_add(org_id, message_id)
+        session.queue_seen(mid)
+        return None
+    rule_allow = rule_action == "allow"
+
+    hdr_combo = f"{subject}\n{sender}\n{message_id}".lower()
+    if not rule_allow and is_ignored_email(hdr_combo):
+        print("Ignored (marketing/system email) — Skipping.\n")
+        return None
+
+    # already_replied + thread/sender cooldowns (Postgres) in one round trip
+    snap = get_decision_snapshot(engine, org_id, message_id_n, thread_key, sender_email, cooldown_hours)
+
+    # Per-message-id de-dupe (DB) early
+    if message_id_n and snap["already_replied"]:
+        print("Already replied to this Message-ID. Skipping send.\n")
+        processed_db_add(org_id, message_id)
+        session.queue_seen(mid)
+        return None
+
+    # In-run de-dupe (this process, and earlier emails of this batch)
+    if message_id_n and message_id_n in replied_mids_this_run:
+        print("[SKIP] already replied (this run) message_id", message_id_n)
+        session.queue_seen(mid)
+        return None
+    if thread_key_n and (thread_key_n in replied_threads_this_run or thread_key_n in batch_threads):
+        print("[SKIP] already replied (this run) thread", thread_key_n)
+        session.queue_seen(mid)
+        return None
+
+    # Thread cooldown (Postgres)
+    if snap["thread_recent"]:
+        print(
+            f"Cooldown(thread): already replied in last {cooldown_hours}h "
+            f"for {sender_email} thread={thread_key}. Skipping.\n"
+        )
+        session.queue_seen(mid)
+        return None
+
+    # Sender cooldown (only if thread_key missing)
+    if not thread_key and snap["sender_recent"]:
+        print(f"Cooldown(sender): already replied to {sender_email} in last {cooldown_hours}h. Skipping.\n")
+        session.queue_seen(mid)
+        return None
+
+    trusted_sender = rule_allow or is_trusted_sender(sender_email, org_settings)
+    signals = scan_signals(subject, sender, body, str(hdr or ""))
+
+    # Security/system filter (bypass for trusted senders)
+    if is_security_alert_email(subject, body, str(hdr or ""), signals=signals) and not trusted_sender:
+        logger.info(
+            f"event=security_skip org={org_slug} from={sender_email} thread_key={thread_key} subject={subject[:120]!r}"
+        )
+        print("Security/system email detected. Skipping.\n")
+        session.queue_seen(mid)
+        return None
+
+    # Enquiry filter
+    is_enquiry, reason = is_real_enquiry(
+        subject, sender, body, raw_headers=hdr, trusted_sender=trusted_sender, signals=signals
+    )
+    if not is_enquiry:
+        logger.info(
+            f"event=not_real_enquiry org={org_slug} reason={reason} from={sender_email} thread_key={thread_key} subject={subject[:120]!r}"
+        )
+        print("Not a real enquiry (likely marketing/system). Skipping.\n")
+        processed_db_add(org_id, message_id)
+        session.queue_seen(mid)
+        return None
+
+    return {
+        "mid": mid,
+        "subject": subject,
+        "sender": sender,
+        "sender_email": sender_email,
+        "body": body,
+        "message_id": message_id,
+        "message_id_n": message_id_n,
+        "in_reply_to": in_reply_to,
+        "references_header": references_header,
+        "thread_key": thread_key,
+        "thread_key_n": thread_key_n,
+    }
+
+
+def prepare_reply(
+    a: EmailAccount,
+    job: dict,
+    org_settings: dict,
+    session: ImapSession | None = None,
+    job_id: int | None = None,
+) -> tuple[str, tuple | None]:
+    """
+    Phase 2a: thread lock, credits, live toggle, "new IN > OUT", log IN, build the prompt.
+    IN is logged once per email: queued jobs (job_id) record job["in_logged"] on the worker_jobs
+    row in the same transaction as the audit row.
+    Returns ("ready", (system_prompt, user_prompt, cache_key, max_tokens)) or (outcome, None) where outcome is
+    "locked" (another worker owns the thread), "busy" (lock store unavailable; retry later),
+    "skipped" or "stop" (see handle_job).
+    """
+    org_id = int(a.org_id)
+    org_slug = f"org{org_id}"
+    mid = job["mid"]
+    subject = job["subject"]
+    sender = job["sender"]
+    sender_email = job["sender_email"]
+    body = job["body"]
+    message_id = job["message_id"]
+    message_id_n = job["message_id_n"]
+    thread_key = job["thread_key"]
+
+    # Enterprise lock (Postgres: app.services.thread_lock)
+    from app.services.thread_lock import try_acquire_thread_lock
+
+    THREAD_LOCK_SECONDS = int(os.getenv("THREAD_LOCK_SECONDS", "120"))
+    got_lock = try_acquire_thread_lock(
+        engine,
+        org_id=org_id,
+        thread_key=thread_key,
+        cooldown_seconds=THREAD_LOCK_SECONDS,
+        worker_id=WORKER_ID,
+        ttl_seconds=THREAD_LOCK_SECONDS + 120,
+    )
+    if got_lock is None:
+        # Lock store (Redis) unreachable: leave the email for a later cycle
+        print(f"[LOCK] Thread lock unavailable org={org_id} thread={thread_key}. Retrying later.\n")
+        logger.info(f"event=lock_unavailable org={org_slug} thread_key={thread_key}")
+        return "busy", None
+    if not got_lock:
+        return "locked", None
+
+    # "new IN > OUT", re-read now that we own the thread lock. Only the thread state can have
+    # changed since gate_message's snapshot: one conversation_threads primary-key read.
+    needs_reply = thread_needs_reply(org_id, thread_key)
+
+    # Credits check (leased block in memory; leases a new block from org_credits when empty)
+    remaining = credit_leases.available(org_id)
+    if remaining <= 0:
+        print(f"[BILLING] No credits left for org={org_id}. Skipping.\n")
+        logger.info(f"event=blocked_no_credits org={org_slug} remaining={remaining}")
+        log_usage(
+            engine,
+            org_id,
+            event="blocked_no_credits",
+            qty=1,
+            meta={"thread_key": thread_key, "from": sender_email, "message_id": message_id_n},
+        )
+        if session is not None:
+            session.queue_seen(mid)
+        report_worker_status(credits_health_ok=False, last_error="No credits left")
+        return "stop", None
+
+    # Re-check enterprise toggle right before generating (live from PG, flag only)
+    if not get_auto_reply_enabled(engine, org_id):
+        print("Auto-reply disabled (enterprise toggle) — Skipping.\n")
+        logger.info(f"event=auto_reply_disabled_live org={org_slug}")
+        if session is not None:
+            session.queue_seen(mid)
+        return "stop", None
+
+    # Only reply if new IN > OUT
+    if not needs_reply:
+        print("[SKIP] No new customer message in thread. Already replied.\n")
+        processed_db_add(org_id, message_id)
+        if session is not None:
+            session.queue_seen(mid)
+        return "skipped", None
+
+    print("ENQUIRY DETECTED -> Generating reply")
+
+    # Log IN to Postgres (conversation_audit)
+    if not job.get("in_logged"):
+        db = SessionLocal()
+        try:
+            log_conversation(
+                db,
+                org_id=org_id,
+                thread_key=thread_key,
+                direction="IN",
+                customer_email=sender_email,
+                subject=subject,
+                body_text=body,
+                ai_model=None,
+                email_message_id=message_id_n or None,
+                in_reply_to=job["in_reply_to"],
+                references_header=job["references_header"],
+            )
+            index_thread_messages(
+                db, org_id, thread_key,
+                thread_message_ids(message_id, job["in_reply_to"], job["references_header"]),
+            )
+            if job_id is not None:
+                mark_in_logged(db, job_id)
+            db.commit()
+        finally:
+            db.close()
+        job["in_logged"] = True
+
+    # Build thread context before OpenAI
+    thread_exchanges = load_thread_exchanges(org_id, thread_key, limit=6)
+    thread_context = format_thread_context(thread_exchanges)
+
+    system_prompt, user_prompt, max_tokens = build_prompt(
+        org_settings=org_settings,
+        subject=subject,
+        sender=sender,
+        body=body,
+        thread_exchanges=thread_exchanges,
+    )
+
+    print(
+        f"[ORG] org_id={org_id} "
+        f"kb_len={len((org_settings.get('kb_text') or ''))} "
+        f"sys_len={len((org_settings.get('system_prompt') or ''))}"
+    )
+
+    # Prompt size: cached prefix vs per-email part (old layout sent the KB a second time in the user prompt)
+    prefix_tokens = estimate_tokens(system_prompt)
+    variable_tokens = estimate_tokens(user_prompt)
+    kb_text = (org_settings.get("kb_text") or "").strip()
+    kb_tokens = estimate_tokens(kb_text)
+    kb_sent_tokens = kb_tokens if use_full_kb(kb_text) else getattr(_prompt_stats, "kb_excerpt_tokens", 0)
+    # Old layout: whole KB in both the system and the user prompt
+    before_tokens = prefix_tokens + variable_tokens - kb_sent_tokens + 2 * kb_tokens
+    logger.info(
+        f"event=prompt_tokens org={org_slug} prefix_tokens={prefix_tokens} variable_tokens={variable_tokens} "
+        f"total_tokens={prefix_tokens + variable_tokens} before_tokens={before_tokens}"
+    )
+    # Reply cache: only for first-contact questions (the context always shows the current IN as pending)
+    prior_context = thread_context if _COMPLETED_EXCHANGE_RE.search(thread_context or "") else ""
+    cache_key = reply_cache_key(
+        org_id,
+        org_settings.get("settings_version") or kb_content_hash(org_settings.get("kb_text") or ""),
+        subject,
+        body,
+        prior_context,
+    )
+    return "ready", (system_prompt, user_prompt, cache_key, max_tokens)
+
+
+def call_llm(client: OpenAI, model: str, system_prompt: str, user_prompt: str, max_tokens: int):
+    """
+    Chat completion (reply bounded to max_tokens) with up to LLM_RETRIES retries on transient
+    errors (connection, timeout, 429, 5xx). Returns (response, latency_ms, retries); latency
+    covers all attempts.
+    """
+    started = time.monotonic()
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            response = client.with_options(max_retries=0).chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+                max_tokens=max_tokens,
+            )
+            return response, int((time.monotonic() - started) * 1000), attempt
+        except LLM_RETRYABLE as e:
+            if attempt >= LLM_RETRIES:
+                raise
+            print(f"OpenAI attempt {attempt+1}/{LLM_RETRIES + 1} failed: {e!r}")
+            time.sleep(2 ** attempt)
+
+
+def generate_reply(org_settings: dict, client: OpenAI, model: str, prompts: tuple) -> tuple:
+    """
+    Phase 2b: OpenAI call (+ safe generic reply when the model says SKIP_REPLY). Errors propagate.
+    Answers to repeated first-contact questions come from the reply cache without an LLM call.
+    Returns (reply, llm) where llm holds tokens_in/tokens_out/latency_ms/retries for the audit row.
+    """
+    system_prompt, user_prompt, cache_key, max_tokens = prompts
+    org_slug = f"org{org_settings.get('org_id')}"
+
+    if cache_key:
+        cached = reply_cache.get(cache_key)
+        st = reply_cache.stats()
+        logger.info(
+            f"event=reply_cache org={org_slug} hit={int(cached is not None)} "
+            f"hits={st['hits']} misses={st['misses']} entries={st['entries']}"
+        )
+        if cached is not None:
+            print("---- AI REPLY (cached) ----")
+            print(cached[:800])
+            # No LLM call: zero tokens, no latency (kept out of the latency percentiles)
+            return cached, {"tokens_in": 0, "tokens_out": 0, "latency_ms": None, "retries": 0}
+
+    print("Calling OpenAI...")
+    response, latency_ms, retries = call_llm(client, model, system_prompt, user_prompt, max_tokens)
+
+    reply = (response.choices[0].message.content or "").strip()
+
+    usage = getattr(response, "usage", None)
+    llm = {
+        "tokens_in": getattr(usage, "prompt_tokens", None),
+        "tokens_out": getattr(usage, "completion_tokens", None),
+        "latency_ms": latency_ms,
+        "retries": retries,
+    }
+    details = getattr(usage, "prompt_tokens_details", None)
+    logger.info(
+        f"event=llm_usage org={org_slug} model={model} "
+        f"prompt_tokens={llm['tokens_in']} "
+        f"cached_tokens={getattr(details, 'cached_tokens', None) if details is not None else None} "
+        f"completion_tokens={llm['tokens_out']} latency_ms={latency_ms} retries={retries}"
+    )
+
+    if cache_key and reply and reply.strip().upper() != "SKIP_REPLY":
+        reply_cache.put(cache_key, reply)
+
+    if reply.strip().upper() == "SKIP_REPLY":
+        # Model tried to skip, but local rules marked this as an enquiry. Force a safe generic reply.
+        print("[WARN] Model returned SKIP_REPLY, but local rules marked as enquiry. Forcing a real reply.")
+
+        support_name = (org_settings.get("support_name") or "Support Team").strip()
+        support_email = (org_settings.get("support_email") or "").strip()
+
+        reply = (
+            "Hello,\n\n"
+            "Thanks for reaching out. We received your enquiry and we’re happy to help.\n"
+            "Could you please share a bit more detail about what you need (service/course/topic) and your preferred mode/timing?\n"
+            "If you want a callback, share your phone number (optional).\n\n"
+            f"Best regards,\n{support_name}"
+            + (f"\n{support_email}" if support_email else "")
+        ).strip()
+
+    print("---- AI REPLY (preview) ----")
+    print(reply[:800])
+    return reply, llm
+
+
+def deliver_reply(a: EmailAccount, job: dict, reply: str) -> bool:
+    """Phase 2c: store a draft (AIMAIL_DRAFT_ONLY) or send via SMTP. Returns True on success."""
+    org_id = int(a.org_id)
+    to_email = job["sender_email"]
+
+    draft_only = (AIMAIL_DRAFT_ONLY != '0')
+
+    if draft_only:
+
+        draft_db_add_engine(engine, org_id, job["message_id"], job["sender_email"], to_email, job["subject"], job["body"], reply)
+
+        return True
+
+    # Threading headers: the reply's own Message-ID goes into message_thread_index (record_outcome)
+    subject = job["subject"] or ""
+    if not re.match(r"^\s*re:", subject, re.I):
+        subject = "Re: " + subject
+    parent = (job["message_id"] or "").strip() or None
+    job["reply_message_id"] = make_msgid(domain=(a.email or "").rpartition("@")[2] or None)
+    return send_smtp_safe(
+        a,
+        to_email,
+        subject,
+        reply,
+        message_id=job["reply_message_id"],
+        in_reply_to=parent,
+        references=reply_references(parent, job.get("in_reply_to"), job.get("references_header")),
+    )
+
+
+def record_outcome(
+    a: EmailAccount,
+    job: dict,
+    model: str,
+    reply: str,
+    smtp_ok: bool,
+    session: ImapSession | None = None,
+    llm: dict | None = None,
+) -> str:
+    """
+    Phase 2d: analytics line, OUT audit row (with LLM tokens/latency/retries), worker status,
+    billing + usage. Returns "sent" / "failed".
+    """
+    llm = llm or {}
+    org_id = int(a.org_id)
+    org_slug = f"org{org_id}"
+    mid = job["mid"]
+    subject = job["subject"]
+    sender_email = job["sender_email"]
+    message_id_n = job["message_id_n"]
+    thread_key = job["thread_key"]
+    thread_key_n = job["thread_key_n"]
+    to_email = sender_email
+
+    # ✅ analytics log line (this is what your /admin/analytics/summary reads)
+    credits_used = 1 if smtp_ok else 0
+    logger.info(
+        f"event=email_processed org={org_slug} message_id={message_id_n} thread_key={thread_key} credits={credits_used}"
+    )
+
+    # Log OUT + worker status
+    db = SessionLocal()
+    try:
+        log_conversation(
+            db,
+            org_id=org_id,
+            thread_key=thread_key,
+            direction="OUT",
+            customer_email=sender_email,
+            subject=subject,
+            body_text=reply if smtp_ok else f"(SMTP FAILED)\n\n{reply}",
+            ai_model=model,
+            ai_tokens_in=llm.get("tokens_in"),
+            ai_tokens_out=llm.get("tokens_out"),
+            ai_latency_ms=llm.get("latency_ms"),
+            ai_retries=llm.get("retries"),
+            email_message_id=message_id_n or None,
+        )
+        if smtp_ok and job.get("reply_message_id"):
+            index_thread_messages(db, org_id, thread_key, thread_message_ids(job["reply_message_id"], None, None))
         upsert_worker_status(
             db,
             worker_id=WORKER_ID,
             last_run_at=now_utc(),
+            last_email_processed_at=now_utc(),
+            last_email_message_id=message_id_n or None,
+            last_thread_key=thread_key,
             lock_health_ok=True,
             credits_health_ok=True,
-            last_error=None,
+            last_error=None if smtp_ok else "SMTP send failed",
         )
         db.commit()
     finally:
         db.close()
 
-    with Session(engine) as db:
-        accounts = (
-            db.query(EmailAccount)
-            .join(Organization, EmailAccount.org_id == Organization.id)
-            .filter(Organization.auto_reply_enabled == True)
-            .all()
+    # Billing + usage
+    if smtp_ok:
+        ok = credit_leases.spend(org_id, qty=1)
+        log_usage(
+            engine,
+            org_id,
+            event="reply_sent",
+            qty=1,
+            meta={"thread_key": thread_key, "to": to_email, "message_id": message_id_n},
+        )
+        redis_fast.record_reply_sent(org_id)
+        if not ok:
+            print(f"[BILLING] Warning: credits could not be consumed after send (org={org_id}).")
+            logger.info(f"event=credits_consume_failed org={org_slug} message_id={message_id_n}")
+    else:
+        log_usage(
+            engine,
+            org_id,
+            event="smtp_failed",
+            qty=1,
+            meta={"thread_key": thread_key, "to": to_email, "message_id": message_id_n},
         )
-    print(f"[DEBUG] accounts_found={len(accounts)}")
 
-    for a in accounts:
-        org_id = int(a.org_id)
-        org_settings = get_org_settings(org_id)
-        cooldown_hours = int(org_settings.get("cooldown_hours", 24) or 24)
-        org_name = org_settings.get("org_name", f"org_id={org_id}")
-        org_slug = f"org{org_id}"
-
-        print(f"[ORG] {org_name} cooldown={cooldown_hours}h")
-        logger.info(f"event=org_cycle_start org={org_slug} org_name={org_name}")
-
-        if not int(org_settings.get("auto_reply_enabled", 1)):
-            print(f"Connecting IMAP: {a.imap_username}")
-            print("Auto-reply disabled (enterprise toggle). Skipping.\n")
-            continue
-        if not int(org_settings.get("auto_reply", 1)):
-            print(f"Connecting IMAP: {a.imap_username}")
-            print("Auto-reply disabled (legacy flag). Skipping.\n")
-            continue
+    if session is not None:
+        session.queue_seen(mid)
 
-        sent_last_hour = replies_sent_last_hour(org_id)
-        max_per_hour = int(org_settings.get("max_replies_per_hour", 10) or 10)
-        if sent_last_hour >= max_per_hour:
-            print(f"Connecting IMAP: {a.imap_username}")
-            print(f"Rate limited: {sent_last_hour}/{max_per_hour} replies in last hour. Skipping.\n")
-            logger.info(f"event=rate_limited org={org_slug} sent_last_hour={sent_last_hour} max_per_hour={max_per_hour}")
-            continue
+    if smtp_ok and message_id_n:
+        mark_replied(org_id, message_id_n)
+        print("Reply recorded + conversation stored.\n")
 
-        for attempt in range(1):
-            imap = None
-            chosen_mid = None
-            message_id = ""
-            thread_key = ""
-            sender_email = ""
-            subject = ""
-            sender = ""
-            body = ""
-            in_reply_to = None
-            references_header = ""
-            chosen_hdr = ""
-            smtp_ok = False
-            reply = ""
+    if message_id_n:
+        replied_mids_this_run.add(message_id_n)
+    if thread_key_n:
+        replied_threads_this_run.add(thread_key_n)
 
-            try:
-                if attempt == 0:
-                    print(f"Connecting IMAP: {a.imap_username}")
-                else:
-                    print(f"Retrying IMAP ({attempt+1}/1): {a.imap_username}")
+    return "sent" if smtp_ok else "failed"
 
-                imap = imaplib.IMAP4_SSL(a.imap_host, a.imap_port)
-                imap.login(a.imap_username, a.imap_password)
-                imap.select(INBOX_FOLDER)
 
-                candidate_ids = []
+def handle_job(
+    a: EmailAccount,
+    job: dict,
+    org_settings: dict,
+    client: OpenAI,
+    model: str,
+    session: ImapSession,
+) -> str:
+    """
+    Phase 2 (inline pipeline): locks, credits, live toggle, generate, send/draft, audit + billing.
+    Queues the Seen flag on `session` when the email should be flagged Seen.
+    Returns "sent", "failed", "skipped", "busy" (thread in progress elsewhere, or the thread lock
+    store is down; retry next cycle) or "stop" (do not handle the rest of the batch; this email
+    is retried next cycle).
+    """
+    org_id = int(a.org_id)
+    org_slug = f"org{org_id}"
+    thread_key = job["thread_key"]
 
-                candidate_ids = search_candidate_ids(imap, org_id)
-                # DEBUG: dump unseen ids
-                try:
-                    st_dbg, msg_dbg = imap.search(None, 'UNSEEN')
-                    ids_dbg = msg_dbg[0].split() if (st_dbg=='OK' and msg_dbg and msg_dbg[0]) else []
-                    print(f"[DEBUG] worker-session UNSEEN ids={len(ids_dbg)} last5={ids_dbg[-5:]}")
-                except Exception as e:
-                    print(f"[DEBUG] worker-session UNSEEN probe failed: {e}")
-                if not candidate_ids:
-                    imap.logout()
-                    print("No candidate emails found (UNSEEN/NEW/RECENT empty; SINCE fallback may also be empty).\n")
-                    break
-
-                chosen_mid = None
-                # choose a non-marketing email based on headers
-                scanned_n = 0
-                bulk_skipped_n = 0
-                bulk_reason_counts = {}
-                for mid in reversed(candidate_ids[-SCAN_LAST_N:]):
-                    st, hdrdata = imap.fetch(
-                        mid,
-                        "(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID REFERENCES IN-REPLY-TO LIST-UNSUBSCRIBE LIST-ID)])",
-                    )
-                    if not hdrdata or not isinstance(hdrdata[0], tuple):
-                        continue
-                    hdr = safe_decode(hdrdata[0][1]) or ""
-                    hdr_l = hdr.lower()
-                    scanned_n += 1
-                    is_bulk, bulk_reason = is_bulk_header(hdr_l)
-                    if is_bulk:
-                        bulk_skipped_n += 1
-                        bulk_reason_counts[bulk_reason] = bulk_reason_counts.get(bulk_reason, 0) + 1
-                        if DEBUG:
-                            print(f"[DEBUG] header-skip mid={mid} reason={bulk_reason}")
-                        continue
-                    chosen_mid = mid
-                    chosen_hdr = hdr
-                    break
-
-                if chosen_mid is None:
-                    print("No suitable (non-marketing/system) emails found.\n")
-                    # Header scan summary
-                    try:
-                        top = sorted(bulk_reason_counts.items(), key=lambda kv: kv[1], reverse=True)[:3]
-                        top_s = ', '.join(['%s=%s' % (kk, vv) for kk, vv in top]) if top else ''
-                        print('[HDRSCAN] scanned=%s bulk_skipped=%s top=%s' % (scanned_n, bulk_skipped_n, top_s))
-                    except Exception:
-                        pass
-                    # Do NOT mark messages as Seen here; it can hide real enquiries.
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                st, data = imap.fetch(chosen_mid, "(BODY.PEEK[])")
-                if not data or not isinstance(data[0], tuple):
-                    imap.logout()
-                    print("Failed to fetch email body.\n")
-                    break
-
-                msg = message_from_bytes(data[0][1], policy=default)
-
-                subject = msg.get("Subject", "") or ""
-                sender = msg.get("From", "") or ""
-                message_id = (msg.get("Message-ID", "") or "").strip()
-                message_id_n = norm_mid(message_id) or ""
-
-                body = get_body_text(msg)
-                sender_email = extract_email(sender)
-
-                in_reply_to = (msg.get("In-Reply-To") or "").strip() or None
-                references_header = (msg.get("References") or "").strip() or None
-
-                thread_key = make_thread_key(org_id, sender_email, subject, in_reply_to, references_header)
-                thread_key_n = (thread_key or "").strip().lower() if thread_key else ""
-
-                print("\nSelected Email:")
-                print("Subject:", subject)
-                print("From:", sender)
-                print("Message-ID:", message_id)
-                # Skip if already processed recently (prevents reselect loop)
-                if processed_db_seen(org_id, message_id):
-                    print("Already processed (DB). Skipping.")
-                    continue
-                print("Thread-Key:", thread_key)
-
-                logger.info(f"event=email_selected org={org_slug} message_id={message_id_n} thread_key={thread_key}")
-                # Mark as processed as soon as selected (prevents reselection loops)
-
-                hdr_combo = f"{subject}\n{sender}\n{message_id}".lower()
-                if is_ignored_email(hdr_combo):
-                    print("Ignored (marketing/system email) — Skipping.\n")
-                    imap.logout()
-                    break
-
-                # Per-message-id de-dupe (DB) early
-                if message_id_n and already_replied(org_id, message_id_n):
-                    print("Already replied to this Message-ID. Skipping send.\n")
-                    processed_db_add(org_id, message_id)
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                # In-run de-dupe
-                if message_id_n and message_id_n in replied_mids_this_run:
-                    print("[SKIP] already replied (this run) message_id", message_id_n)
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    imap.logout()
-                    break
-                if thread_key_n and thread_key_n in replied_threads_this_run:
-                    print("[SKIP] already replied (this run) thread", thread_key_n)
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    imap.logout()
-                    break
-
-                # Thread cooldown (Postgres)
-                if replied_to_thread_recently(org_id, thread_key, hours=cooldown_hours):
-                    print(
-                        f"Cooldown(thread): already replied in last {cooldown_hours}h "
-                        f"for {sender_email} thread={thread_key}. Skipping.\n"
-                    )
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    continue
-
-                # Sender cooldown (only if thread_key missing)
-                if not thread_key and replied_to_sender_recently(org_id, sender_email, hours=cooldown_hours):
-                    print(f"Cooldown(sender): already replied to {sender_email} in last {cooldown_hours}h. Skipping.\n")
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    continue
-
-                trusted_sender = is_trusted_sender(sender_email, org_settings)
-
-                # Security/system filter (bypass for trusted senders)
-                if is_security_alert_email(subject, body, str(chosen_hdr or "")) and not trusted_sender:
-                    logger.info(
-                        f"event=security_skip org={org_slug} from={sender_email} thread_key={thread_key} subject={subject[:120]!r}"
-                    )
-                    print("Security/system email detected. Skipping.\n")
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                # Enquiry filter
-                if not is_real_enquiry(subject, sender, body, raw_headers=chosen_hdr, trusted_sender=trusted_sender):
-                    reason = getattr(is_real_enquiry, "last_reason", "")
-                    logger.info(
-                        f"event=not_real_enquiry org={org_slug} reason={reason} from={sender_email} thread_key={thread_key} subject={subject[:120]!r}"
-                    )
-                    print("Not a real enquiry (likely marketing/system). Skipping.\n")
-                    processed_db_add(org_id, message_id)
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                # Enterprise lock (Postgres: app.services.thread_lock)
-                from app.services.thread_lock import try_acquire_thread_lock
-
-                THREAD_LOCK_SECONDS = int(os.getenv("THREAD_LOCK_SECONDS", "120"))
-                got_lock = try_acquire_thread_lock(
-                    engine,
-                    org_id=org_id,
-                    thread_key=thread_key,
-                    cooldown_seconds=THREAD_LOCK_SECONDS,
-                    worker_id=WORKER_ID,
-                    ttl_seconds=THREAD_LOCK_SECONDS + 120,
-                )
-                if not got_lock:
-                    print(f"[LOCK] Skip duplicate reply (another worker owns lock) org={org_id} thread={thread_key}\n")
-                    processed_db_add(org_id, message_id)
-                    logger.info(f"event=lock_skip org={org_slug} thread_key={thread_key}")
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-
-                    db = SessionLocal()
-                    try:
-                        upsert_worker_status(
-                            db,
-                            worker_id=WORKER_ID,
-                            last_run_at=now_utc(),
-                            lock_health_ok=True,
-                            credits_health_ok=True,
-                            last_error=None,
-                        )
-                        db.commit()
-                    finally:
-                        db.close()
-
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                # Credits check
-                remaining = get_remaining_credits(engine, org_id)
-                if remaining <= 0:
-                    print(f"[BILLING] No credits left for org={org_id}. Skipping.\n")
-                    logger.info(f"event=blocked_no_credits org={org_slug} remaining={remaining}")
-                    log_usage(
-                        engine,
-                        org_id,
-                        event="blocked_no_credits",
-                        qty=1,
-                        meta={"thread_key": thread_key, "from": sender_email, "message_id": message_id_n},
-                    )
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-
-                    db = SessionLocal()
-                    try:
-                        upsert_worker_status(
-                            db,
-                            worker_id=WORKER_ID,
-                            last_run_at=now_utc(),
-                            credits_health_ok=False,
-                            lock_health_ok=True,
-                            last_error="No credits left",
-                        )
-                        db.commit()
-                    finally:
-                        db.close()
-
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                # Re-check enterprise toggle right before generating (live from PG)
-                org_settings_live = get_org_settings(org_id)
-                if not int(org_settings_live.get("auto_reply_enabled", 1)):
-                    print("Auto-reply disabled (enterprise toggle) — Skipping.\n")
-                    logger.info(f"event=auto_reply_disabled_live org={org_slug}")
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                # Only reply if new IN > OUT
-                if not thread_needs_reply(org_id, thread_key):
-                    print("[SKIP] No new customer message in thread. Already replied.\n")
-                    processed_db_add(org_id, message_id)
-                    try:
-                        imap.store(chosen_mid, "+FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    try:
-                        imap.logout()
-                    except Exception:
-                        pass
-                    break
-
-                print("ENQUIRY DETECTED -> Generating reply")
-
-                # Log IN to Postgres (conversation_audit)
-                db = SessionLocal()
-                try:
-                    log_conversation(
-                        db,
-                        org_id=org_id,
-                        thread_key=thread_key,
-                        direction="IN",
-                        customer_email=sender_email,
-                        subject=subject,
-                        body_text=body,
-                        ai_model=None,
-                        email_message_id=message_id_n or None,
-                        in_reply_to=in_reply_to,
-                        references_header=references_header,
-                    )
-                    db.commit()
-                finally:
-                    db.close()
+    # Another account of this org is already handling this thread in this process
+    if not claim_inflight_thread(org_id, thread_key):
+        print(f"[LOCK] Thread already in progress in this worker org={org_id} thread={thread_key}. Skipping.\n")
+        logger.info(f"event=inflight_skip org={org_slug} thread_key={thread_key}")
+        return "busy"
 
-                # Build thread context before OpenAI
-                thread_context = load_thread_context(org_id, thread_key, limit=6)
+    try:
+        outcome, prompts = prepare_reply(a, job, org_settings, session)
+        if outcome == "locked":
+            print(f"[LOCK] Skip duplicate reply (another worker owns lock) org={org_id} thread={thread_key}\n")
+            processed_db_add(org_id, job["message_id"])
+            logger.info(f"event=lock_skip org={org_slug} thread_key={thread_key}")
+            session.queue_seen(job["mid"])
+            report_worker_status()
+            return "skipped"
+        if outcome != "ready":
+            return outcome
+
+        smtp_ok = False
+        reply = ""
+        llm = None
+
+        # OpenAI + SMTP
+        try:
+            reply, llm = generate_reply(org_settings, client, model, prompts)
+            smtp_ok = deliver_reply(a, job, reply)
+        except Exception as e:
+            print("WORKER ERROR (OpenAI/SMTP block):", repr(e))
+            logger.exception(f"event=worker_error org={org_slug} kind=openai_or_smtp")
+            smtp_ok = False
+            if not reply:
+                reply = "(generation failed) Please try again later."
 
-                # Logout before OpenAI
-                try:
-                    imap.logout()
-                except Exception:
-                    pass
-                imap = None
-
-                system_prompt, user_prompt = build_prompt(
-                    org_settings=org_settings,
-                    subject=subject,
-                    sender=sender,
-                    body=body,
-                    thread_context=thread_context,
-                )
-
-                print(
-                    f"[ORG] org_id={org_id} "
-                    f"kb_len={len((org_settings.get('kb_text') or ''))} "
-                    f"sys_len={len((org_settings.get('system_prompt') or ''))}"
-                )
-
-                # OpenAI + SMTP
-                try:
-                    print("Calling OpenAI...")
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt},
-                        ],
-                    )
+        return record_outcome(a, job, model, reply, smtp_ok, session, llm=llm)
+    finally:
+        release_inflight_thread(org_id, thread_key)
 
-                    reply = (response.choices[0].message.content or "").strip()
 
-                    if reply.strip().upper() == "SKIP_REPLY":
-                        # Model tried to skip, but local rules marked this as an enquiry. Force a safe generic reply.
-                        print("[WARN] Model returned SKIP_REPLY, but local rules marked as enquiry. Forcing a real reply.")
+# ---------------------- durable job queue (WORKER_STAGES) ----------------------
+def load_account(account_id: int) -> EmailAccount | None:
+    with Session(engine) as db:
+        return db.get(EmailAccount, int(account_id))
 
-                        support_name = (org_settings.get("support_name") or "Support Team").strip()
-                        support_email = (org_settings.get("support_email") or "").strip()
 
-                        reply = (
-                            "Hello,\n\n"
-                            "Thanks for reaching out. We received your enquiry and we’re happy to help.\n"
-                            "Could you please share a bit more detail about what you need (service/course/topic) and your preferred mode/timing?\n"
-                            "If you want a callback, share your phone number (optional).\n\n"
-                            f"Best regards,\n{support_name}"
-                            + (f"\n{support_email}" if support_email else "")
-                        ).strip()
+def enqueue_batch(session: ImapSession, a: EmailAccount, jobs: list, progress) -> int:
+    """
+    Ingest stage: store gated emails as "generate" jobs. Once an email is durably queued it is
+    flagged Seen and its UID is done for the sync cursor; the queue owns it from here on.
+    """
+    org_id = int(a.org_id)
+    queued = 0
+    for job in jobs:
+        mid = job["mid"]
+        mid_s = mid.decode() if isinstance(mid, bytes) else str(mid)
+        uidvalidity = progress.uidvalidity if progress is not None else 0
+        dedupe_key = job["message_id_n"] or f"uid:{a.id}:{uidvalidity}:{mid_s}"
+        payload = dict(job, mid=mid_s)
+
+        if not enqueue_job(engine, org_id, a.id, dedupe_key, job["thread_key"], payload):
+            continue
+        queued += 1
+        session.queue_seen(mid)
+        if progress is not None:
+            progress.done(mid)
+        logger.info(f"event=job_enqueued org=org{org_id} message_id={job['message_id_n']} thread_key={job['thread_key']}")
+    return queued
+
+
+def run_generate_job(row: dict, claim_id: str, client: OpenAI, model: str):
+    job = row["payload"]
+    org_id = int(row["org_id"])
+    org_slug = f"org{org_id}"
+    thread_key = job["thread_key"]
+
+    a = load_account(row["account_id"])
+    if a is None:
+        finish_job(engine, row["id"], claim_id, status="skipped", error="account removed")
+        return
+    org_settings = get_org_settings(org_id)
 
-                    print("---- AI REPLY (preview) ----")
-                    print(reply[:800])
+    # Hourly budget counts replies already sent; queued jobs wait for the window to move
+    max_per_hour = int(org_settings.get("max_replies_per_hour", 10) or 10)
+    if replies_sent_last_hour(org_id) >= max_per_hour:
+        logger.info(f"event=job_deferred org={org_slug} job={row['id']} reason=rate_limited")
+        defer_job(engine, row["id"], claim_id, QUEUE_DEFER_SECONDS, "rate limited")
+        return
 
-                    to_email = sender_email
+    if not claim_inflight_thread(org_id, thread_key):
+        defer_job(engine, row["id"], claim_id, 60, "thread busy (this worker)")
+        return
+    try:
+        # A reply for this thread is generated but not delivered yet
+        if thread_has_open_job(engine, org_id, thread_key, exclude_id=row["id"]):
+            defer_job(engine, row["id"], claim_id, 60, "thread busy (pending delivery)")
+            return
+
+        # payload.in_logged: IN was already logged by an earlier attempt of this job
+        outcome, prompts = prepare_reply(a, job, org_settings, job_id=row["id"])
+        if outcome == "locked":
+            logger.info(f"event=job_deferred org={org_slug} job={row['id']} reason=thread_locked")
+            defer_job(engine, row["id"], claim_id, 60, "thread locked by another worker")
+            return
+        if outcome == "busy":
+            logger.info(f"event=job_deferred org={org_slug} job={row['id']} reason=lock_unavailable")
+            defer_job(engine, row["id"], claim_id, 60, "thread lock unavailable (Redis down)")
+            return
+        if outcome == "stop":
+            logger.info(f"event=job_deferred org={org_slug} job={row['id']} reason=stop")
+            defer_job(engine, row["id"], claim_id, QUEUE_DEFER_SECONDS, "no credits / auto-reply disabled")
+            return
+        if outcome != "ready":
+            finish_job(engine, row["id"], claim_id, status="skipped")
+            return
 
-                    draft_only = (AIMAIL_DRAFT_ONLY != '0')
+        try:
+            reply, llm = generate_reply(org_settings, client, model, prompts)
+        except Exception as e:
+            logger.exception(f"event=worker_error org={org_slug} kind=openai job={row['id']}")
+            status = retry_job(engine, row["id"], claim_id, f"OpenAI: {e!r}")
+            if status == "dead":
+                logger.info(f"event=job_dead org={org_slug} job={row['id']} stage=generate")
+                record_outcome(a, job, model, "(generation failed) Please try again later.", False)
+            return
+
+        advance_job(engine, row["id"], claim_id, STAGE_DELIVER, dict(job, reply=reply, llm=llm))
+        logger.info(f"event=job_generated org={org_slug} job={row['id']} thread_key={thread_key}")
+    finally:
+        release_inflight_thread(org_id, thread_key)
 
-                    if draft_only:
 
-                        draft_db_add_engine(engine, org_id, message_id, sender_email, to_email, subject, body, reply)
+def run_deliver_job(row: dict, claim_id: str, model: str):
+    job = row["payload"]
+    org_id = int(row["org_id"])
+    org_slug = f"org{org_id}"
+    reply = job.get("reply") or ""
 
-                        smtp_ok = True
+    a = load_account(row["account_id"])
+    if a is None:
+        finish_job(engine, row["id"], claim_id, status="skipped", error="account removed")
+        return
 
-                    else:
+    # An earlier attempt delivered and logged OUT, then lost its claim before finishing the job
+    if job["message_id_n"] and already_replied(org_id, job["message_id_n"]):
+        finish_job(engine, row["id"], claim_id, status="done")
+        return
 
-                        smtp_ok = send_smtp_safe(a, to_email, "Re: " + subject, reply)
-                except Exception as e:
-                    print("WORKER ERROR (OpenAI/SMTP block):", repr(e))
-                    logger.exception(f"event=worker_error org={org_slug} kind=openai_or_smtp")
-                    smtp_ok = False
-                    if not reply:
-                        reply = "(generation failed) Please try again later."
-                    to_email = sender_email
-
-                # ✅ analytics log line (this is what your /admin/analytics/summary reads)
-                credits_used = 1 if smtp_ok else 0
-                logger.info(
-                    f"event=email_processed org={org_slug} message_id={message_id_n} thread_key={thread_key} credits={credits_used}"
-                )
-
-                # Log OUT + worker status
-                db = SessionLocal()
-                try:
-                    log_conversation(
-                        db,
-                        org_id=org_id,
-                        thread_key=thread_key,
-                        direction="OUT",
-                        customer_email=sender_email,
-                        subject=subject,
-                        body_text=reply if smtp_ok else f"(SMTP FAILED)\n\n{reply}",
-                        ai_model=model,
-                        email_message_id=message_id_n or None,
-                    )
-                    upsert_worker_status(
-                        db,
-                        worker_id=WORKER_ID,
-                        last_run_at=now_utc(),
-                        last_email_processed_at=now_utc(),
-                        last_email_message_id=message_id_n or None,
-                        last_thread_key=thread_key,
-                        lock_health_ok=True,
-                        credits_health_ok=True,
-                        last_error=None if smtp_ok else "SMTP send failed",
-                    )
-                    db.commit()
-                finally:
-                    db.close()
-
-                # Billing + usage
-                if smtp_ok:
-                    ok = consume_credits(engine, org_id, qty=1)
-                    log_usage(
-                        engine,
-                        org_id,
-                        event="reply_sent",
-                        qty=1,
-                        meta={"thread_key": thread_key, "to": to_email, "message_id": message_id_n},
-                    )
-                    if not ok:
-                        print(f"[BILLING] Warning: credits could not be consumed after send (org={org_id}).")
-                        logger.info(f"event=credits_consume_failed org={org_slug} message_id={message_id_n}")
-                else:
-                    log_usage(
-                        engine,
-                        org_id,
-                        event="smtp_failed",
-                        qty=1,
-                        meta={"thread_key": thread_key, "to": to_email, "message_id": message_id_n},
-                    )
+    try:
+        ok = deliver_reply(a, job, reply)
+        error = "" if ok else "SMTP send failed"
+    except Exception as e:
+        ok, error = False, repr(e)
+
+    if ok:
+        record_outcome(a, job, model, reply, True, llm=job.get("llm"))
+        finish_job(engine, row["id"], claim_id, status="done")
+        logger.info(f"event=job_delivered org={org_slug} job={row['id']}")
+        return
 
-                # Mark seen (requires re-login because we logged out earlier)
-                if chosen_mid is not None:
-                    mark_seen_by_relogin(a, a.imap_host, a.imap_port, chosen_mid)
+    status = retry_job(engine, row["id"], claim_id, error)
+    if status == "dead":
+        logger.info(f"event=job_dead org={org_slug} job={row['id']} stage=deliver")
+        record_outcome(a, job, model, reply, False, llm=job.get("llm"))
+
+
+def stage_worker_loop(stage: str, claim_id: str, client: OpenAI, model: str):
+    """One consumer thread: claim a job, run it, repeat. Unexpected errors count as a failed attempt."""
+    visibility = GENERATE_VISIBILITY_SECONDS if stage == STAGE_GENERATE else DELIVER_VISIBILITY_SECONDS
+    while True:
+        credit_leases.release_expired()
+        rows = claim_jobs(engine, stage, claim_id, limit=1, visibility_seconds=visibility)
+        if not rows:
+            time.sleep(QUEUE_POLL_SECONDS)
+            continue
+        row = rows[0]
+        try:
+            if stage == STAGE_GENERATE:
+                run_generate_job(row, claim_id, client, model)
+            else:
+                run_deliver_job(row, claim_id, model)
+        except Exception as e:
+            logger.exception(f"event=worker_error org=org{row['org_id']} kind=job_{stage} job={row['id']}")
+            retry_job(engine, row["id"], claim_id, repr(e))
 
-                if smtp_ok and message_id_n:
-                    mark_replied(org_id, message_id_n)
-                    print("Reply recorded + conversation stored.\n")
 
-                if message_id_n:
-                    replied_mids_this_run.add(message_id_n)
-                if thread_key_n:
-                    replied_threads_this_run.add(thread_key_n)
+def start_stage_workers(client: OpenAI, model: str) -> list:
+    """Start the generate/deliver consumer threads configured in WORKER_STAGES."""
+    threads = []
+    for stage, n in ((STAGE_GENERATE, GENERATE_CONCURRENCY), (STAGE_DELIVER, DELIVER_CONCURRENCY)):
+        if stage not in WORKER_STAGES:
+            continue
+        for i in range(n):
+            t = threading.Thread(
+                target=stage_worker_loop,
+                args=(stage, f"{WORKER_ID}/{stage}-{i}", client, model),
+                name=f"{stage}-{i}",
+                daemon=True,
+            )
+            t.start()
+            threads.append(t)
+    logger.info(f"event=stage_workers_started stages={','.join(sorted(WORKER_STAGES))} threads={len(threads)}")
+    return threads
 
-            except (ConnectionResetError, imaplib.IMAP4.abort, OSError) as e:
-                print("NETWORK/IMAP ERROR:", repr(e))
-                logger.exception(f"event=worker_error org=org{org_id} kind=network")
 
-                try:
-                    if imap:
-                        imap.logout()
-                except Exception:
-                    pass
+def process_account(a: EmailAccount, client: OpenAI, model: str):
+    """
+    One poll cycle for a single mailbox: select up to WORKER_BATCH_SIZE eligible emails in one
+    IMAP session, then gate + generate + send/draft each of them.
+    Safe to run concurrently for different accounts (see run_accounts).
+    """
+    org_id = int(a.org_id)
+    org_settings = get_org_settings(org_id)
+    cooldown_hours = int(org_settings.get("cooldown_hours", 24) or 24)
+    org_name = org_settings.get("org_name", f"org_id={org_id}")
+    org_slug = f"org{org_id}"
+
+    print(f"[ORG] {org_name} cooldown={cooldown_hours}h")
+    logger.info(f"event=org_cycle_start org={org_slug} org_name={org_name}")
+
+    if not int(org_settings.get("auto_reply_enabled", 1)):
+        print(f"Connecting IMAP: {a.imap_username}")
+        print("Auto-reply disabled (enterprise toggle). Skipping.\n")
+        return
+    if not int(org_settings.get("auto_reply", 1)):
+        print(f"Connecting IMAP: {a.imap_username}")
+        print("Auto-reply disabled (legacy flag). Skipping.\n")
+        return
 
-                db = SessionLocal()
-                try:
-                    upsert_worker_status(
-                        db,
-                        worker_id=WORKER_ID,
-                        last_run_at=now_utc(),
-                        lock_health_ok=True,
-                        credits_health_ok=True,
-                        last_error=f"NETWORK/IMAP ERROR: {repr(e)}"[:2000],
-                    )
-                    db.commit()
-                finally:
-                    db.close()
+    sent_last_hour = replies_sent_last_hour(org_id)
+    max_per_hour = int(org_settings.get("max_replies_per_hour", 10) or 10)
+    if sent_last_hour >= max_per_hour:
+        print(f"Connecting IMAP: {a.imap_username}")
+        print(f"Rate limited: {sent_last_hour}/{max_per_hour} replies in last hour. Skipping.\n")
+        logger.info(f"event=rate_limited org={org_slug} sent_last_hour={sent_last_hour} max_per_hour={max_per_hour}")
+        return
 
-                time.sleep(2)
-                if attempt == 0:
-                    continue
+    # Never select more than the hourly budget still allows
+    limit = min(WORKER_BATCH_SIZE, max_per_hour - sent_last_hour)
+    if QUEUE_MODE:
+        # Jobs already queued for this org will use part of the same budget
+        limit -= count_open_jobs(engine, org_id)
+        if limit <= 0:
+            print(f"Queue full for {org_slug}: hourly budget already queued. Skipping.\n")
+            return
+
+    # One IMAP connection for the whole turn (kept across the LLM calls); Seen flags are
+    # queued and written with one UID STORE when the session closes.
+    session = ImapSession(
+        a.imap_host,
+        a.imap_port,
+        a.imap_username,
+        a.imap_password,
+        folder=INBOX_FOLDER,
+        before_select=enable_condstore,
+    )
+    with session:
+        try:
+            jobs, progress = collect_batch(session, a, org_id, org_settings, cooldown_hours, limit)
+        except (ConnectionResetError, imaplib.IMAP4.abort, OSError) as e:
+            print("NETWORK/IMAP ERROR:", repr(e))
+            logger.exception(f"event=worker_error org=org{org_id} kind=network")
+            report_worker_status(last_error=f"NETWORK/IMAP ERROR: {repr(e)}"[:2000])
+            time.sleep(2)
+            return
+        except Exception as e:
+            print("WORKER ERROR:", repr(e))
+            logger.exception(f"event=worker_error org=org{org_id} kind=general")
+            report_worker_status(lock_health_ok=False, last_error=f"WORKER ERROR: {repr(e)}"[:2000])
+            return
+
+        if QUEUE_MODE:
+            queued = enqueue_batch(session, a, jobs, progress)
+            session.flush_flags()
+            jobs = []
+
+        sent_n = 0
+        for job in jobs:
+            if sent_last_hour + sent_n >= max_per_hour:
+                print(f"Rate limited: {sent_last_hour + sent_n}/{max_per_hour} replies in last hour. Leaving rest of batch.\n")
+                logger.info(f"event=rate_limited org={org_slug} sent_last_hour={sent_last_hour + sent_n} max_per_hour={max_per_hour}")
                 break
-
+            try:
+                outcome = handle_job(a, job, org_settings, client, model, session)
             except Exception as e:
                 print("WORKER ERROR:", repr(e))
                 logger.exception(f"event=worker_error org=org{org_id} kind=general")
+                report_worker_status(lock_health_ok=False, last_error=f"WORKER ERROR: {repr(e)}"[:2000])
+                continue
+            if outcome == "sent":
+                sent_n += 1
+            if outcome in ("sent", "failed", "skipped") and progress is not None:
+                progress.done(job["mid"])
+            if outcome == "stop":
+                break
 
-                try:
-                    if imap:
-                        imap.logout()
-                except Exception:
-                    pass
+        session.flush_flags()
 
-                db = SessionLocal()
-                try:
-                    upsert_worker_status(
-                        db,
-                        worker_id=WORKER_ID,
-                        last_run_at=now_utc(),
-                        lock_health_ok=False,
-                        credits_health_ok=True,
-                        last_error=f"WORKER ERROR: {repr(e)}"[:2000],
-                    )
-                    db.commit()
-                finally:
-                    db.close()
+    commit_sync_progress(a, progress)
+
+    if QUEUE_MODE:
+        logger.info(f"event=ingest_done org={org_slug} queued={queued} imap_logins={session.logins}")
+    elif len(jobs) > 1:
+        logger.info(f"event=batch_done org={org_slug} selected={len(jobs)} sent={sent_n} imap_logins={session.logins}")
 
-                break
 
 if __name__ == "__main__":
     import time as _time
@@ -1551,9 +2606,30 @@ if __name__ == "__main__":
     _logging.basicConfig(level=_logging.INFO)
     _logger = _logging.getLogger("aimail-worker")
 
+    def _on_sigterm(signum, frame):
+        # Process supervisors stop the worker with SIGTERM, which skips atexit handlers
+        credit_leases.release_all()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
     print("IMAP Worker started...\n")
     _logger.info("event=test_log_created org=system credits=0")
-    _logger.info(f"event=worker_start worker_id={WORKER_ID}")
+    _logger.info(f"event=worker_start worker_id={WORKER_ID} mode={WORKER_MODE} stages={','.join(sorted(WORKER_STAGES)) or 'inline'}")
+
+    if QUEUE_MODE:
+        stage_threads = start_stage_workers(
+            OpenAI(api_key=os.getenv("OPENAI_API_KEY")),
+            os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+        )
+        if "ingest" not in WORKER_STAGES:
+            # generate/deliver-only node: no IMAP polling here
+            for t in stage_threads:
+                t.join()
+            sys.exit(0)
+
+    if WORKER_MODE == "idle":
+        run_idle_forever()
 
     while True:
         try: